@@ -20,6 +20,11 @@ from .createrepo import createrepo
 from .exceptions import CreateRepoError, CoprSignError
 from .helpers import get_redis_logger, silent_remove, ensure_dir_exists, get_chroot_arch
 from .sign import sign_rpms_in_dir, unsign_rpms_in_dir, get_pubkey
+from .project_settings import ProjectSettings
+
+
+# lock key of actions whose project is not known, they exclude any other action
+EXCLUSIVE_LOCK_KEY = "*"
 
 
 class Action(object):
@@ -54,6 +59,44 @@ class Action(object):
     def __str__(self):
         return "<Action: {}>".format(self.data)
 
+    @property
+    def type_name(self):
+        return ActionType.get_name(self.data["action_type"])
+
+    def get_lock_keys(self):
+        """
+        Actions touching the same project must not run concurrently.
+
+        :return: set of "owner/project" names the action works with,
+            or {EXCLUSIVE_LOCK_KEY} when they can't be found out
+        """
+        action_type = self.data["action_type"]
+        try:
+            if action_type == ActionType.LEGAL_FLAG:
+                return set()
+            elif action_type in [ActionType.RENAME, ActionType.FORK]:
+                # reads the old project and creates the new one
+                names = [self.data["old_value"], self.data["new_value"]]
+            elif action_type == ActionType.DELETE:
+                names = [self.data["old_value"]]
+            else:
+                data = json.loads(self.data["data"])
+                names = ["{}/{}".format(data.get("ownername") or data.get("username") or data["user"],
+                                        data.get("projectname") or data["copr"])]
+        except (ValueError, KeyError, TypeError):
+            self.log.warning("Can't find out project of the action {}".format(self.data.get("id")))
+            return {EXCLUSIVE_LOCK_KEY}
+
+        return set(os.path.normpath(name) for name in names if name)
+
+    def invalidate_project_settings(self):
+        project_settings = ProjectSettings(self.opts, frontend_client=self.frontend_client)
+        for full_name in self.get_lock_keys() - {EXCLUSIVE_LOCK_KEY}:
+            try:
+                project_settings.invalidate(*full_name.split("/", 1))
+            except Exception as e:
+                self.log.exception("Failed to drop cached settings of {}: {}".format(full_name, e))
+
     def handle_legal_flag(self):
         self.log.debug("Action legal-flag: ignoring")
 
@@ -293,7 +336,10 @@ class Action(object):
                     createrepo(
                         path=createrepo_target,
                         front_url=self.front_url, base_url=result_base_url,
-                        username=username, projectname=projectname
+                        username=username, projectname=projectname,
+                        debounce=self.opts.createrepo_debounce,
+                        max_delay=self.opts.createrepo_max_delay,
+                        opts=self.opts,
                     )
                 except CoprRequestException:
                     # FIXME: dirty hack to catch the case when createrepo invoked upon a deleted project
@@ -421,6 +467,12 @@ class Action(object):
 
         action_type = self.data["action_type"]
 
+        # project settings are changed together with these actions (e.g. createrepo
+        # is emitted when auto_createrepo gets enabled), don't use the cached ones
+        if action_type in [ActionType.CREATEREPO, ActionType.RENAME, ActionType.FORK] or \
+                (action_type == ActionType.DELETE and self.data["object_type"] == "copr"):
+            self.invalidate_project_settings()
+
         if action_type == ActionType.DELETE:
             if self.data["object_type"] == "copr":
                 self.handle_delete_copr_project()
@@ -463,8 +515,10 @@ class Action(object):
                     not getattr(result, "job_ended_on", None):
                 result.job_ended_on = time.time()
 
+            # not batched, dispatcher fetches the action again
+            # as long as frontend doesn't know it has finished
             try:
-                self.frontend_client.update({"actions": [result]})
+                self.frontend_client.post_update({"actions": [result]})
             except RequestException as e:
                 self.log.exception(e)
 
@@ -481,6 +535,13 @@ class ActionType(object):
     UPDATE_MODULE_MD = 8
     BUILD_MODULE = 9
 
+    @classmethod
+    def get_name(cls, value):
+        for name, number in vars(cls).items():
+            if name.isupper() and number == value:
+                return name.lower()
+        return "unknown"
+
 
 class ActionResult(object):
     WAITING = 0
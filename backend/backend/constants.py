@@ -5,6 +5,7 @@ mockchain = "/usr/bin/mockchain"
 rsync = "/usr/bin/rsync"
 
 DEF_REMOTE_BASEDIR = "/var/tmp"
+DEF_DIST_GIT_CACHE_DIR = "/var/tmp/copr-dist-git-cache"
 DEF_BUILD_TIMEOUT = 3600 * 6
 DEF_REPOS = []
 DEF_CHROOT = None
@@ -28,6 +29,18 @@ class BuildStatus(object):
 
 LOG_PUB_SUB = "copr:backend:log:pubsub::"
 
+FRONTEND_UPDATES_REDIS_KEY = "copr:backend:frontend_updates:list::"
+# list of json encoded data for /backend/update/ waiting to be sent by UpdateFlusher
+
+FRONTEND_UPDATES_DEAD_REDIS_KEY = "copr:backend:frontend_updates_dead:list::"
+# list of json encoded updates the frontend kept refusing, put aside by UpdateFlusher
+
+ACTION_METRICS_REDIS_KEY = "copr:backend:action_metrics:hset::"
+# action queue depth and per action type counters, see ActionDispatcher.get_metrics()
+
+KNOWN_SIGN_KEYS_REDIS_KEY = "copr:backend:known_sign_keys:set::"
+# gpg emails of keys known to be in the signer keyring, see sign.ensure_user_keys()
+
 from logging import Formatter
 default_log_format = Formatter(
     '[%(asctime)s][%(levelname)6s][%(name)10s][%(filename)s:%(funcName)s:%(lineno)d] %(message)s')
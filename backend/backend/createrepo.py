@@ -1,4 +1,6 @@
 import os
+import time
+import tempfile
 from subprocess import Popen, PIPE
 
 from setproctitle import getproctitle, setproctitle
@@ -11,6 +13,7 @@ from lockfile import LockFile
 # log = get_redis_logger(opts, "createrepo", "actions")
 
 from .helpers import get_auto_createrepo_status
+from .project_settings import ProjectSettings
 from .exceptions import CreateRepoError
 
 
@@ -35,7 +38,7 @@ def run_cmd_unsafe(comm_str, lock_path):
     return out
 
 
-def createrepo_unsafe(path, dest_dir=None, base_url=None):
+def createrepo_unsafe(path, dest_dir=None, base_url=None, pkglist=None):
     """
         Run createrepo_c on the given path
 
@@ -47,6 +50,9 @@ def createrepo_unsafe(path, dest_dir=None, base_url=None):
     :param str dest_dir: [optional] relative to path location for repomd, in most cases
         you should also provide base_url.
     :param str base_url: optional parameter for createrepo_c, "--baseurl"
+    :param pkglist: [optional] packages (relative to path) added since the last run,
+        when given and repodata exist, only these packages are read and the rest
+        is taken over from the old metadata instead of scanning the whole directory
 
     :return tuple: (return_code,  stdout, stderr)
     """
@@ -54,6 +60,16 @@ def createrepo_unsafe(path, dest_dir=None, base_url=None):
     comm = ['/usr/bin/createrepo_c', '--database', '--ignore-lock']
     if os.path.exists(path + '/repodata/repomd.xml'):
         comm.append("--update")
+
+    pkglist_file = None
+    if pkglist is not None and \
+            os.path.exists(os.path.join(path, dest_dir or "", "repodata", "repomd.xml")):
+        fd, pkglist_file = tempfile.mkstemp(prefix="createrepo-pkglist-")
+        with os.fdopen(fd, "w") as f:
+            f.write("".join("{}\n".format(pkg) for pkg in sorted(pkglist)))
+        if "--update" not in comm:
+            comm.append("--update")
+        comm.extend(['--recycle-pkglist', '--pkglist', pkglist_file])
     if "epel-5" in path:
         # this is because rhel-5 doesn't know sha256
         comm.extend(['-s', 'sha', '--checksum', 'md5'])
@@ -73,7 +89,172 @@ def createrepo_unsafe(path, dest_dir=None, base_url=None):
 
     comm.append(path)
 
-    return run_cmd_unsafe(" ".join(map(str, comm)), os.path.join(path, "createrepo.lock"))
+    try:
+        return run_cmd_unsafe(" ".join(map(str, comm)), os.path.join(path, "createrepo.lock"))
+    finally:
+        if pkglist_file:
+            os.remove(pkglist_file)
+
+
+class CreaterepoScheduler(object):
+    """
+    Coalesces createrepo requests for one directory, so a burst of builds
+    finishing in the same chroot regenerates the repository once or twice
+    instead of once per build. Works across processes, the state is kept
+    in files inside the hidden .createrepo subdirectory, so it isn't listed
+    among the results:
+
+        - pending: packages added since the last run, one per line
+          ("*" means the whole directory has to be scanned)
+        - done: time when the last successful run started
+        - run.lock: held while createrepo runs
+
+    Every request is covered by a run which started after the request was made.
+    When such a run was already done by somebody else while we were waiting
+    for the lock, there is nothing left to do.
+
+    :param path: repository directory
+    :param debounce: wait until no new request came for this many seconds ...
+    :param max_delay: ... but at most this many seconds since our request
+    """
+
+    FULL_SCAN = "*"
+
+    def __init__(self, path, debounce=0, max_delay=0):
+        self.path = path
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        self.state_dir = os.path.join(path, ".createrepo")
+        self.pending_path = os.path.join(self.state_dir, "pending")
+        self.done_path = os.path.join(self.state_dir, "done")
+        self.lock_path = os.path.join(self.state_dir, "run")
+
+    def ensure_state_dir(self):
+        try:
+            os.makedirs(self.state_dir)
+        except OSError:
+            if not os.path.isdir(self.state_dir):
+                raise
+
+    def request(self, pkgs=None):
+        """
+        Announce that packages were added to the directory.
+
+        :param pkgs: list of added packages or directories with packages (relative
+            to the repository directory), None when the whole directory has to be scanned
+        :return: time of the request
+        """
+        lines = [self.FULL_SCAN] if pkgs is None else pkgs
+        self.ensure_state_dir()
+        # small appends are atomic, no need to lock
+        with open(self.pending_path, "a") as f:
+            f.write("".join("{}\n".format(line) for line in lines))
+        return time.time()
+
+    def wait_for_quiet(self, requested_on):
+        """
+        Give other builds finishing at about the same time a chance
+        to join the coming createrepo run.
+        """
+        if not self.debounce:
+            return
+
+        while True:
+            now = time.time()
+            try:
+                last_request = os.path.getmtime(self.pending_path)
+            except OSError:
+                # somebody took our request already
+                return
+            quiet_for = now - last_request
+            waiting_for = now - requested_on
+            if quiet_for >= self.debounce or waiting_for >= self.max_delay:
+                return
+            time.sleep(min(self.debounce - quiet_for, self.max_delay - waiting_for))
+
+    def last_run_started(self):
+        try:
+            with open(self.done_path) as f:
+                return float(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def take_pending(self):
+        """
+        :return: set of packages added since the last run (relative to the repository
+            directory), None when the whole directory has to be scanned, or empty
+            set when nothing was requested since the last run
+        """
+        processing_path = self.pending_path + ".processing"
+        try:
+            os.rename(self.pending_path, processing_path)
+        except OSError:
+            return set()
+
+        with open(processing_path) as f:
+            lines = set(line.strip() for line in f if line.strip())
+        os.remove(processing_path)
+
+        if self.FULL_SCAN in lines:
+            return None
+        return self.expand(lines)
+
+    def expand(self, pkgs):
+        """
+        :return: set of rpm files (relative to the repository directory)
+            given directly or found in the given directories
+        """
+        rpms = set()
+        for pkg in pkgs:
+            full_path = os.path.join(self.path, pkg)
+            if os.path.isdir(full_path):
+                rpms.update(os.path.relpath(os.path.join(root, name), self.path)
+                            for root, _, files in os.walk(full_path)
+                            for name in files if name.endswith(".rpm"))
+            elif os.path.exists(full_path):
+                rpms.add(pkg)
+        return rpms
+
+    def run(self, do_createrepo, pkgs=None):
+        """
+        Request createrepo and run it unless it gets done by somebody else meanwhile.
+
+        :param do_createrepo: callable taking the set of added packages
+            (None for full scan) and running createrepo
+        :param pkgs: see `request()`
+        :return: output of `do_createrepo` or None when the request was coalesced
+            with another run
+        """
+        requested_on = self.request(pkgs)
+        self.wait_for_quiet(requested_on)
+        return self.run_requested(do_createrepo, requested_on)
+
+    def run_requested(self, do_createrepo, requested_on):
+        """
+        Run createrepo for requests made so far, unless a run which started
+        after `requested_on` was done meanwhile.
+        """
+        self.ensure_state_dir()
+        with LockFile(self.lock_path):
+            if self.last_run_started() >= requested_on:
+                return None
+
+            started_on = time.time()
+            pkglist = self.take_pending()
+            if pkglist == set():
+                # a run which started before our request took it
+                return None
+            try:
+                out = do_createrepo(pkglist)
+            except Exception:
+                # packages taken from the pending list could be missing in the metadata now
+                self.request()
+                raise
+
+            with open(self.done_path, "w") as f:
+                f.write(repr(started_on))
+            return out
 
 
 APPDATA_CMD_TEMPLATE = \
@@ -149,7 +330,8 @@ def add_module_md(path):
 
 
 def createrepo(path, front_url, username, projectname,
-               override_acr_flag=False, base_url=None):
+               override_acr_flag=False, base_url=None,
+               pkgs=None, debounce=None, max_delay=0, opts=None):
     """
         Creates repo depending on the project setting "auto_createrepo".
         When enabled creates `repodata` at the provided path, otherwise
@@ -160,18 +342,41 @@ def createrepo(path, front_url, username, projectname,
     :param projectname: copr project name
     :param base_url: base_url to access rpms independently of repomd location
     :param Multiprocessing.Lock lock:  [optional] global copr-backend lock
-
-    :return: tuple(returncode, stdout, stderr) produced by `createrepo_c`
+    :param pkgs: [optional] packages or directories with packages (relative to path)
+        added since the last createrepo run, the rest of the directory is not scanned
+    :param debounce: [optional] when greater than zero, coalesce this request with
+        other requests for the same path, see `CreaterepoScheduler`
+    :param max_delay: [optional] max time to postpone createrepo because of `debounce`
+    :param opts: [optional] backend config, when given, project settings are taken
+        from the cache shared by backend processes
+
+    :return: tuple(returncode, stdout, stderr) produced by `createrepo_c`,
+        empty string when the request was coalesced with another run
     """
     # TODO: add means of logging
 
     base_url = base_url or ""
 
-    acr_flag = get_auto_createrepo_status(front_url, username, projectname)
-    if override_acr_flag or acr_flag:
-        out_cr = createrepo_unsafe(path)
-        out_ad = add_appdata(path, username, projectname)
-        out_md = add_module_md(path)
-        return "\n".join([out_cr, out_ad, out_md])
+    if override_acr_flag:
+        acr_flag = True
+    elif opts:
+        acr_flag = ProjectSettings(opts).get_auto_createrepo_status(username, projectname)
     else:
-        return createrepo_unsafe(path, base_url=base_url, dest_dir="devel")
+        acr_flag = get_auto_createrepo_status(front_url, username, projectname)
+
+    def do_createrepo(pkglist=None):
+        if acr_flag:
+            out_cr = createrepo_unsafe(path, pkglist=pkglist)
+            out_ad = add_appdata(path, username, projectname)
+            out_md = add_module_md(path)
+            return "\n".join([out_cr, out_ad, out_md])
+        else:
+            return createrepo_unsafe(path, base_url=base_url, dest_dir="devel", pkglist=pkglist)
+
+    if not debounce:
+        if pkgs is not None:
+            pkgs = CreaterepoScheduler(path).expand(pkgs)
+        return do_createrepo(pkgs)
+
+    scheduler = CreaterepoScheduler(path, debounce, max_delay)
+    return scheduler.run(do_createrepo, pkgs) or ""
@@ -5,22 +5,56 @@ from __future__ import unicode_literals
 from __future__ import division
 from __future__ import absolute_import
 
-import json
 import time
 import multiprocessing
 from setproctitle import setproctitle
-from requests import get, RequestException
+from requests import RequestException
 
 from backend.frontend import FrontendClient
 
-from ..actions import Action
-from ..helpers import get_redis_logger
+from ..actions import Action, EXCLUSIVE_LOCK_KEY
+from ..constants import ACTION_METRICS_REDIS_KEY
+from ..helpers import get_redis_logger, get_redis_connection, sleep_for
+
+
+class ActionWorker(multiprocessing.Process):
+    """
+    Runs a single action in a separate process and records how long it took.
+    """
+
+    def __init__(self, opts, action, queued_on):
+        multiprocessing.Process.__init__(self, name="action-worker-{}".format(action.data["id"]))
+
+        self.opts = opts
+        self.action = action
+        self.queued_on = queued_on
+
+    def run(self):
+        setproctitle("Action worker {} ({})".format(self.action.data["id"], self.action.type_name))
+        started_on = time.time()
+        try:
+            self.action.run()
+        except Exception as e: # dirty
+            self.action.log.exception(str(e))
+
+        try:
+            rc = get_redis_connection(self.opts)
+            pipe = rc.pipeline()
+            pipe.hincrby(ACTION_METRICS_REDIS_KEY, "{}:count".format(self.action.type_name), 1)
+            pipe.hincrbyfloat(ACTION_METRICS_REDIS_KEY, "{}:wait_seconds".format(self.action.type_name),
+                              started_on - self.queued_on)
+            pipe.hincrbyfloat(ACTION_METRICS_REDIS_KEY, "{}:run_seconds".format(self.action.type_name),
+                              time.time() - started_on)
+            pipe.execute()
+        except Exception as e:
+            self.action.log.exception("Failed to record action metrics: {}".format(e))
 
 
 class ActionDispatcher(multiprocessing.Process):
     """
-    1) Fetch action task from frontend
-    2) Run it synchronously
+    1) Fetch waiting actions from frontend into a local queue
+    2) Start the queued actions in up to `actions_max_workers` parallel workers,
+       actions of the same project are started one after another in the queue order
     3) Go to 1)
     """
 
@@ -30,6 +64,12 @@ class ActionDispatcher(multiprocessing.Process):
         self.opts = opts
         self.log = get_redis_logger(self.opts, "backend.action_dispatcher", "action_dispatcher")
         self.frontend_client = FrontendClient(self.opts, self.log)
+        self.rc = get_redis_connection(self.opts)
+
+        # fetched actions waiting for a worker, items are (action, queued_on)
+        self.queue = []
+        # running workers by action id
+        self.workers = {}
 
     def update_process_title(self, msg=None):
         proc_title = "Action dispatcher"
@@ -37,30 +77,118 @@ class ActionDispatcher(multiprocessing.Process):
             proc_title += " - " + msg
         setproctitle(proc_title)
 
-    def load_action(self):
+    def fetch_actions(self, wait=None):
         """
-        Retrieve an action task from frontend.
+        Add new waiting actions from frontend to the local queue.
+
+        :return: number of fetched actions
         """
-        self.log.info("Waiting for an action task from frontend...")
-        get_action_init_time = time.time()
+        # fetch more than we can run, so there is something to start right after
+        # a worker ends; actions waiting for their project don't count, otherwise
+        # a long series of actions of one busy project would hold back the others
+        startable, _ = self.split_queue()
+        count = 2 * self.opts.actions_max_workers - len(startable)
+        if count <= 0:
+            return 0
 
-        action_task = None
-        while not action_task:
-            self.update_process_title("Waiting for an action task from frontend for {}s"
-                                      .format(int(time.time() - get_action_init_time)))
-            try:
-                r = get("{0}/backend/waiting/".format(self.opts.frontend_base_url),
-                        auth=("user", self.opts.frontend_auth))
-                action_task = r.json().get("action")
-            except (RequestException, ValueError) as error:
-                self.log.exception("Retrieving an action task from {} failed with error: {}"
-                                   .format(self.opts.frontend_base_url, error))
-            finally:
-                if not action_task:
-                    time.sleep(self.opts.sleeptime)
+        exclude = [action.data["id"] for action, _ in self.queue] + list(self.workers.keys())
+        action_tasks = self.frontend_client.waiting_actions(count, exclude=exclude, wait=wait)
+
+        queued_on = time.time()
+        for action_task in action_tasks:
+            self.log.info("Got new action_task {} of type {}"
+                          .format(action_task["id"], action_task["action_type"]))
+            action = Action(self.opts, action_task, frontend_client=self.frontend_client)
+            self.queue.append((action, queued_on))
+        return len(action_tasks)
+
+    def split_queue(self):
+        """
+        An action can't start while an earlier action of the same project
+        is either running or still queued. Actions of unknown project wait
+        for all earlier ones and block all later ones.
+
+        :return: tuple of lists of queue items, (startable, blocked)
+        """
+        busy = set()
+        for worker in self.workers.values():
+            busy |= worker.action.get_lock_keys()
 
-        self.log.info("Got new action_task {} of type {}".format(action_task['id'], action_task['action_type']))
-        return Action(self.opts, action_task, frontend_client=self.frontend_client)
+        startable, blocked = [], []
+        for action, queued_on in self.queue:
+            lock_keys = action.get_lock_keys()
+            (blocked if self.conflicts(lock_keys, busy) else startable).append((action, queued_on))
+            busy |= lock_keys
+        return startable, blocked
+
+    @staticmethod
+    def conflicts(lock_keys, busy):
+        """
+        :return: True if an action with `lock_keys` can't run along
+            with actions holding `busy` lock keys
+        """
+        if EXCLUSIVE_LOCK_KEY in lock_keys | busy:
+            return bool(lock_keys) and bool(busy)
+        return bool(lock_keys & busy)
+
+    def start_actions(self):
+        """
+        Start queued actions while there are free workers.
+
+        :return: number of started actions
+        """
+        startable, _ = self.split_queue()
+
+        started = 0
+        for action, queued_on in startable:
+            if len(self.workers) >= self.opts.actions_max_workers:
+                break
+
+            self.queue.remove((action, queued_on))
+            worker = ActionWorker(self.opts, action, queued_on)
+            self.workers[action.data["id"]] = worker
+            worker.start()
+            started += 1
+            self.log.info("Started new action {} of type {}"
+                          .format(action.data["id"], action.data["action_type"]))
+        return started
+
+    def clean_finished_workers(self):
+        for action_id, worker in list(self.workers.items()):
+            if not worker.is_alive():
+                worker.join(5)
+                del self.workers[action_id]
+                self.log.info("Action {} finished".format(action_id))
+
+    def report_metrics(self):
+        try:
+            self.rc.hmset(ACTION_METRICS_REDIS_KEY, {
+                "queued": len(self.queue),
+                "running": len(self.workers),
+            })
+        except Exception as e:
+            self.log.exception("Failed to report action metrics: {}".format(e))
+
+    def get_metrics(self):
+        """
+        :return: dict with the action queue depth and, for each action type,
+            number of processed actions and their mean wait/run time in seconds
+        """
+        raw = self.rc.hgetall(ACTION_METRICS_REDIS_KEY)
+        metrics = {
+            "queued": int(raw.pop("queued", 0)),
+            "running": int(raw.pop("running", 0)),
+            "types": {},
+        }
+        for field, value in raw.items():
+            type_name, counter = field.rsplit(":", 1)
+            metrics["types"].setdefault(type_name, {})[counter] = float(value)
+
+        for counters in metrics["types"].values():
+            count = counters.get("count") or 1
+            counters["mean_wait_seconds"] = counters.get("wait_seconds", 0) / count
+            counters["mean_run_seconds"] = counters.get("run_seconds", 0) / count
+        return metrics
 
     def run(self):
         """
@@ -70,12 +198,24 @@ class ActionDispatcher(multiprocessing.Process):
         self.update_process_title()
 
         while True:
-            action = self.load_action()
+            self.clean_finished_workers()
+
+            # long-poll the frontend only when there is nothing else to do
+            idle = not self.workers and not self.queue
+            poll_start = time.time()
             try:
-                action.run()
-            except Exception as e: # dirty
-                self.log.exception(str(e))
-            msg = "Started new action {} of type {}"\
-                  .format(action.data["id"], action.data["action_type"])
-            self.update_process_title(msg)
-            self.log.info(msg)
+                self.fetch_actions(wait=self.opts.sleeptime if idle else None)
+            except (RequestException, ValueError, KeyError) as error:
+                self.log.exception("Retrieving action tasks from {} failed with error: {}"
+                                   .format(self.opts.frontend_base_url, error))
+                time.sleep(self.opts.sleeptime)
+
+            self.start_actions()
+            self.report_metrics()
+            self.update_process_title("{} running, {} queued actions"
+                                      .format(len(self.workers), len(self.queue)))
+
+            if self.workers or self.queue:
+                time.sleep(self.opts.actions_poll_period)
+            else:
+                sleep_for(self.opts.sleeptime, poll_start)
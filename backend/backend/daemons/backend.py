@@ -22,6 +22,7 @@ from ..exceptions import CoprBackendError
 from ..helpers import BackendConfigReader, get_redis_logger
 from .build_dispatcher import BuildDispatcher
 from .action_dispatcher import ActionDispatcher
+from .update_flusher import UpdateFlusher
 
 
 class CoprBackend(object):
@@ -59,9 +60,19 @@ class CoprBackend(object):
         self.update_conf()
         self.log.info("Initial config: {}".format(self.opts))
 
+        update_flusher = None
+        if self.opts.frontend_update_batching:
+            update_flusher = UpdateFlusher(self.opts)
+            try:
+                self.log.info("Sending updates queued by the previous run")
+                update_flusher.flush_all()
+            except RequestException as err:
+                self.log.exception(err)
+                raise CoprBackendError(err)
+
         try:
             self.log.info("Rescheduling old unfinished builds")
-            self.frontend_client.reschedule_all_running(120) # 10 minutes
+            self.frontend_client.reschedule_all_running(25) # ~10 minutes
         except RequestException as err:
             self.log.exception(err)
             raise CoprBackendError(err)
@@ -69,6 +80,8 @@ class CoprBackend(object):
         build_dispatcher = BuildDispatcher(self.opts)
         action_dispatcher = ActionDispatcher(self.opts)
 
+        if update_flusher:
+            update_flusher.start()
         build_dispatcher.start()
         action_dispatcher.start()
 
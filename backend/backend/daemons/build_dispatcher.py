@@ -9,14 +9,16 @@ import time
 import os
 import multiprocessing
 import json
+from collections import deque, defaultdict
 from setproctitle import setproctitle
-from requests import get, RequestException
+from requests import RequestException
 
 from backend.frontend import FrontendClient
 
-from ..helpers import get_redis_logger
+from ..helpers import get_redis_logger, sleep_for
 from ..exceptions import DispatchBuildError, NoVmAvailable
 from ..job import BuildJob
+from ..vm_manage import PUBSUB_VM_RELEASED
 from ..vm_manage.manager import VmManager
 from .worker import Worker
 
@@ -27,6 +29,13 @@ class BuildDispatcher(multiprocessing.Process):
     2) Get a free VM for it
     3) Create a worker for the job
     4) Start it asynchronously and go to 1)
+
+    With build_prefetch_count set, leased jobs which get no VM are held in
+    a queue of their VM group instead of being deferred on frontend. Held jobs
+    are tried again when a worker releases a VM of the group, or once per
+    `sleeptime` for VMs which became ready otherwise. Job of the owner who uses
+    the fewest VMs of the group goes first, so one user's backlog doesn't
+    take all VMs released in the group.
     """
 
     def __init__(self, opts):
@@ -42,6 +51,16 @@ class BuildDispatcher(multiprocessing.Process):
         # PC => max N builders per user
         self.group_to_usermax = dict()
 
+        # leased jobs waiting for dispatch, items are (job, lease_deadline)
+        self.job_queue = deque()
+        # group id => leased jobs waiting for a VM of the group, items are (job, lease_deadline)
+        self.held_jobs = defaultdict(deque)
+        # group id => time when to try acquiring VM for held jobs again
+        self.group_retry_at = dict()
+        # lease deadline of the job returned by the last load_job()
+        self.lease_deadline = None
+        self.vm_release_events = None
+
         self.init_internal_structures()
 
     def get_vm_group_id(self, arch):
@@ -68,10 +87,148 @@ class BuildDispatcher(multiprocessing.Process):
                self.log.debug("user might use only {0}VMs for {1} group".format(group["max_vm_per_user"], group_id))
                self.group_to_usermax[group_id] = group["max_vm_per_user"]
 
+    def fetch_jobs(self):
+        """
+        Lease a batch of build jobs from frontend and put them into the local queue.
+
+        :return: number of fetched jobs
+        """
+        # frontend offers jobs with expired lease again, don't hold them twice
+        self.drop_expired_held_jobs()
+        # groups with full holding queue wait for VMs first
+        archs = sorted(arch for arch, group_id in self.arch_to_group.items()
+                       if len(self.held_jobs[group_id]) < self.opts.build_prefetch_count)
+        if not archs:
+            return 0
+
+        # don't block in long-poll while held jobs could be started
+        wait = 0 if self.has_held_jobs() else self.opts.sleeptime
+        tasks = self.frontend_client.lease_build_tasks(
+            archs, self.opts.build_prefetch_count, self.opts.build_lease_seconds, wait=wait)
+
+        # frontend could have held the request for a while, count the lease from its reply
+        lease_deadline = time.time() + self.opts.build_lease_seconds
+        for task in tasks:
+            self.job_queue.append((BuildJob(task, self.opts), lease_deadline))
+        return len(tasks)
+
+    def pop_leased_job(self):
+        """
+        :return: first (job, lease_deadline) from the local queue whose lease is still valid, or None
+        """
+        while self.job_queue:
+            job, lease_deadline = self.job_queue.popleft()
+            if time.time() < lease_deadline:
+                return job, lease_deadline
+            self.log.info("Lease for job {} expired, dropping it from local queue"
+                          .format(job.task_id))
+        return None
+
+    def drop_expired_held_jobs(self):
+        for held in self.held_jobs.values():
+            for job, lease_deadline in list(held):
+                if time.time() >= lease_deadline:
+                    self.log.info("Lease for held job {} expired, dropping it".format(job.task_id))
+                    held.remove((job, lease_deadline))
+
+    def has_held_jobs(self):
+        return any(self.held_jobs.values())
+
+    def hold_job(self, job, group_id, lease_deadline, group_full):
+        """
+        Keep the job until a VM of its group is released.
+
+        :param group_full: no VM of the group is available, don't try to acquire
+            one until some is released, otherwise only the owner reached the limit
+        """
+        self.held_jobs[group_id].append((job, lease_deadline))
+        if group_full:
+            self.group_retry_at[group_id] = time.time() + self.opts.sleeptime
+
+    def is_group_full(self, group_id):
+        return self.group_retry_at.get(group_id, 0) > time.time()
+
+    def pop_held_job(self):
+        """
+        :return: (job, lease_deadline) held for a group which could have a free VM,
+            the job of the owner using the fewest VMs of the group, the oldest one
+            for the same number of VMs; None when there is no such job
+        """
+        self.drop_expired_held_jobs()
+        for group_id, held in self.held_jobs.items():
+            if not held or self.is_group_full(group_id):
+                continue
+
+            in_use = self.vm_manager.get_vm_in_use_counts(group_id)
+            candidates = [(in_use.get(item[0].project_owner, 0), index)
+                          for index, item in enumerate(held)
+                          if in_use.get(item[0].project_owner, 0) < self.group_to_usermax[group_id]]
+            if not candidates:
+                continue
+            item = held[min(candidates)[1]]
+            held.remove(item)
+            return item
+        return None
+
+    def read_vm_release_events(self, timeout=0):
+        """
+        Mark groups in which a VM was released, so their held jobs are tried again.
+        Waits up to `timeout` seconds for the first event.
+        """
+        if self.vm_release_events is None:
+            if timeout:
+                time.sleep(timeout)
+            return
+        message = self.vm_release_events.get_message(timeout=timeout)
+        while message:
+            if message["type"] == "message":
+                self.group_retry_at.pop(int(message["data"]), None)
+            message = self.vm_release_events.get_message()
+
+    def subscribe_vm_release_events(self):
+        self.vm_release_events = self.vm_manager.rc.pubsub(ignore_subscribe_messages=True)
+        self.vm_release_events.subscribe(PUBSUB_VM_RELEASED)
+
+    def load_leased_job(self):
+        """
+        Retrieve a single build job from the local queue, refill the queue from frontend
+        when it runs out of jobs.
+        """
+        get_task_init_time = time.time()
+
+        self.read_vm_release_events()
+        item = self.pop_held_job() or self.pop_leased_job()
+        while not item:
+            self.update_process_title("Waiting for jobs from frontend for {} s"
+                                      .format(int(time.time() - get_task_init_time)))
+            poll_start = time.time()
+            try:
+                if self.fetch_jobs():
+                    self.log.info("Leased {} build jobs".format(len(self.job_queue)))
+                item = self.pop_leased_job()
+            except (RequestException, ValueError, KeyError) as error:
+                self.log.exception("Leasing build jobs from {} failed with error: {}"
+                                   .format(self.opts.frontend_base_url, error))
+                time.sleep(self.opts.sleeptime)
+            else:
+                if not item and self.has_held_jobs():
+                    self.read_vm_release_events(
+                        timeout=max(self.opts.sleeptime - (time.time() - poll_start), 0))
+                    item = self.pop_held_job()
+                elif not item:
+                    sleep_for(self.opts.sleeptime, poll_start)
+
+        job, self.lease_deadline = item
+        self.log.info("Got new build job {}".format(job.task_id))
+        return job
+
     def load_job(self):
         """
         Retrieve a single build job from frontend.
         """
+        if self.opts.build_prefetch_count:
+            return self.load_leased_job()
+
         self.log.info("Waiting for a job from frontend...")
         get_task_init_time = time.time()
 
@@ -79,16 +236,17 @@ class BuildDispatcher(multiprocessing.Process):
         while not task:
             self.update_process_title("Waiting for a job from frontend for {} s"
                                       .format(int(time.time() - get_task_init_time)))
+            poll_start = time.time()
             try:
-                r = get("{0}/backend/waiting/".format(self.opts.frontend_base_url),
-                        auth=("user", self.opts.frontend_auth))
-                task = r.json().get("build")
+                task = self.frontend_client.waiting(
+                    wait=self.opts.sleeptime, wait_for=["build"]).get("build")
             except (RequestException, ValueError) as error:
                 self.log.exception("Retrieving build job from {} failed with error: {}"
                                    .format(self.opts.frontend_base_url, error))
-            finally:
+                time.sleep(self.opts.sleeptime)
+            else:
                 if not task:
-                    time.sleep(self.opts.sleeptime)
+                    sleep_for(self.opts.sleeptime, poll_start)
 
         self.log.info("Got new build job {}".format(task['task_id']))
         return BuildJob(task, self.opts)
@@ -114,6 +272,35 @@ class BuildDispatcher(multiprocessing.Process):
 
         return can_build_start
 
+    def acquire_vm(self, job):
+        """
+        :return: VM acquired for the job, None if the job was deferred or held
+        """
+        vm_group_id = self.get_vm_group_id(job.arch)
+        if self.opts.build_prefetch_count and self.is_group_full(vm_group_id):
+            self.hold_job(job, vm_group_id, self.lease_deadline, group_full=False)
+            return None
+
+        try:
+            self.log.info("Acquiring VM for job {}...".format(str(job)))
+            vm = self.vm_manager.acquire_vm(vm_group_id, job.project_owner, os.getpid(),
+                                            job.task_id, job.build_id, job.chroot,
+                                            job.package_name)
+        except NoVmAvailable as error:
+            if not self.opts.build_prefetch_count:
+                self.log.info("No available resources for task {} (Reason: {}). Deferring job."
+                              .format(job.task_id, error))
+                self.frontend_client.defer_build(job.build_id, job.chroot)
+                return None
+            self.log.info("No available resources for task {} (Reason: {}). Holding job."
+                          .format(job.task_id, error))
+            group_full = self.vm_manager.can_user_acquire_more_vm(job.project_owner, vm_group_id)
+            self.hold_job(job, vm_group_id, self.lease_deadline, group_full)
+            return None
+
+        self.log.info("VM {} for job {} successfully acquired".format(vm.vm_name, job.task_id))
+        return vm
+
     def clean_finished_workers(self, workers):
         for worker in workers:
             if not worker.is_alive():
@@ -128,6 +315,8 @@ class BuildDispatcher(multiprocessing.Process):
         """
         self.log.info("Build dispatching started.")
         self.update_process_title()
+        if self.opts.build_prefetch_count:
+            self.subscribe_vm_release_events()
 
         workers = []
         next_worker_id = 1
@@ -135,22 +324,12 @@ class BuildDispatcher(multiprocessing.Process):
             self.clean_finished_workers(workers)
 
             job = self.load_job()
-
-            try:
-                self.log.info("Acquiring VM for job {}...".format(str(job)))
-                vm_group_id = self.get_vm_group_id(job.arch)
-                vm = self.vm_manager.acquire_vm(vm_group_id, job.project_owner, os.getpid(),
-                                                job.task_id, job.build_id, job.chroot)
-            except NoVmAvailable as error:
-                self.log.info("No available resources for task {} (Reason: {}). Deferring job."
-                              .format(job.task_id, error))
-                self.frontend_client.defer_build(job.build_id, job.chroot)
+            vm = self.acquire_vm(job)
+            if not vm:
                 continue
-            else:
-                self.log.info("VM {} for job {} successfully acquired".format(vm.vm_name, job.task_id))
 
             if not self.can_build_start(job):
-                self.vm_manager.release_vm(vm.vm_name)
+                self.vm_manager.release_vm(vm.vm_name, vm.group)
                 continue
 
             worker = Worker(
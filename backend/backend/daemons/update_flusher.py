@@ -0,0 +1,149 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import json
+import time
+import multiprocessing
+from requests import RequestException
+from setproctitle import setproctitle
+
+from backend.frontend import FrontendClient
+
+from ..constants import FRONTEND_UPDATES_REDIS_KEY, FRONTEND_UPDATES_DEAD_REDIS_KEY
+from ..helpers import get_redis_logger, get_redis_connection
+
+
+class UpdateFlusher(multiprocessing.Process):
+    """
+    Sends updates queued by FrontendClient.update() to the frontend in batches,
+    so many workers finishing at the same time result in one /backend/update/ request.
+
+    Updates are removed from the queue only after the frontend accepted them,
+    so each update is delivered at least once and in the order it was queued.
+    When the frontend refuses a batch, its updates are sent one by one and an
+    update refused `frontend_update_max_failures` times in a row is moved
+    to the FRONTEND_UPDATES_DEAD_REDIS_KEY list, so it doesn't block the rest.
+    """
+
+    # frontend (or the proxy in front of it) is down, not a problem of the update
+    UNAVAILABLE_STATUSES = (502, 503, 504)
+
+    def __init__(self, opts):
+        multiprocessing.Process.__init__(self, name="update-flusher")
+
+        self.opts = opts
+        self.log = get_redis_logger(self.opts, "backend.update_flusher", "update_flusher")
+        self.frontend_client = FrontendClient(self.opts, self.log)
+        self.rc = get_redis_connection(self.opts)
+
+        # raw update -> how many times in a row frontend refused it
+        self.failures = {}
+
+    def parse_update(self, raw_update):
+        """
+        :return: decoded update, None for malformed one
+        """
+        try:
+            return json.loads(raw_update)
+        except ValueError:
+            self.log.error("Dropping malformed update: {}".format(raw_update))
+            return None
+
+    def flush(self):
+        """
+        Send one batch of queued updates to the frontend.
+
+        :return: number of updates taken from the queue
+        :raises RequestException: when frontend is unavailable
+        """
+        raw_updates = self.rc.lrange(FRONTEND_UPDATES_REDIS_KEY, 0,
+                                     self.opts.frontend_update_batch_size - 1)
+        if not raw_updates:
+            return 0
+
+        batch = {}
+        for raw_update in raw_updates:
+            update = self.parse_update(raw_update)
+            for typ, objects in (update or {}).items():
+                batch.setdefault(typ, []).extend(objects)
+
+        if batch:
+            try:
+                self.frontend_client.post_update(batch)
+            except RequestException as error:
+                self.log.warning("Frontend didn't accept batch of {} updates, sending them one by one: {}"
+                                 .format(len(raw_updates), error))
+                return self.flush_one_by_one(raw_updates)
+
+        # only this process removes items from the queue head, workers append to its tail
+        self.rc.ltrim(FRONTEND_UPDATES_REDIS_KEY, len(raw_updates), -1)
+        self.log.debug("Sent {} queued updates to frontend".format(len(raw_updates)))
+        return len(raw_updates)
+
+    def flush_one_by_one(self, raw_updates):
+        """
+        Send updates separately, stop at the first one which has to be tried again later.
+
+        :return: number of updates taken from the queue
+        """
+        taken = 0
+        try:
+            for raw_update in raw_updates:
+                update = self.parse_update(raw_update)
+                if update is not None:
+                    self.post_single(raw_update, update)
+                taken += 1
+        finally:
+            self.rc.ltrim(FRONTEND_UPDATES_REDIS_KEY, taken, -1)
+        return taken
+
+    def post_single(self, raw_update, update):
+        """
+        Send one update, move it to the dead letter list when frontend keeps refusing it.
+
+        :raises RequestException: when the update should be tried again later
+        """
+        try:
+            self.frontend_client.post_update(update, max_repeats=1)
+        except RequestException as error:
+            response = getattr(error, "response", None)
+            if response is None or response.status_code in self.UNAVAILABLE_STATUSES:
+                raise
+
+            failures = self.failures.get(raw_update, 0) + 1
+            if failures < self.opts.frontend_update_max_failures:
+                self.failures[raw_update] = failures
+                raise
+
+            self.log.error("Frontend refused update {} times, moving it to {}: {}"
+                           .format(failures, FRONTEND_UPDATES_DEAD_REDIS_KEY, raw_update))
+            self.rc.rpush(FRONTEND_UPDATES_DEAD_REDIS_KEY, raw_update)
+        self.failures.pop(raw_update, None)
+
+    def flush_all(self):
+        """
+        Send everything queued so far, e.g. updates left from the previous backend run.
+        """
+        while self.flush():
+            pass
+
+    def run(self):
+        """
+        Executes update flushing process.
+        """
+        self.log.info("Update flusher started.")
+        setproctitle("Update flusher")
+
+        while True:
+            try:
+                sent = self.flush()
+            except Exception as error:
+                self.log.exception("Failed to send queued updates to frontend: {}".format(error))
+                sent = 0
+
+            if sent < self.opts.frontend_update_batch_size:
+                time.sleep(self.opts.frontend_update_flush_period)
@@ -10,10 +10,11 @@ from multiprocessing import Process
 import time
 from setproctitle import setproctitle
 import traceback
-import psutil
-
 from ..vm_manage import VmStates
+from ..vm_manage.models import state_index_keys
+from ..vm_manage.planner import group_demand, plan_group
 from ..exceptions import VmSpawnLimitReached
+from ..frontend import FrontendClient
 
 from ..helpers import get_redis_logger
 
@@ -35,17 +36,19 @@ class VmMaster(Process):
         self.checker = checker
 
         self.kill_received = False
+        self.frontend_client = None
 
         self.log = get_redis_logger(self.opts, "vmm.vm_master", "vmm")
         self.vmm.set_logger(self.log)
 
-    def remove_old_dirty_vms(self):
+    def remove_old_dirty_vms(self, snapshot=None):
         # terminate vms bound_to user and time.time() - vm.last_release_time > threshold_keep_vm_for_user_timeout
         #  or add field to VMD ot override common threshold
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.READY]):
-            if vmd.get_field(self.vmm.rc, "bound_to_user") is None:
+        pool = snapshot or self.vmm
+        for vmd in pool.get_vm_by_group_and_state_list(None, [VmStates.READY]):
+            if getattr(vmd, "bound_to_user", None) is None:
                 continue
-            last_release = vmd.get_field(self.vmm.rc, "last_release")
+            last_release = getattr(vmd, "last_release", None)
             if last_release is None:
                 continue
             not_re_acquired_in = time.time() - float(last_release)
@@ -56,105 +59,91 @@ class VmMaster(Process):
 
 
     def check_one_vm_for_dead_builder(self, vmd):
-        # TODO: builder should renew lease periodically
-        # and we should use that time instead of in_use_since and pid checks
-        in_use_since = vmd.get_field(self.vmm.rc, "in_use_since")
-        pid = vmd.get_field(self.vmm.rc, "used_by_pid")
-
-        if not in_use_since or not pid:
-            return
-        in_use_time_elapsed = time.time() - float(in_use_since)
-
-        # give a minute for worker to set correct title
-        if in_use_time_elapsed < 60 and str(pid) == "None":
+        """
+        Terminate VM whose lease expired, the worker using it is gone or stuck
+        """
+        in_use_since = getattr(vmd, "in_use_since", None)
+        if not in_use_since:
             return
-
-        pid = int(pid)
-        # try:
-        #     # here we can catch race condition: worker acquired VM but haven't set process title yet
-        #     if psutil.pid_exists(pid) and vmd.vm_name in psutil.Process(pid).cmdline[0]:
-        #         return
-        #
-        #     self.log.info("Process `{}` not exists anymore, doing second try. VM data: {}"
-        #                   .format(pid, vmd))
-        #     # dirty hack: sleep and check again
-        #     time.sleep(5)
-        #     if psutil.pid_exists(pid) and vmd.vm_name in psutil.Process(pid).cmdline[0]:
-        #         return
-        # except Exception:
-        #     self.log.exception("Failed do determine if process `{}` still alive for VM: {}, assuming alive"
-        #                        .format(pid, vmd))
-        #     return
-
-        # psutil changed Process().cmdline from property to function between f20 and f22
-        # disabling more precise check for now
-        try:
-            # here we can catch race condition: worker acquired VM but haven't set process title yet
-            if psutil.pid_exists(pid):
-                return
-
-            self.log.info("Process `{}` not exists anymore, doing second try. VM data: {}"
-                          .format(pid, vmd))
-            # dirty hack: sleep and check again
-            time.sleep(5)
-            if psutil.pid_exists(pid):
-                return
-
-        except Exception:
-            self.log.exception("Failed do determine if process `{}` still alive for VM: {}, assuming alive"
-                               .format(pid, vmd))
+        # lease is set on acquire, only VMs acquired before leases were used can miss it earlier
+        if time.time() - float(in_use_since) < self.opts.vm_lease_seconds:
             return
 
-        self.log.info("Process `{}` not exists anymore, terminating VM: {} ".format(pid, vmd.vm_name))
+        self.log.info("Lease of builder `{}` expired, terminating VM: {} "
+                      .format(getattr(vmd, "used_by_pid", None), vmd.vm_name))
         self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.IN_USE)
         # TODO: build rescheduling ?
 
-    def remove_vm_with_dead_builder(self):
+    def remove_vm_with_dead_builder(self, snapshot=None):
         # TODO: rewrite build manage at backend and move functionality there
         # VMM shouldn't do this
 
-        # check that process who acquired VMD still exists, otherwise release VM
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.IN_USE]):
+        # workers renew lease of the acquired VM, expired lease means the worker is dead
+        pool = snapshot or self.vmm
+        in_use = pool.get_vm_by_group_and_state_list(None, [VmStates.IN_USE])
+        for vmd in self.vmm.get_vms_without_lease(in_use):
             self.check_one_vm_for_dead_builder(vmd)
 
-    def check_vms_health(self):
+    def check_vms_health(self, snapshot=None):
         # for machines in state ready and time.time() - vm.last_health_check > threshold_health_check_period
         states_to_check = [VmStates.CHECK_HEALTH_FAILED, VmStates.READY,
                            VmStates.GOT_IP, VmStates.IN_USE]
 
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, states_to_check):
-            last_health_check = vmd.get_field(self.vmm.rc, "last_health_check")
+        # one batch at a time, VMs due for a check stay usable until their batch starts
+        if self.checker.is_running():
+            return
+
+        pool = snapshot or self.vmm
+        to_check = []
+        for vmd in pool.get_vm_by_group_and_state_list(None, states_to_check):
+            last_health_check = float(getattr(vmd, "last_health_check", None) or 0)
             check_period = self.opts.build_groups[vmd.group]["vm_health_check_period"]
-            if not last_health_check or time.time() - float(last_health_check) > check_period:
-                self.start_vm_check(vmd.vm_name)
+            if time.time() - last_health_check > check_period:
+                to_check.append((last_health_check, vmd.vm_name))
+        if to_check:
+            self.start_vm_checks([vm_name for _, vm_name in sorted(to_check)])
 
-    def start_vm_check(self, vm_name):
+    def start_vm_checks(self, vm_names):
         """
-        Start VM health check sub-process if current VM state allows it
-        """
-
-        vmd = self.vmm.get_vm_by_name(vm_name)
-        orig_state = vmd.state
+        Start one health check thread for the first `vm_health_check_batch_size`
+        VMs whose current state allows it, the others are left for the next cycle
 
-        if self.vmm.lua_scripts["set_checking_state"](keys=[vmd.vm_key], args=[time.time()]) == "OK":
-            # can start
-            try:
-                self.checker.run_check_health(vmd.vm_name, vmd.vm_ip)
-            except Exception as err:
-                self.log.exception("Failed to start health check: {}".format(err))
+        :return: number of VMs being checked
+        """
+        orig_states = {}
+        vms = []
+        for vm_name in vm_names:
+            if len(vms) >= self.opts.vm_health_check_batch_size:
+                break
+            vmd = self.vmm.get_vm_by_name(vm_name)
+            orig_state = vmd.state
+
+            keys = [vmd.vm_key] + state_index_keys(vmd.group)
+            if self.vmm.lua_scripts["set_checking_state"](keys=keys, args=[time.time()]) == "OK":
+                orig_states[vmd.vm_name] = (vmd, orig_state)
+                vms.append((vmd.vm_name, vmd.vm_ip))
+            else:
+                self.log.debug("Failed to start vm check, wrong state")
+
+        if not vms:
+            return 0
+
+        # can start
+        try:
+            self.checker.run_check_health_batch(vms)
+        except Exception as err:
+            self.log.exception("Failed to start health check: {}".format(err))
+            for vmd, orig_state in orig_states.values():
                 if orig_state != VmStates.IN_USE:
                     vmd.store_field(self.vmm.rc, "state", orig_state)
+        return len(vms)
 
-        else:
-            self.log.debug("Failed to start vm check, wrong state")
-            return False
-
-    def _check_total_running_vm_limit(self, group):
+    def _check_total_running_vm_limit(self, group, snapshot=None):
         """ Checks that number of VM in any state excluding Terminating plus
         number of running spawn processes is less than
         threshold defined by BackendConfig.build_group[group]["max_vm_total"]
         """
-        active_vmd_list = self.vmm.get_vm_by_group_and_state_list(
+        active_vmd_list = (snapshot or self.vmm).get_vm_by_group_and_state_list(
             group, [VmStates.GOT_IP, VmStates.READY, VmStates.IN_USE,
                     VmStates.CHECK_HEALTH, VmStates.CHECK_HEALTH_FAILED])
         total_vm_estimation = len(active_vmd_list) + self.spawner.get_proc_num_per_group(group)
@@ -185,27 +174,27 @@ class VmMaster(Process):
                 "Skip spawn for group {}: reached maximum number of spawning processes: {}"
                 .format(group, self.spawner.get_proc_num_per_group(group)))
 
-    def _check_total_vm_limit(self, group):
+    def _check_total_vm_limit(self, group, snapshot=None):
         """ Check that number of running spawn processes is less than
         threshold defined by BackendConfig.build_group[]["max_spawn_processes"]
         """
-        count_all_vm = len(self.vmm.get_all_vm_in_group(group))
+        count_all_vm = len((snapshot or self.vmm).get_all_vm_in_group(group))
         if count_all_vm >= 2 * self.opts.build_groups[group]["max_vm_total"]:
             raise VmSpawnLimitReached(
                 "Skip spawn for group {}: #(ALL VM) >= 2 * max_vm_total reached: {}"
                 .format(group, count_all_vm))
 
-    def try_spawn_one(self, group):
+    def try_spawn_one(self, group, snapshot=None):
         """
         Starts spawning process if all conditions are satisfied
         """
         # TODO: add setting "max_vm_in_ready_state", when this number reached, do not spawn more VMS, min value = 1
 
         try:
-            self._check_total_running_vm_limit(group)
+            self._check_total_running_vm_limit(group, snapshot)
             self._check_elapsed_time_after_spawn(group)
             self._check_number_of_running_spawn_processes(group)
-            self._check_total_vm_limit(group)
+            self._check_total_vm_limit(group, snapshot)
         except VmSpawnLimitReached as err:
             self.log.debug(err.msg)
             return
@@ -217,22 +206,86 @@ class VmMaster(Process):
         except Exception as error:
             self.log.exception("Error during spawn attempt: {}".format(error))
 
-    def start_spawn_if_required(self):
+    def get_build_counts(self):
+        """
+        :return: numbers of pending and recently submitted build tasks from frontend,
+            None if they are not available
+        """
+        try:
+            if self.frontend_client is None:
+                self.frontend_client = FrontendClient(self.opts, self.log)
+            return self.frontend_client.pending_build_counts(self.opts.spawn_planner_window)
+        except Exception as error:
+            self.log.exception("Failed to get pending build counts, spawning VMs one by one: {}"
+                               .format(error))
+            return None
+
+    def apply_spawn_plan(self, group, counts, snapshot=None):
+        """
+        Spawns as many VMs as the group needs for the queued builds at once,
+        terminates clean VMs which are not needed
+        """
+        group_opts = self.opts.build_groups[group]
+        active = (snapshot or self.vmm).get_vm_by_group_and_state_list(
+            group, [VmStates.GOT_IP, VmStates.READY, VmStates.IN_USE,
+                    VmStates.CHECK_HEALTH, VmStates.CHECK_HEALTH_FAILED])
+        ready = [vmd for vmd in active if vmd.state == VmStates.READY]
+        plan = plan_group(
+            group_opts, group_demand(group_opts, counts, self.opts.spawn_planner_lead_time),
+            ready=len(ready),
+            idle_clean=[vmd.vm_name for vmd in ready if getattr(vmd, "bound_to_user", None) is None],
+            starting=len([vmd for vmd in active if vmd.state in [VmStates.GOT_IP, VmStates.CHECK_HEALTH]]),
+            active=len(active),
+            spawning=self.spawner.get_proc_num_per_group(group))
+
+        for vm_name in plan.terminate:
+            self.log.info("Clean VM `{}` not needed, demand of group {}: {}, terminating it"
+                          .format(vm_name, group_opts["name"], plan.demand))
+            self.vmm.start_vm_termination(vm_name, allowed_pre_state=VmStates.READY)
+
+        if not plan.spawn:
+            return
+        try:
+            self._check_elapsed_time_after_spawn(group)
+            self._check_total_vm_limit(group, snapshot)
+        except VmSpawnLimitReached as err:
+            self.log.debug(err.msg)
+            return
+
+        self.log.info("Start spawning {} new VMs for group: {}, demand: {}"
+                      .format(plan.spawn, group_opts["name"], plan.demand))
+        self.vmm.write_vm_pool_info(group, "last_vm_spawn_start", time.time())
+        for _ in range(plan.spawn):
+            try:
+                self.spawner.start_spawn(group)
+            except Exception as error:
+                self.log.exception("Error during spawn attempt: {}".format(error))
+                break
+
+    def start_spawn_if_required(self, snapshot=None):
+        counts = self.get_build_counts() if self.opts.spawn_planner else None
         for group in self.vmm.vm_groups:
-            self.try_spawn_one(group)
+            if counts is None:
+                self.try_spawn_one(group, snapshot)
+            else:
+                self.apply_spawn_plan(group, counts, snapshot)
 
     def do_cycle(self):
         self.log.debug("starting do_cycle")
 
         # TODO: each check should be executed in threads ... and finish with join?
 
-        self.remove_old_dirty_vms()
-        self.check_vms_health()
-        self.start_spawn_if_required()
+        # load the whole VM pool once, checks below verify VM state
+        # again when they change it, so a slightly outdated view is fine
+        snapshot = self.vmm.get_snapshot()
 
-        self.remove_vm_with_dead_builder()
-        self.finalize_long_health_checks()
-        self.terminate_again()
+        self.remove_old_dirty_vms(snapshot)
+        self.check_vms_health(snapshot)
+        self.start_spawn_if_required(snapshot)
+
+        self.remove_vm_with_dead_builder(snapshot)
+        self.finalize_long_health_checks(snapshot)
+        self.terminate_again(snapshot)
 
         self.spawner.recycle()
 
@@ -262,21 +315,22 @@ class VmMaster(Process):
         if self.checker is not None:
             self.checker.terminate()
 
-    def finalize_long_health_checks(self):
+    def finalize_long_health_checks(self, snapshot=None):
         """
         After server crash it's possible that some VM's will remain in `check_health` state
         Here we are looking for such records and mark them with `check_health_failed` state
         """
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.CHECK_HEALTH]):
+        pool = snapshot or self.vmm
+        for vmd in pool.get_vm_by_group_and_state_list(None, [VmStates.CHECK_HEALTH]):
 
-            time_elapsed = time.time() - float(vmd.get_field(self.vmm.rc, "last_health_check") or 0)
+            time_elapsed = time.time() - float(getattr(vmd, "last_health_check", None) or 0)
             if time_elapsed > self.opts.build_groups[vmd.group]["vm_health_check_max_time"]:
                 self.log.info("VM marked with check fail state, "
                               "VM stayed too long in health check state, elapsed: {} VM: {}"
                               .format(time_elapsed, str(vmd)))
-                self.vmm.mark_vm_check_failed(vmd.vm_name)
+                self.vmm.mark_vm_check_failed(vmd.vm_name, vmd.group)
 
-    def terminate_again(self):
+    def terminate_again(self, snapshot=None):
         """
         If we failed to terminate instance request termination once more.
         Non-terminated instance detected as vm in the `terminating` state with
@@ -284,15 +338,19 @@ class VmMaster(Process):
         It's possible, that VM was terminated but termination process doesn't receive confirmation from VM provider,
         but we have already got a new VM with the same IP => it's safe to remove old vm from pool
         """
-
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.TERMINATING]):
-            time_elapsed = time.time() - float(vmd.get_field(self.vmm.rc, "terminating_since") or 0)
+        pool = snapshot or self.vmm
+        removed = set()
+        for vmd in pool.get_vm_by_group_and_state_list(None, [VmStates.TERMINATING]):
+            time_elapsed = time.time() - float(getattr(vmd, "terminating_since", None) or 0)
             if time_elapsed > self.opts.build_groups[vmd.group]["vm_terminating_timeout"]:
-                if len(self.vmm.lookup_vms_by_ip(vmd.vm_ip)) > 1:
+                same_ip_vms = [other for other in pool.lookup_vms_by_ip(vmd.vm_ip)
+                               if other.vm_name not in removed]
+                if len(same_ip_vms) > 1:
                     self.log.info(
                         "Removing VM record: {}. There are more VM with the same ip, "
                         "it's safe to remove current one from VM pool".format(vmd.vm_name))
                     self.vmm.remove_vm_from_pool(vmd.vm_name)
+                    removed.add(vmd.vm_name)
                 else:
                     self.log.info("Sent VM {} for termination again".format(vmd.vm_name))
                     self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.TERMINATING)
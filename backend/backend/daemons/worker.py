@@ -5,6 +5,7 @@ import time
 import gzip
 import shutil
 import multiprocessing
+import threading
 from setproctitle import setproctitle
 
 from ..exceptions import MockRemoteError, CoprWorkerError, VmError, NoVmAvailable
@@ -308,13 +309,33 @@ class Worker(multiprocessing.Process):
             title += str(suffix)
         setproctitle(title)
 
+    def keep_vm_lease(self, stop_event):
+        """
+        Renew lease of the VM until `stop_event` is set, without it VmMaster
+        considers the worker dead and terminates the VM
+        """
+        period = self.opts.vm_lease_seconds / 3.0
+        while not stop_event.wait(period):
+            try:
+                if not self.vm_manager.renew_lease(self.vm.vm_name):
+                    self.log.warning("Lease of VM {} expired, it is going to be terminated"
+                                     .format(self.vm.vm_name))
+            except Exception as error:
+                self.log.exception("Failed to renew lease of VM {}: {}".format(self.vm.vm_name, error))
+
     def run(self):
         self.log.info("Starting worker")
         self.init_fedmsg()
 
+        stop_event = threading.Event()
+        lease_keeper = threading.Thread(target=self.keep_vm_lease, args=(stop_event,))
+        lease_keeper.daemon = True
+        lease_keeper.start()
         try:
             self.do_job(self.job)
         except VmError as error:
             self.log.exception("Building error: {}".format(error))
         finally:
-            self.vm_manager.release_vm(self.vm.vm_name)
+            stop_event.set()
+            lease_keeper.join()
+            self.vm_manager.release_vm(self.vm.vm_name, self.vm.group)
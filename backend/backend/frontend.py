@@ -1,38 +1,109 @@
 import json
-from requests import post, RequestException
+import os
+import random
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import time
 
+from .constants import FRONTEND_UPDATES_REDIS_KEY
+from .helpers import get_redis_connection
+
 
 class FrontendClient(object):
     """
     Object to send data back to fronted
+
+    All requests go through a keep-alive session with a connection pool.
+    Session (and redis connection for batched updates) is created lazily
+    in each process, so the client could be passed to forked workers
+    without sharing sockets with the parent.
     """
 
     def __init__(self, opts, logger=None):
         super(FrontendClient, self).__init__()
+        self.opts = opts
         self.frontend_url = "{}/backend".format(opts.frontend_base_url)
         self.frontend_auth = opts.frontend_auth
 
+        self.pool_size = opts.frontend_pool_size
+        self.retries = opts.frontend_retries
+        self.timeout = opts.frontend_timeout
+        self.backoff_max = opts.frontend_backoff_max
+        self.update_batching = opts.frontend_update_batching
+
+        self._session = None
+        self._session_pid = None
+        self._redis = None
+        self._redis_pid = None
+
         self.msg = None
         self.log = logger
 
-    def _post_to_frontend(self, data, url_path):
+    @property
+    def session(self):
+        """
+        :rtype: requests.Session
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            session = Session()
+            # retry only failed connection attempts here, other errors are handled
+            # by _post_to_frontend_repeatedly since requests are not idempotent
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                  max_retries=Retry(total=self.retries, read=0, backoff_factor=0.5))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.auth = ("user", self.frontend_auth)
+
+            self._session = session
+            self._session_pid = os.getpid()
+        return self._session
+
+    @property
+    def redis(self):
+        """
+        :rtype: redis.StrictRedis
+        """
+        if self._redis is None or self._redis_pid != os.getpid():
+            self._redis = get_redis_connection(self.opts)
+            self._redis_pid = os.getpid()
+        return self._redis
+
+    def backoff_delay(self, attempt):
+        """
+        :return: jittered exponential delay (in seconds) before the next attempt
+        """
+        delay = min(self.backoff_max, 2 ** attempt)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def _get_from_frontend(self, url_path, params=None, timeout=None):
+        """
+        Make a GET request to the frontend
+        """
+        url = "{}/{}/".format(self.frontend_url, url_path)
+        response = self.session.get(url, params=params, timeout=timeout or self.timeout)
+        if response.status_code >= 400:
+            raise RequestException("Failed to get data from frontend: {0}: {1}".format(
+                response.status_code, response.text))
+        return response
+
+    def _post_to_frontend(self, data, url_path, timeout=None):
         """
         Make a request to the frontend
         """
 
         headers = {"content-type": "application/json"}
         url = "{}/{}/".format(self.frontend_url, url_path)
-        auth = ("user", self.frontend_auth)
 
         self.msg = None
 
         try:
-            response = post(url, data=json.dumps(data), auth=auth, headers=headers)
+            response = self.session.post(url, data=json.dumps(data), headers=headers,
+                                         timeout=timeout or self.timeout)
             if response.status_code >= 400:
                 self.msg = "Failed to submit to frontend: {0}: {1}".format(
                     response.status_code, response.text)
-                raise RequestException(self.msg)
+                raise RequestException(self.msg, response=response)
         except RequestException as e:
             self.msg = "Post request failed: {0}".format(e)
             raise
@@ -42,21 +113,91 @@ class FrontendClient(object):
         """
         Make a request max_repeats-time to the frontend
         """
+        error = None
         for i in range(max_repeats):
             try:
                 if i and self.log:
                     self.log.warning("failed to post data to frontend, repeat #{0}".format(i))
                 return self._post_to_frontend(data, url_path)
-            except RequestException:
-                time.sleep(5)
-        else:
-            raise RequestException("Failed to post to frontend for {} times".format(max_repeats))
+            except RequestException as err:
+                error = err
+                if i + 1 < max_repeats:
+                    time.sleep(self.backoff_delay(i))
+        # keep the last response, callers can tell a refused request from unreachable frontend
+        raise RequestException("Failed to post to frontend for {} times: {}".format(max_repeats, error),
+                               response=getattr(error, "response", None))
+
+    def waiting(self, wait=None, wait_for=None):
+        """
+        Ask frontend for the waiting tasks.
+
+        :param wait: when nothing is waiting, let frontend hold the request
+            for up to `wait` seconds until a new task appears
+        :param wait_for: list of task kinds ("build", "action") worth waiting for
+        :return: dict with the "build" and "action" keys
+        """
+        params = {}
+        if wait:
+            params["wait"] = wait
+        if wait_for:
+            params["wait_for"] = ",".join(wait_for)
+        return self._get_from_frontend("waiting", params=params or None,
+                                       timeout=self.timeout + (wait or 0)).json()
+
+    def waiting_actions(self, count, exclude=None, wait=None):
+        """
+        Ask frontend for up to `count` waiting actions, in the order they were created.
+
+        :param exclude: ids of actions which shouldn't be returned (e.g. already running)
+        :param wait: when there is no action, let frontend hold the request
+            for up to `wait` seconds until a new one appears
+        :return: list of dicts with action data
+        """
+        params = {"count": count}
+        if exclude:
+            params["exclude"] = ",".join(str(action_id) for action_id in exclude)
+        if wait:
+            params["wait"] = wait
+        return self._get_from_frontend("waiting_actions", params=params,
+                                       timeout=self.timeout + (wait or 0)).json()["actions"]
+
+    def pending_build_counts(self, window):
+        """
+        Ask frontend how many build tasks wait for a builder, per architecture.
+
+        :param window: also count tasks of builds submitted in last `window` seconds
+        :return: dict with "pending" and "arrived" dicts arch -> number of tasks
+        """
+        return self._get_from_frontend("pending_build_counts", params={"window": window}).json()
+
+    def get_project_settings(self, projects=None):
+        """
+        Get settings (auto_createrepo, persistent, ...) of many projects at once.
+
+        :param projects: list of project full names (owner/name), None for all projects
+        :return: dict mapping project full names to dicts with their settings
+        """
+        data = {} if projects is None else {"projects": list(projects)}
+        response = self._post_to_frontend_repeatedly(data, "project_settings")
+        return response.json()["projects"]
 
     def update(self, data):
         """
-        Send data to be updated in the frontend
+        Send data to be updated in the frontend.
+
+        When `frontend_update_batching` is enabled, data are only queued in redis
+        and UpdateFlusher sends them to the frontend together with other updates.
         """
-        self._post_to_frontend_repeatedly(data, "update")
+        if self.update_batching:
+            self.redis.rpush(FRONTEND_UPDATES_REDIS_KEY, json.dumps(data))
+        else:
+            self.post_update(data)
+
+    def post_update(self, data, max_repeats=10):
+        """
+        Send data to be updated in the frontend right away
+        """
+        self._post_to_frontend_repeatedly(data, "update", max_repeats)
 
     def starting_build(self, build_id, chroot_name):
         """
@@ -87,6 +228,21 @@ class FrontendClient(object):
             self.log.exception("Frontend refused to defer build task: build_id {} and chroot {}"
                                .format(build_id, chroot_name))
 
+    def lease_build_tasks(self, archs, count, lease_seconds, wait=None):
+        """
+        Take up to `count` build tasks for the given architectures from the frontend.
+        Frontend won't offer these tasks to anybody else for `lease_seconds`.
+        When there are no tasks, frontend holds the request for up to `wait` seconds.
+
+        :return: list of dicts with build task data
+        """
+        data = {"archs": archs, "count": count, "lease": lease_seconds}
+        if wait:
+            data["wait"] = wait
+        response = self._post_to_frontend(data, "lease_build_tasks",
+                                          timeout=self.timeout + (wait or 0))
+        return response.json()["builds"]
+
     def reschedule_build(self, build_id, chroot_name):
         """
         Announce to the frontend that a build should be rescheduled (set pending state).
@@ -26,7 +26,7 @@ from . import constants
 
 from copr.client import CoprClient
 from backend.constants import DEF_BUILD_USER, DEF_BUILD_TIMEOUT, DEF_CONSECUTIVE_FAILURE_THRESHOLD, \
-    CONSECUTIVE_FAILURE_REDIS_KEY, default_log_format
+    CONSECUTIVE_FAILURE_REDIS_KEY, DEF_DIST_GIT_CACHE_DIR, default_log_format
 from backend.exceptions import CoprBackendError
 
 
@@ -132,6 +132,30 @@ class BackendConfigReader(object):
         opts.frontend_auth = _get_conf(
             cp, "backend", "frontend_auth", "PASSWORDHERE")
 
+        opts.frontend_pool_size = _get_conf(
+            cp, "backend", "frontend_pool_size", 10, mode="int")
+
+        opts.frontend_retries = _get_conf(
+            cp, "backend", "frontend_retries", 3, mode="int")
+
+        opts.frontend_timeout = _get_conf(
+            cp, "backend", "frontend_timeout", 60, mode="int")
+
+        opts.frontend_backoff_max = _get_conf(
+            cp, "backend", "frontend_backoff_max", 30, mode="int")
+
+        opts.frontend_update_batching = _get_conf(
+            cp, "backend", "frontend_update_batching", False, mode="bool")
+
+        opts.frontend_update_flush_period = _get_conf(
+            cp, "backend", "frontend_update_flush_period", 0.3, mode="float")
+
+        opts.frontend_update_batch_size = _get_conf(
+            cp, "backend", "frontend_update_batch_size", 200, mode="int")
+
+        opts.frontend_update_max_failures = _get_conf(
+            cp, "backend", "frontend_update_max_failures", 3, mode="int")
+
         opts.redis_host = _get_conf(
             cp, "backend", "redis_host", "127.0.0.1")
 
@@ -144,6 +168,12 @@ class BackendConfigReader(object):
         opts.do_sign = _get_conf(
             cp, "backend", "do_sign", False, mode="bool")
 
+        opts.sign_workers = _get_conf(
+            cp, "backend", "sign_workers", 4, mode="int")
+
+        opts.sign_batch_size = _get_conf(
+            cp, "backend", "sign_batch_size", 1, mode="int")
+
         opts.keygen_host = _get_conf(
             cp, "backend", "keygen_host", "copr-keygen.cloud.fedoraproject.org")
 
@@ -202,6 +232,9 @@ class BackendConfigReader(object):
                 "vm_terminating_timeout": _get_conf(
                     cp, "backend", "group{}_vm_terminating_timeout".format(group_id),
                     default=600, mode="int"),
+                "vm_idle_reserve": _get_conf(
+                    cp, "backend", "group{}_vm_idle_reserve".format(group_id),
+                    default=2, mode="int"),
             }
             opts.build_groups.append(group)
 
@@ -211,6 +244,20 @@ class BackendConfigReader(object):
         opts.vm_ssh_check_timeout = _get_conf(
             cp, "backend", "vm_ssh_check_timeout",
             default=5, mode="int")
+        opts.vm_lease_seconds = _get_conf(
+            cp, "backend", "vm_lease_seconds",
+            default=120, mode="int")
+        opts.vm_health_check_batch_size = _get_conf(
+            cp, "backend", "vm_health_check_batch_size",
+            default=20, mode="int")
+        opts.spawn_planner = _get_conf(
+            cp, "backend", "spawn_planner", False, mode="bool")
+        opts.spawn_planner_window = _get_conf(
+            cp, "backend", "spawn_planner_window",
+            default=600, mode="int")
+        opts.spawn_planner_lead_time = _get_conf(
+            cp, "backend", "spawn_planner_lead_time",
+            default=300, mode="int")
 
         opts.destdir = _get_conf(cp, "backend", "destdir", None, mode="path")
 
@@ -220,11 +267,31 @@ class BackendConfigReader(object):
             cp, "backend", "fedmsg_enabled", False, mode="bool")
         opts.sleeptime = _get_conf(
             cp, "backend", "sleeptime", 10, mode="int")
+        opts.project_settings_ttl = _get_conf(
+            cp, "backend", "project_settings_ttl", 600, mode="int")
+        opts.createrepo_incremental = _get_conf(
+            cp, "backend", "createrepo_incremental", False, mode="bool")
+        opts.createrepo_debounce = _get_conf(
+            cp, "backend", "createrepo_debounce", 0, mode="float")
+        opts.createrepo_max_delay = _get_conf(
+            cp, "backend", "createrepo_max_delay", 10, mode="float")
+        opts.actions_max_workers = _get_conf(
+            cp, "backend", "actions_max_workers", 4, mode="int")
+        opts.actions_poll_period = _get_conf(
+            cp, "backend", "actions_poll_period", 1, mode="float")
+        opts.build_prefetch_count = _get_conf(
+            cp, "backend", "build_prefetch_count", 0, mode="int")
+        opts.build_lease_seconds = _get_conf(
+            cp, "backend", "build_lease_seconds", 300, mode="int")
+        opts.incremental_rsync_period = _get_conf(
+            cp, "backend", "incremental_rsync_period", 0, mode="int")
         opts.timeout = _get_conf(
             cp, "builder", "timeout", DEF_BUILD_TIMEOUT, mode="int")
         opts.consecutive_failure_threshold = _get_conf(
             cp, "builder", "consecutive_failure_threshold",
             DEF_CONSECUTIVE_FAILURE_THRESHOLD, mode="int")
+        opts.dist_git_cache_dir = _get_conf(
+            cp, "builder", "dist_git_cache_dir", DEF_DIST_GIT_CACHE_DIR)
         opts.log_dir = _get_conf(
             cp, "backend", "log_dir", "/var/log/copr-backend/")
         opts.log_level = _get_conf(
@@ -233,12 +300,25 @@ class BackendConfigReader(object):
             cp, "backend", "verbose", False, mode="bool")
 
         opts.prune_days = _get_conf(cp, "backend", "prune_days", None, mode="int")
+        opts.prune_workers = _get_conf(
+            cp, "backend", "prune_workers", 4, mode="int")
+        opts.prune_createrepo_workers = _get_conf(
+            cp, "backend", "prune_createrepo_workers", 2, mode="int")
+        opts.prune_checkpoint_file = _get_conf(
+            cp, "backend", "prune_checkpoint_file",
+            "/var/lib/copr/prune_results.checkpoint", mode="path")
 
         # ssh options
         opts.ssh = Munch()
         # TODO: ansible Runner show some magic bugs with transport "ssh", using paramiko
         opts.ssh.transport = _get_conf(
             cp, "ssh", "transport", "paramiko")
+        opts.ssh.multiplex = _get_conf(
+            cp, "ssh", "multiplex", False, mode="bool")
+        opts.ssh.control_dir = _get_conf(
+            cp, "ssh", "control_dir", "/var/run/copr-backend/ssh", mode="path")
+        opts.ssh.control_persist = _get_conf(
+            cp, "ssh", "control_persist", 60, mode="int")
 
         # thoughts for later
         # ssh key for connecting to builders?
@@ -385,6 +465,16 @@ def utc_now():
     return u
 
 
+def sleep_for(period, since):
+    """
+    Sleep for the rest of `period` seconds counted from the `since` timestamp,
+    e.g. when a long-polling request already took part of the polling period.
+    """
+    remaining = period - (time.time() - since)
+    if remaining > 0:
+        time.sleep(remaining)
+
+
 def silent_remove(filename):
     try:
         os.remove(filename)
@@ -39,7 +39,7 @@ import os
 from munch import Munch
 import time
 
-from ..constants import DEF_REMOTE_BASEDIR, DEF_BUILD_TIMEOUT, DEF_REPOS, \
+from ..constants import DEF_REMOTE_BASEDIR, DEF_DIST_GIT_CACHE_DIR, DEF_BUILD_TIMEOUT, DEF_REPOS, \
     DEF_BUILD_USER, DEF_MACROS
 from ..exceptions import MockRemoteError, BuilderError, CreateRepoError
 
@@ -110,6 +110,7 @@ class MockRemote(object):
             :ivar results_baseurl: base url for the built results
             :ivar remote_basedir: basedir on builder
             :ivar remote_tempdir: tempdir on builder
+            :ivar dist_git_cache_dir: dist-git clones and srpms cache on builder
 
         # Removed:
         # :param cont: if a pkg fails to build, continue to the next one--
@@ -123,7 +124,9 @@ class MockRemote(object):
             build_user=DEF_BUILD_USER,
             remote_basedir=DEF_REMOTE_BASEDIR,
             remote_tempdir=None,
+            dist_git_cache_dir=DEF_DIST_GIT_CACHE_DIR,
             timeout=DEF_BUILD_TIMEOUT,
+            incremental_rsync_period=0,
         )
         if opts:
             self.opts.update(opts)
@@ -236,6 +239,10 @@ class MockRemote(object):
                 base_url=base_url,
                 username=self.job.project_owner,
                 projectname=self.job.project_name,
+                pkgs=[self.job.target_dir_name] if self.opts.createrepo_incremental else None,
+                debounce=self.opts.createrepo_debounce,
+                max_delay=self.opts.createrepo_max_delay,
+                opts=self.opts,
             )
         except CreateRepoError:
             self.log.exception("Error making local repo: {}".format(self.chroot_dir))
@@ -305,6 +312,11 @@ class MockRemote(object):
         finally:
             self.builder.download_results(self.job.results_dir)
             self.builder.download_configs(os.path.join(self.job.results_dir, "configs"))
+            stats = self.builder.transfer_stats
+            self.log.info("Downloaded {} bytes of results in {:.1f}s, {} bytes in {:.1f}s "
+                          "after the build finished".format(
+                              stats["bytes"], stats["seconds"],
+                              stats["bytes_after_build"], stats["seconds_after_build"]))
             # self.add_log_symlinks()  # todo: add config option, need this for nginx
             self.log.info("End Build: {0}".format(self.job))
 
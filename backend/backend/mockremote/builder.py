@@ -1,12 +1,16 @@
 import os
+import re
+import json
+import base64
 import pipes
 import socket
-from subprocess import Popen
+from subprocess import Popen, PIPE
 import time
 from urlparse import urlparse
 
 from ansible.runner import Runner
 from backend.vm_manage import PUBSUB_INTERRUPT_BUILDER
+from backend.vm_manage.connection import configure_ansible, ssh_command, ssh_options
 from ..helpers import get_redis_connection, ensure_dir_exists
 
 from ..exceptions import BuilderError, BuilderTimeOutError, AnsibleCallError, AnsibleResponseError, VmError
@@ -16,6 +20,9 @@ from ..constants import mockchain, rsync, DEF_BUILD_TIMEOUT
 import modulemd
 
 
+PREPARE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prepare_build.py")
+
+
 class Builder(object):
 
     def __init__(self, opts, hostname, job, logger):
@@ -34,6 +41,16 @@ class Builder(object):
         self.remote_pkg_path = None
         self.remote_pkg_name = None
 
+        # downloaded results, in total and in the rsync runs after the build finished
+        self.transfer_stats = {
+            "bytes": 0,
+            "seconds": 0.0,
+            "bytes_after_build": 0,
+            "seconds_after_build": 0.0,
+        }
+
+        configure_ansible(self.opts, self.log)
+
         # if we're at this point we've connected and done stuff on the host
         self.conn = self._create_ans_conn()
         self.root_conn = self._create_ans_conn(username="root")
@@ -148,21 +165,13 @@ class Builder(object):
     def _get_remote_config_dir(self):
         return os.path.normpath(os.path.join(self.remote_build_dir, "configs", self.job.chroot))
 
-    def setup_mock_chroot_config(self):
+    def mock_config_edits(self):
         """
-        Setup mock config for current chroot.
+        Changes of the chroot mock config needed for this job, in the form
+        of ansible lineinfile module arguments.
 
         Packages in buildroot_pkgs are added to minimal buildroot.
         """
-        cfg_path = self.get_chroot_config_path(self.job.chroot)
-
-        try:
-            copy_cmd = "cp /etc/mock/{chroot}.cfg {dest}".format(chroot=self.job.chroot, dest=cfg_path)
-            self.run_ansible_with_check(copy_cmd, module_name="shell")
-        except BuilderError as err:
-            self.log.exception(err)
-            raise err
-
         if ("'{0} '".format(self.buildroot_pkgs) !=
                 pipes.quote(str(self.buildroot_pkgs) + ' ')):
 
@@ -170,53 +179,30 @@ class Builder(object):
             # allowed in packages name
             raise BuilderError("Do not try this kind of attack on me")
 
-        self.log.info("putting {0} into minimal buildroot of {1}"
-                      .format(self.buildroot_pkgs, self.job.chroot))
-
-        kwargs = {
-            "cfg_path": cfg_path,
-            "chroot": self.job.chroot,
-            "pkgs": self.buildroot_pkgs,
-            "net_enabled": "True" if self.job.enable_net else "False",
-        }
-        buildroot_cmd = (
-            "dest={cfg_path}"
-            " line=\"config_opts['chroot_setup_cmd'] = 'install \\1 {pkgs}'\""
-            " regexp=\"^.*chroot_setup_cmd.*(@buildsys-build|buildsys-build buildsys-macros).*$\""
-            " backrefs=yes"
-        )
-        buildroot_custom_cmd = (
-            "dest={cfg_path}"
-            " line=\"config_opts['chroot_setup_cmd'] = 'install {pkgs}'\""
-            " regexp=\"config_opts\\['chroot_setup_cmd'\\] = ''$\""
-        )
-        set_networking_cmd = (
-            "dest={cfg_path}"
-            " line=\"config_opts['use_host_resolv'] = {net_enabled}\""
-            " regexp=\"^.*use_host_resolv.*$\""
-        )
-
-        try:
-            self.run_ansible_with_check(set_networking_cmd.format(**kwargs),
-                                        module_name="lineinfile")
-            if self.buildroot_pkgs:
-                self.run_ansible_with_check(buildroot_cmd.format(**kwargs),
-                                            module_name="lineinfile")
-                self.run_ansible_with_check(buildroot_custom_cmd.format(**kwargs),
-                                            module_name="lineinfile")
-
-            if self.module_dist_tag:
-                set_dist_tag_cmd = (
-                    "dest={cfg_path}"
-                    " line=\"config_opts['macros']['%dist'] = '{dist_tag}'\""
-                    " regexp=\"^.*config_opts['macros']['%dist'].*$\""
-                )
-                self.run_ansible_with_check(set_dist_tag_cmd.format(
-                    cfg_path=cfg_path, dist_tag=self.module_dist_tag), module_name="lineinfile")
-
-        except Exception as err:
-            self.log.exception(err)
-            raise
+        edits = [{
+            "line": "config_opts['use_host_resolv'] = {}".format(
+                "True" if self.job.enable_net else "False"),
+            "regexp": "^.*use_host_resolv.*$",
+        }]
+
+        if self.buildroot_pkgs:
+            edits.append({
+                "line": "config_opts['chroot_setup_cmd'] = 'install \\1 {}'".format(self.buildroot_pkgs),
+                "regexp": "^.*chroot_setup_cmd.*(@buildsys-build|buildsys-build buildsys-macros).*$",
+                "backrefs": True,
+            })
+            edits.append({
+                "line": "config_opts['chroot_setup_cmd'] = 'install {}'".format(self.buildroot_pkgs),
+                "regexp": "config_opts\\['chroot_setup_cmd'\\] = ''$",
+            })
+
+        if self.module_dist_tag:
+            edits.append({
+                "line": "config_opts['macros']['%dist'] = '{}'".format(self.module_dist_tag),
+                "regexp": "^.*config_opts['macros']['%dist'].*$",
+            })
+
+        return edits
 
     def collect_built_packages(self):
         self.log.info("Listing built binary packages")
@@ -236,35 +222,77 @@ class Builder(object):
         ansible_test_results = self._run_ansible("/usr/bin/test -f {0}".format(successfile))
         check_for_ans_error(ansible_test_results, self.hostname)
 
-    def download_job_pkg_to_builder(self):
-        repo_url = "{}/{}.git".format(self.opts.dist_git_url, self.job.git_repo)
-        self.log.info("Cloning Dist Git repo {}, branch {}, hash {}".format(
+    def dist_git_params(self):
+        """
+        :return: what PREPARE_SCRIPT needs to make (or find in its cache) the srpm
+        """
+        return {
+            "repo_url": "{}/{}.git".format(self.opts.dist_git_url, self.job.git_repo),
+            "pkg_name": self.job.package_name,
+            "git_hash": self.job.git_hash,
+            "branch": self.job.git_branch,
+            "cache_dir": self.opts.dist_git_cache_dir,
+        }
+
+    def prepare_build(self):
+        """
+        Check the builder, create tempdir, set up the mock config and get the srpm
+        from dist-git, all in one ansible call of PREPARE_SCRIPT on the builder.
+
+        :return: dict with results of the script, "phases" are durations
+            of its parts in seconds
+        :raises BuilderError: the builder can't be used or the srpm was not obtained
+        """
+        params = {
+            "mockchain": mockchain,
+            "chroot": self.job.chroot,
+            "tempdir": self._remote_tempdir,
+            "basedir": self._remote_basedir,
+            "config_edits": self.mock_config_edits(),
+            "dist_git": self.dist_git_params(),
+        }
+        self.log.info("Preparing build, cloning Dist Git repo {}, branch {}, hash {}".format(
             self.job.git_repo, self.job.git_branch, self.job.git_hash))
-        results = self._run_ansible(
-            "rm -rf /tmp/build_package_repo && "
-            "mkdir /tmp/build_package_repo && "
-            "cd /tmp/build_package_repo && "
-            "git clone {repo_url} && "
-            "cd {pkg_name} && "
-            "git checkout {git_hash} && "
-            "fedpkg-copr --dist {branch} srpm"
-            .format(repo_url=repo_url,
-                    pkg_name=self.job.package_name,
-                    git_hash=self.job.git_hash,
-                    branch=self.job.git_branch))
-
-        # expected output:
-        # ...
-        # Wrote: /tmp/.../copr-ping/copr-ping-1-1.fc21.src.rpm
 
+        started = time.time()
+        results = self.run_ansible_with_check(
+            "{} {}".format(PREPARE_SCRIPT, base64.b64encode(json.dumps(params).encode("utf-8"))),
+            module_name="script")
         try:
-            self.remote_pkg_path = list(results["contacted"].values())[0][u"stdout"].split("Wrote: ")[1]
-            self.remote_pkg_name = os.path.basename(self.remote_pkg_path).replace(".src.rpm", "")
-        except Exception:
-            self.log.exception("Failed to obtain srpm from dist-git")
-            raise BuilderError("Failed to obtain srpm from dist-git: ansible results {}".format(results))
-
-        self.log.info("Got srpm to build: {}".format(self.remote_pkg_path))
+            prepared = json.loads(get_ans_results(results, self.hostname)["stdout"])
+        except (KeyError, ValueError) as error:
+            raise BuilderError("Failed to prepare build, unexpected output: {}: {}"
+                               .format(error, results))
+        prepared["phases"]["total"] = time.time() - started
+
+        error = prepared.get("error")
+        if error == "missing_packages":
+            raise BuilderError(msg="Build host `{0}` does not have mock or rsync installed"
+                               .format(self.hostname))
+        elif error == "missing_mockchain":
+            raise BuilderError(msg="Build host `{}` missing mockchain binary `{}`"
+                               .format(self.hostname, mockchain))
+        elif error == "missing_config":
+            raise BuilderError(msg="Build host `{}` missing mock config for chroot `{}`"
+                               .format(self.hostname, self.job.chroot))
+        elif error:
+            raise BuilderError("Failed to obtain srpm from dist-git: {}: {}"
+                               .format(error, prepared.get("output")))
+
+        self.tempdir = prepared["tempdir"]
+        self.remote_pkg_path = prepared["srpm_path"]
+        self.remote_pkg_name = os.path.basename(self.remote_pkg_path).replace(".src.rpm", "")
+
+        cache = prepared.get("cache", {})
+        self.log.info("Got srpm to build: {} ({})".format(
+            self.remote_pkg_path,
+            "cached srpm" if cache.get("srpm") else
+            "made in cached clone" if cache.get("clone") else "made in new clone"))
+        self.log.info("Build prepared in {:.1f}s ({})".format(
+            prepared["phases"]["total"],
+            ", ".join("{} {:.1f}s".format(name, prepared["phases"][name])
+                      for name in ["check", "config", "srpm"])))
+        return prepared
 
     def pre_process_repo_url(self, repo_url):
         """
@@ -304,29 +332,107 @@ class Builder(object):
         buildcmd += self.remote_pkg_path
         return buildcmd
 
+    @property
+    def build_status_path(self):
+        return os.path.join(self.tempdir, "build.status")
+
+    def wrap_build_command(self, buildcmd):
+        """
+        Make the build command leave its exit status in `build_status_path`
+        """
+        status_path = pipes.quote(self.build_status_path)
+        return "rm -f {status}; {cmd}; rc=$?; echo $rc > {status}; exit $rc".format(
+            cmd=buildcmd, status=status_path)
+
+    def start_wait_session(self):
+        """
+        Open ssh session which returns once the build command exits, the waiting
+        itself happens on the builder so it costs no round trips
+        """
+        wait_cmd = "while [ ! -s {0} ]; do sleep 1; done; cat {0}".format(
+            pipes.quote(self.build_status_path))
+        cmd = (["ssh"] + ssh_options(self.opts) +
+               ["-o", "ServerAliveInterval=30",
+                "{}@{}".format(self.opts.build_user, self.hostname), wait_cmd])
+        try:
+            return Popen(cmd, stdout=PIPE, stderr=PIPE)
+        except OSError as error:
+            self.log.warning("Failed to start ssh waiting for the build: {}".format(error))
+            return None
+
+    def cancel_build(self):
+        """
+        Kill the build running on the builder, failure is only logged
+        """
+        try:
+            self._run_ansible("/usr/bin/pkill -TERM -f '{}|/usr/libexec/mock/mock|/usr/sbin/mock'"
+                              .format(mockchain), as_root=True)
+        except Exception as error:
+            self.log.exception("Failed to kill the build on {}: {}".format(self.hostname, error))
+
     def run_build_and_wait(self, buildcmd):
+        """
+        Run the build command and wait until it ends. The end is signalled by an ssh
+        session started along with the build, ansible is asked for results only then.
+        If the session breaks, ansible is polled every 10 seconds.
+
+        The build is killed on a message in PUBSUB_INTERRUPT_BUILDER channel of this builder.
+
+        :raises BuilderTimeOutError: the build did not end in time
+        :raises VmError: the build was interrupted
+        """
         self.log.info("executing: {0}".format(buildcmd))
+        self.setup_pubsub_handler()
         self.conn.module_name = "shell"
-        self.conn.module_args = buildcmd
+        self.conn.module_args = self.wrap_build_command(buildcmd)
         _, poller = self.conn.run_async(self.timeout)
+        wait_session = self.start_wait_session()
+        build_ended = False
         waited = 0
+        since_sync = 0
         results = None
 
-        # self.setup_pubsub_handler()
-        while True:
-            # TODO rework Builder and extrace check_pubsub, add method to interrupt build process from dispatcher
-            # self.check_pubsub()
-            results = poller.poll()
-
-            if results["contacted"] or results["dark"]:
-                break
+        try:
+            while True:
+                self.check_pubsub()
+
+                if wait_session and wait_session.poll() is not None:
+                    _, err = wait_session.communicate()
+                    build_ended = wait_session.returncode == 0
+                    if not build_ended:
+                        self.log.warning("Lost ssh session waiting for the build, polling instead: {}"
+                                         .format(err))
+                    wait_session = None
+
+                if not wait_session:
+                    results = poller.poll()
+                    if results["contacted"] or results["dark"]:
+                        break
+
+                if waited >= self.timeout:
+                    raise BuilderTimeOutError("Build timeout expired. Time limit: {}s, time spent: {}s"
+                                              .format(self.timeout, waited))
+
+                if self.opts.incremental_rsync_period and \
+                        since_sync >= self.opts.incremental_rsync_period:
+                    self.download_results_during_build(self.job.results_dir)
+                    since_sync = 0
+
+                # only local checks while the ssh session waits
+                interval = 1 if wait_session or build_ended else 10
+                time.sleep(interval)
+                waited += interval
+                since_sync += interval
+
+        except VmError:
+            self.cancel_build()
+            raise
 
-            if waited >= self.timeout:
-                raise BuilderTimeOutError("Build timeout expired. Time limit: {}s, time spent: {}s"
-                                          .format(self.timeout, waited))
+        finally:
+            if wait_session and wait_session.poll() is None:
+                wait_session.kill()
+            self.ps.close()
 
-            time.sleep(10)
-            waited += 10
         return results
 
     def setup_pubsub_handler(self):
@@ -363,10 +469,8 @@ class Builder(object):
     #
 
     def build(self):
-        self.setup_mock_chroot_config()
-
-        # download the package to the builder
-        self.download_job_pkg_to_builder()
+        # check the builder, set up mock config and download the package to the builder
+        self.prepare_build()
 
         # construct the mockchain command
         buildcmd = self.gen_mockchain_command()
@@ -379,19 +483,23 @@ class Builder(object):
         self.check_build_success()
         return get_ans_results(ansible_build_results, self.hostname).get("stdout", "")
 
-    def rsync_call(self, source_path, target_path):
+    def rsync_call(self, source_path, target_path, during_build=False):
         ensure_dir_exists(target_path, self.log)
+        log_filepath = os.path.join(target_path, self.job.rsync_log_name)
+        log_offset = os.path.getsize(log_filepath) if os.path.exists(log_filepath) else 0
 
         # make spaces work w/our rsync command below :(
-        target_path = "'" + target_path.replace("'", "'\\''") + "'"
+        quoted_target_path = "'" + target_path.replace("'", "'\\''") + "'"
 
-        ssh_opts = "'ssh -o PasswordAuthentication=no -o StrictHostKeyChecking=no'"
+        ssh_opts = pipes.quote(ssh_command(self.opts))
         full_source_path = "{}@{}:{}/*".format(self.opts.build_user,
                                                self.hostname,
                                                source_path)
-        log_filepath = os.path.join(target_path, self.job.rsync_log_name)
-        command = "{} -rlptDvH -e {} {} {}/ &> {}".format(
-            rsync, ssh_opts, full_source_path, target_path, log_filepath)
+        # the log is appended, results may be downloaded more times during one build
+        command = "{} -rlptDvH --stats -e {} {} {}/ >> {} 2>&1".format(
+            rsync, ssh_opts, full_source_path, quoted_target_path,
+            os.path.join(quoted_target_path, self.job.rsync_log_name))
+        started = time.time()
 
         # dirty magic with Popen due to IO buffering
         # see http://thraxil.org/users/anders/posts/2008/03/13/Subprocess-Hanging-PIPE-is-your-enemy/
@@ -406,11 +514,48 @@ class Builder(object):
             self.log.error(err_msg)
             raise BuilderError(err_msg)
 
+        self.record_transfer(log_filepath, log_offset, time.time() - started, during_build)
+
         if cmd.returncode != 0:
             err_msg = "Failed to download data from builder due to rsync error, see the rsync log file for details."
-            self.log.error(err_msg)
+            if not during_build:
+                self.log.error(err_msg)
             raise BuilderError(err_msg, return_code=cmd.returncode)
 
+    def record_transfer(self, log_filepath, log_offset, seconds, during_build):
+        """
+        Add size of the rsync transfer, as reported by `rsync --stats` in its log
+        since `log_offset`, and its duration to `transfer_stats`
+        """
+        received = 0
+        try:
+            with open(log_filepath) as log_file:
+                log_file.seek(log_offset)
+                match = re.search(r"Total bytes received: ([\d,]+)", log_file.read())
+            if match:
+                received = int(match.group(1).replace(",", ""))
+        except IOError as error:
+            self.log.warning("Failed to read rsync stats from {}: {}".format(log_filepath, error))
+
+        self.transfer_stats["bytes"] += received
+        self.transfer_stats["seconds"] += seconds
+        if not during_build:
+            self.transfer_stats["bytes_after_build"] += received
+            self.transfer_stats["seconds_after_build"] += seconds
+
+    def download_results_during_build(self, target_path):
+        """
+        Download logs and packages the running build produced so far, so that
+        only the rest has to be downloaded after the build finishes.
+        Failure is not fatal, e.g. the results dir need not exist yet.
+        """
+        if not self._get_remote_results_dir():
+            return
+        try:
+            self.rsync_call(self._get_remote_results_dir(), target_path, during_build=True)
+        except BuilderError as error:
+            self.log.info("Results not downloaded during build: {}".format(error))
+
     def download_results(self, target_path):
         if self._get_remote_results_dir():
             self.rsync_call(self._get_remote_results_dir(), target_path)
@@ -419,34 +564,16 @@ class Builder(object):
         self.rsync_call(self._get_remote_config_dir(), target_path)
 
     def check(self):
-        # do check of host
+        """
+        Remote checks of the builder (mock, rsync, mockchain and chroot config
+        present) are done as part of `prepare_build`
+        """
         try:
             # requires name resolve facility
             socket.gethostbyname(self.hostname)
         except IOError:
             raise BuilderError("{0} could not be resolved".format(self.hostname))
 
-        try:
-            # check_for_ans_error(res, self.hostname)
-            self.run_ansible_with_check("/bin/rpm -q mock rsync")
-        except AnsibleCallError:
-            raise BuilderError(msg="Build host `{0}` does not have mock or rsync installed"
-                               .format(self.hostname))
-
-        # test for path existence for mockchain and chroot config for this chroot
-        try:
-            self.run_ansible_with_check("/usr/bin/test -f {0}".format(mockchain))
-        except AnsibleCallError:
-            raise BuilderError(msg="Build host `{}` missing mockchain binary `{}`"
-                               .format(self.hostname, mockchain))
-
-        try:
-            self.run_ansible_with_check("/usr/bin/test -f /etc/mock/{}.cfg"
-                                        .format(self.job.chroot))
-        except AnsibleCallError:
-            raise BuilderError(msg="Build host `{}` missing mock config for chroot `{}`"
-                               .format(self.hostname, self.job.chroot))
-
 
 def get_ans_results(results, hostname):
     if hostname in results["dark"]:
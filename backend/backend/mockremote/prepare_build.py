@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+"""
+Prepares builder for one build, executed on the builder by
+Builder.prepare_build() through ansible "script" module.
+
+Does in one go what used to be a separate ansible call each: checks required
+packages, mockchain and mock config, creates tempdir, copies and edits the mock
+config and makes the srpm from dist-git. Dist-git clones are kept in a cache
+keyed by the repo url and only fetched by the following builds, srpms are
+cached by git hash and branch, so a VM building the same package for more
+chroots makes its srpm only once. Gets its parameters as base64 encoded
+json in the first argument and prints json with the results, including how long
+each phase took. Builders run it with python 3 (like mock itself), backend
+tests import it under python 2 as well.
+"""
+
+from __future__ import print_function
+
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+def run(cmd):
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode, output.decode("utf-8", "replace")
+
+
+def lineinfile(path, regexp, line, backrefs=False):
+    """
+    Same as ansible lineinfile module with state=present: the last line matching
+    `regexp` is replaced, without a match `line` is appended unless `backrefs` is used
+    """
+    with open(path) as f:
+        lines = f.read().splitlines()
+
+    pattern = re.compile(regexp)
+    matches = [(index, pattern.search(text)) for index, text in enumerate(lines)]
+    matches = [(index, match) for index, match in matches if match]
+    if matches:
+        index, match = matches[-1]
+        lines[index] = match.expand(line) if backrefs else line
+    elif backrefs or line in lines:
+        return
+    else:
+        lines.append(line)
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def cached_srpm(srpm_dir):
+    if not os.path.isdir(srpm_dir):
+        return None
+    srpms = [name for name in os.listdir(srpm_dir) if name.endswith(".src.rpm")]
+    if len(srpms) != 1:
+        return None
+    return os.path.join(srpm_dir, srpms[0])
+
+
+def make_srpm(dist_git, result):
+    """
+    Updates the cached clone (or clones the repo) and makes srpm in it
+
+    :return: path to the srpm or None
+    """
+    repo_dir = os.path.join(
+        dist_git["cache_dir"], "repos",
+        hashlib.sha1(dist_git["repo_url"].encode("utf-8")).hexdigest(), dist_git["pkg_name"])
+    build_srpm = "cd {0} && git checkout -f {1} && git clean -ffdx && fedpkg-copr --dist {2} srpm".format(
+        quote(repo_dir), quote(dist_git["git_hash"]), quote(dist_git["branch"]))
+
+    result["cache"]["clone"] = os.path.isdir(os.path.join(repo_dir, ".git"))
+    if result["cache"]["clone"]:
+        returncode, output = run("cd {0} && git fetch origin && {1}".format(quote(repo_dir), build_srpm))
+        if returncode == 0 and "Wrote: " in output:
+            result["output"] = output
+            return output.split("Wrote: ")[1].strip()
+        # broken clone or rewritten history, start over
+        result["cache"]["clone"] = False
+
+    shutil.rmtree(repo_dir, ignore_errors=True)
+    returncode, output = run("git clone {0} {1} && {2}".format(
+        quote(dist_git["repo_url"]), quote(repo_dir), build_srpm))
+    result["output"] = output
+    if returncode != 0 or "Wrote: " not in output:
+        return None
+    return output.split("Wrote: ")[1].strip()
+
+
+def get_srpm(dist_git, result):
+    """
+    :return: path to the srpm for git hash and branch given in `dist_git`, from
+        the cache if it was made before, None if it could not be made
+    """
+    srpm_dir = os.path.join(dist_git["cache_dir"], "srpms", "{0}-{1}".format(
+        dist_git["git_hash"], dist_git["branch"].replace("/", "_")))
+    result["cache"] = {"srpm": False, "clone": False}
+
+    srpm_path = cached_srpm(srpm_dir)
+    if srpm_path:
+        result["cache"]["srpm"] = True
+        return srpm_path
+
+    built_path = make_srpm(dist_git, result)
+    if not built_path:
+        return None
+
+    # the srpm appears in the cache at once, or not at all
+    partial_dir = srpm_dir + ".partial"
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
+    shutil.copy(built_path, partial_dir)
+    shutil.rmtree(srpm_dir, ignore_errors=True)
+    os.rename(partial_dir, srpm_dir)
+    return os.path.join(srpm_dir, os.path.basename(built_path))
+
+
+def prepare(params, result):
+    phase_start = time.time()
+
+    def phase_done(name):
+        result["phases"][name] = time.time() - phase_start
+
+    if run("/bin/rpm -q mock rsync")[0] != 0:
+        return "missing_packages"
+    if not os.path.isfile(params["mockchain"]):
+        return "missing_mockchain"
+    chroot_cfg = "/etc/mock/{0}.cfg".format(params["chroot"])
+    if not os.path.isfile(chroot_cfg):
+        return "missing_config"
+    phase_done("check")
+
+    phase_start = time.time()
+    tempdir = params["tempdir"]
+    if not tempdir:
+        tempdir = tempfile.mkdtemp(prefix="mockremote-", dir=params["basedir"])
+        os.chmod(tempdir, 0o755)
+    result["tempdir"] = tempdir
+
+    cfg_path = os.path.join(tempdir, "{0}.cfg".format(params["chroot"]))
+    shutil.copy(chroot_cfg, cfg_path)
+    for edit in params["config_edits"]:
+        lineinfile(cfg_path, **edit)
+    phase_done("config")
+
+    phase_start = time.time()
+    srpm_path = get_srpm(params["dist_git"], result)
+    if not srpm_path:
+        return "srpm_failed"
+    result["srpm_path"] = srpm_path
+    phase_done("srpm")
+
+
+def main():
+    params = json.loads(base64.b64decode(sys.argv[1]).decode("utf-8"))
+    result = {"phases": {}}
+    try:
+        result["error"] = prepare(params, result)
+    except Exception as error:
+        result["error"] = "exception"
+        result["output"] = "{0}: {1}".format(type(error).__name__, error)
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
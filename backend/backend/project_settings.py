@@ -0,0 +1,77 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import json
+
+from copr.exceptions import CoprRequestException
+
+from .frontend import FrontendClient
+from .helpers import get_redis_connection
+
+
+class ProjectSettings(object):
+    """
+    Project settings backend needs (auto_createrepo, persistent), fetched
+    from frontend and cached in redis for `project_settings_ttl` seconds,
+    so all backend processes share them.
+
+    Actions changing the settings drop the cached values with `invalidate()`.
+    Changes made in frontend without an action are seen once the cached
+    values expire.
+    """
+
+    KEY = "copr:backend:project_settings:str::{}"
+
+    def __init__(self, opts, frontend_client=None, log=None):
+        self.opts = opts
+        self.rc = get_redis_connection(self.opts)
+        self.frontend_client = frontend_client or FrontendClient(self.opts, log)
+
+    @staticmethod
+    def full_name(owner, project):
+        return "{}/{}".format(owner, project)
+
+    def get(self, owner, project):
+        """
+        :return: dict with the project settings
+        :raises CoprRequestException: when the project doesn't exist
+        """
+        full_name = self.full_name(owner, project)
+        cached = self.rc.get(self.KEY.format(full_name))
+        if cached:
+            return json.loads(cached)
+
+        settings = self.prefetch([full_name])
+        if full_name not in settings:
+            # same message as the API gives, callers look for it
+            raise CoprRequestException("Project {} does not exists".format(full_name))
+        return settings[full_name]
+
+    def prefetch(self, projects=None):
+        """
+        Load settings of many projects with a single request to frontend.
+
+        :param projects: list of project full names, None for all projects
+        :return: dict mapping project full names to their settings
+        """
+        settings = self.frontend_client.get_project_settings(projects)
+
+        pipe = self.rc.pipeline()
+        for full_name, project_settings in settings.items():
+            pipe.setex(self.KEY.format(full_name), self.opts.project_settings_ttl,
+                       json.dumps(project_settings))
+        pipe.execute()
+        return settings
+
+    def invalidate(self, owner, project):
+        self.rc.delete(self.KEY.format(self.full_name(owner, project)))
+
+    def get_auto_createrepo_status(self, owner, project):
+        return bool(self.get(owner, project).get("auto_createrepo", True))
+
+    def get_persistent_status(self, owner, project):
+        return bool(self.get(owner, project).get("persistent", True))
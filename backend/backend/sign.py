@@ -6,13 +6,17 @@ Wrapper for /bin/sign from obs-sign package
 """
 
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 import json
 
 import os
+from redis.exceptions import RedisError
 from requests import request
 
+from .constants import KNOWN_SIGN_KEYS_REDIS_KEY
 from .exceptions import CoprSignError, CoprSignNoKeyError, \
     CoprKeygenRequestError
+from .helpers import get_redis_connection
 
 
 SIGN_BINARY = "/bin/sign"
@@ -66,6 +70,33 @@ def get_pubkey(username, projectname, outfile=None):
     return stdout
 
 
+def ensure_user_keys(username, projectname, opts):
+    """
+    Make sure the signer has keys for the project, generate them if not.
+
+    Keys are never removed from the signer keyring, so projects with keys are
+    remembered in redis and every build (signed in its own worker process)
+    doesn't have to ask again.
+    """
+    usermail = create_gpg_email(username, projectname)
+    rc = get_redis_connection(opts)
+    try:
+        if rc.sismember(KNOWN_SIGN_KEYS_REDIS_KEY, usermail):
+            return
+    except RedisError:
+        pass
+
+    try:
+        get_pubkey(username, projectname)
+    except CoprSignNoKeyError:
+        create_user_keys(username, projectname, opts)
+
+    try:
+        rc.sadd(KNOWN_SIGN_KEYS_REDIS_KEY, usermail)
+    except RedisError:
+        pass
+
+
 def _sign_one(path, email):
     cmd = ["sudo", SIGN_BINARY, "-u", email, "-r", path]
 
@@ -90,6 +121,55 @@ def _sign_one(path, email):
     return stdout, stderr
 
 
+def _sign_many(paths, email):
+    """
+    Sign several rpms by one sign invocation
+    """
+    cmd = ["sudo", SIGN_BINARY, "-u", email, "-r"] + list(paths)
+
+    try:
+        handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = handle.communicate()
+    except Exception as e:
+        raise CoprSignError(
+            msg="Failed to invoke sign {} by user {} with error {}"
+            .format(paths, email, e))
+
+    if handle.returncode != 0:
+        raise CoprSignError(
+            msg="Failed to sign {} by user {}".format(paths, email),
+            return_code=handle.returncode,
+            cmd=cmd, stdout=stdout, stderr=stderr)
+
+    return stdout, stderr
+
+
+def _sign_batch(paths, email, log):
+    """
+    :return: list of tuples (rpm_filepath, exception) for rpms which failed to sign
+    """
+    if len(paths) > 1:
+        try:
+            _sign_many(paths, email)
+            for rpm in paths:
+                log.info("signed rpm: {}".format(rpm))
+            return []
+        except CoprSignError:
+            # find out which rpms are wrong
+            log.warning("failed to sign rpms {} at once, signing them one by one".format(paths))
+
+    errors = []
+    for rpm in paths:
+        try:
+            _sign_one(rpm, email)
+            log.info("signed rpm: {}".format(rpm))
+
+        except CoprSignError as e:
+            log.exception("failed to sign rpm: {}".format(rpm))
+            errors.append((rpm, e))
+    return errors
+
+
 def sign_rpms_in_dir(username, projectname, path, opts, log):
     """
     Signs rpms using obs-signd.
@@ -97,6 +177,9 @@ def sign_rpms_in_dir(username, projectname, path, opts, log):
     If some some pkgs failed to sign, entire build marked as failed,
     but we continue to try sign other pkgs.
 
+    Up to `opts.sign_workers` sign invocations run concurrently, each of them
+    signs up to `opts.sign_batch_size` rpms.
+
     :param username: copr username
     :param projectname: copr projectname
     :param path: directory with rpms to be signed
@@ -115,21 +198,20 @@ def sign_rpms_in_dir(username, projectname, path, opts, log):
     if not rpm_list:
         return
 
-    try:
-        get_pubkey(username, projectname)
-    except CoprSignNoKeyError:
-        create_user_keys(username, projectname, opts)
+    ensure_user_keys(username, projectname, opts)
 
-    errors = []  # tuples (rpm_filepath, exception)
-    for rpm in rpm_list:
-        try:
-            _sign_one(rpm, create_gpg_email(username, projectname))
-            log.info("signed rpm: {}".format(rpm))
+    email = create_gpg_email(username, projectname)
+    batch_size = max(opts.sign_batch_size, 1)
+    batches = [rpm_list[i:i + batch_size] for i in range(0, len(rpm_list), batch_size)]
 
-        except CoprSignError as e:
-            log.exception("failed to sign rpm: {}".format(rpm))
-            errors.append((rpm, e))
+    pool = ThreadPool(max(min(opts.sign_workers, len(batches)), 1))
+    try:
+        results = pool.map(lambda batch: _sign_batch(batch, email, log), batches)
+    finally:
+        pool.close()
+        pool.join()
 
+    errors = [error for batch_errors in results for error in batch_errors]  # tuples (rpm_filepath, exception)
     if errors:
         raise CoprSignError("Rpm sign failed, affected rpms: {}"
                             .format([err[0] for err in errors]))
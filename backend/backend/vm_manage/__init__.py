@@ -9,6 +9,11 @@ class VmStates(object):
     IN_USE = "in_use"
     TERMINATING = "terminating"
 
+    @classmethod
+    def all_states(cls):
+        return [cls.GOT_IP, cls.CHECK_HEALTH, cls.CHECK_HEALTH_FAILED,
+                cls.READY, cls.IN_USE, cls.TERMINATING]
+
 # for IPC
 PUBSUB_MB = "copr:backend:vm:pubsub::"
 
@@ -19,6 +24,9 @@ class EventTopics(object):
     VM_TERMINATION_REQUEST = "vm_termination_request"
     VM_TERMINATED = "vm_terminated"
 
+# message - group of the VM, published when a VM is released
+PUBSUB_VM_RELEASED = "copr:backend:vm_released:pubsub::"
+
 # argument - vm_ip
 PUBSUB_INTERRUPT_BUILDER = "copr:backend:interrupt_build:pubsub::{}"
 
@@ -30,6 +38,23 @@ KEY_VM_POOL_INFO = "copr:backend:vm_pool_info:hset::{group}"
 # hset with additional information for `group`, used fields:
 # - "last_vm_spawn_start": latest time when VM spawn was initiated for this `group`
 
+KEY_VM_STATE_INDEX = "copr:backend:vm_state_index:set::{group}:{state}"
+# set of vm_names of vm in `group` with the given `state`,
+# kept in sync with VmDescriptor state by lua scripts (see models.set_vm_state_lua_snippet)
+
+KEY_VM_IN_USE_BY_USER = "copr:backend:vm_in_use_by_user:hset::{group}"
+# hset with number of VMs in `in_use` state for `group`, field: username -> count
+# maintained by acquire/release/terminate lua scripts in VmManager
+
+KEY_VM_AFFINITY_STATS = "copr:backend:vm_affinity_stats:hset::{group}"
+# hset with counters of VM acquisitions for `group` by affinity kind (see VmManager.affinity_kind),
+# fields: "acquired:<kind>", "builds:<kind>" and "build_seconds:<kind>",
+# maintained by acquire/release lua scripts in VmManager
+
+KEY_VM_LEASE = "copr:backend:vm_lease:string::{vm_name}"
+# string with expiration, exists while the VM is in use by a live worker, value: "host:pid"
+# of the lease owner; set on acquire, renewed by the worker, removed on release/termination
+
 KEY_SERVER_INFO = "copr:backend:server_info:hset::"
 # common shared info about server, not stritly related to VMM, maybe move it to helpers later
 # used fields:
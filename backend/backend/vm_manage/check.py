@@ -8,27 +8,89 @@ from ansible.runner import Runner
 
 from backend.helpers import get_redis_connection
 from backend.vm_manage import PUBSUB_MB, EventTopics
+from backend.vm_manage.connection import multiplexing_enabled, start_ssh
 from backend.vm_manage.executor import Executor
 
 from ..helpers import get_redis_logger
 
 
-def check_health(opts, vm_name, vm_ip):
+def check_health_batch(opts, vms):
     """
-    Test connectivity to the VM
+    Test connectivity to several VMs at once (VmMaster hands over at most
+    `opts.vm_health_check_batch_size` of them). Results are published
+    together, one HEALTH_CHECK message per VM.
 
-    :param vm_ip: ip address to the newly created VM
-    :raises: :py:class:`~backend.exceptions.CoprWorkerSpawnFailError`: validation fails
+    :param vms: list of (vm_name, vm_ip)
     """
     # setproctitle("check VM: {}".format(vm_ip))
 
     log = get_redis_logger(opts, "vmm.check_health.detached", "vmm")
 
+    vm_ips = sorted(set(vm_ip for _, vm_ip in vms))
+    if multiplexing_enabled(opts):
+        errors = check_health_ssh(opts, vm_ips, log)
+    else:
+        errors = check_health_ansible(opts, vm_ips, log)
+
+    results = []
+    for vm_name, vm_ip in vms:
+        result = {
+            "vm_ip": vm_ip,
+            "vm_name": vm_name,
+            "msg": "",
+            "result": "OK",
+            "topic": EventTopics.HEALTH_CHECK
+        }
+        if errors.get(vm_ip):
+            result["result"] = "failed"
+            result["msg"] = errors[vm_ip]
+        results.append(result)
+
+    try:
+        pipe = get_redis_connection(opts).pipeline(transaction=False)
+        for result in results:
+            pipe.publish(PUBSUB_MB, json.dumps(result))
+        pipe.execute()
+    except Exception as err:
+        log.exception("Failed to publish msg health check results: {} with error: {}"
+                      .format(results, err))
+
+
+def check_health_ssh(opts, vm_ips, log):
+    """
+    Runs the check through the shared ssh connections, all VMs at once
+
+    :return: dict vm_ip -> error message or None
+    """
+    user = opts.build_user or "root"
+    processes = {}
+    errors = {}
+    for vm_ip in vm_ips:
+        try:
+            processes[vm_ip] = start_ssh(opts, vm_ip, user, "echo hello", opts.vm_ssh_check_timeout, log)
+        except Exception as error:
+            errors[vm_ip] = "Failed to check VM ({}) due to ssh error: {}".format(vm_ip, error)
+            log.exception(errors[vm_ip])
+
+    for vm_ip, process in processes.items():
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            errors[vm_ip] = ("VM is not responding to ssh, return code: {}, stderr:\n{}"
+                             .format(process.returncode, stderr))
+    return errors
+
+
+def check_health_ansible(opts, vm_ips, log):
+    """
+    Runs the check through one ansible runner for all VMs
+
+    :return: dict vm_ip -> error message or None
+    """
     runner_options = dict(
         remote_user=opts.build_user or "root",
-        host_list="{},".format(vm_ip),
-        pattern=vm_ip,
-        forks=1,
+        host_list="{},".format(",".join(vm_ips)),
+        pattern="all",
+        forks=len(vm_ips),
         transport=opts.ssh.transport,
         timeout=opts.vm_ssh_check_timeout
     )
@@ -36,35 +98,22 @@ def check_health(opts, vm_name, vm_ip):
     connection.module_name = "shell"
     connection.module_args = "echo hello"
 
-    result = {
-        "vm_ip": vm_ip,
-        "vm_name": vm_name,
-        "msg": "",
-        "result": "OK",
-        "topic": EventTopics.HEALTH_CHECK
-    }
-    err_msg = None
+    errors = {}
     try:
         res = connection.run()
-        if vm_ip not in res.get("contacted", {}):
-            err_msg = (
-                "VM is not responding to the testing playbook."
-                "Runner options: {}".format(runner_options) +
-                "Ansible raw response:\n{}".format(res))
+        contacted = res.get("contacted", {})
+        for vm_ip in vm_ips:
+            if vm_ip not in contacted:
+                errors[vm_ip] = (
+                    "VM is not responding to the testing playbook."
+                    "Runner options: {}".format(runner_options) +
+                    "Ansible raw response:\n{}".format(res.get("dark", {}).get(vm_ip, res)))
 
     except Exception as error:
-        err_msg = "Failed to check  VM ({})due to ansible error: {}".format(vm_ip, error)
-        log.exception(err_msg)
-
-    try:
-        if err_msg:
-            result["result"] = "failed"
-            result["msg"] = err_msg
-        rc = get_redis_connection(opts)
-        rc.publish(PUBSUB_MB, json.dumps(result))
-    except Exception as err:
-        log.exception("Failed to publish msg health check result: {} with error: {}"
-                      .format(result, err))
+        for vm_ip in vm_ips:
+            errors[vm_ip] = "Failed to check  VM ({})due to ansible error: {}".format(vm_ip, error)
+        log.exception("Failed to check VMs {} due to ansible error: {}".format(vm_ips, error))
+    return errors
 
 
 class HealthChecker(Executor):
@@ -72,11 +121,17 @@ class HealthChecker(Executor):
     __name_for_log__ = "health_checker"
     __who_for_log__ = "vmm"
 
-    def run_check_health(self, vm_name, vm_ip):
+    def run_check_health_batch(self, vms):
+        """
+        Check all given VMs in one thread, see check_health_batch()
+
+        :param vms: list of (vm_name, vm_ip)
+        """
         self.recycle()
-        self.run_detached(check_health, args=(self.opts, vm_name, vm_ip))
-        # proc = Process(target=check_health, args=(self.opts, vm_name, vm_ip))
-        # proc = Thread(target=check_health, args=(self.opts, vm_name, vm_ip))
-        # self.child_processes.append(proc)
-        # proc.start()
-        # self.log.debug("Check health process started: {}".format(proc.pid))
+        self.run_detached(check_health_batch, args=(self.opts, vms))
+
+    def is_running(self):
+        """
+        :return: True while some health check thread hasn't finished yet
+        """
+        return any(proc.is_alive() for proc in self.child_processes)
@@ -0,0 +1,95 @@
+# coding: utf-8
+
+"""
+Shared ssh connections to builder VMs.
+
+With `multiplex` enabled in the [ssh] section of the config, the first ssh
+session to a VM starts an OpenSSH ControlMaster and all the following sessions
+(ansible with "ssh" transport, rsync of results, waiting for builds, health
+checks) go through it, from any backend process. The master lives as long as
+it is used at least once per `control_persist` seconds (60 by default, enough
+for the next build on a released VM) and it is closed when the VM is
+terminated.
+"""
+
+import os
+import pipes
+from subprocess import Popen, PIPE
+
+import ansible.constants
+
+from ..helpers import ensure_dir_exists
+
+
+def multiplexing_enabled(opts):
+    return opts.ssh.get("multiplex", False)
+
+
+def control_path(opts):
+    # expanded by ssh for each user, host and port
+    return os.path.join(opts.ssh.control_dir, "%r@%h:%p")
+
+
+def multiplex_options(opts):
+    if not multiplexing_enabled(opts):
+        return []
+    return ["-o", "ControlMaster=auto",
+            "-o", "ControlPath={}".format(control_path(opts)),
+            "-o", "ControlPersist={}".format(opts.ssh.control_persist)]
+
+
+def ssh_options(opts):
+    """
+    :return: list of ssh arguments used for all connections to builders
+    """
+    return (["-o", "PasswordAuthentication=no", "-o", "StrictHostKeyChecking=no"] +
+            multiplex_options(opts))
+
+
+def ssh_command(opts):
+    """
+    :return: ssh command line, e.g. for `rsync -e`
+    """
+    return " ".join(pipes.quote(arg) for arg in ["ssh"] + ssh_options(opts))
+
+
+def configure_ansible(opts, log):
+    """
+    Create the directory for control sockets and make ansible "ssh" transport
+    use the shared connections. Affects all ansible runners in this process,
+    paramiko transport is not affected.
+    """
+    if not multiplexing_enabled(opts):
+        return
+    ensure_dir_exists(opts.ssh.control_dir, log)
+    if opts.ssh.transport == "ssh":
+        ansible.constants.ANSIBLE_SSH_ARGS = " ".join(multiplex_options(opts))
+
+
+def start_ssh(opts, vm_ip, user, command, timeout, log):
+    """
+    Start command on the VM, it is killed after `timeout` seconds
+
+    :rtype: Popen
+    """
+    if multiplexing_enabled(opts):
+        ensure_dir_exists(opts.ssh.control_dir, log)
+    cmd = (["timeout", str(timeout), "ssh"] + ssh_options(opts) +
+           ["-o", "ConnectTimeout={}".format(timeout), "{}@{}".format(user, vm_ip), command])
+    return Popen(cmd, stdout=PIPE, stderr=PIPE)
+
+
+def close_connections(opts, vm_ip, log):
+    """
+    Stop ControlMasters of all users connected to the VM
+    """
+    if not multiplexing_enabled(opts):
+        return
+    for user in set([opts.build_user, "root"]):
+        cmd = ["ssh", "-o", "ControlPath={}".format(control_path(opts)),
+               "-O", "exit", "{}@{}".format(user, vm_ip)]
+        try:
+            process = Popen(cmd, stdout=PIPE, stderr=PIPE)
+            process.communicate()
+        except OSError as error:
+            log.exception("Failed to close ssh connection to {}@{}: {}".format(user, vm_ip, error))
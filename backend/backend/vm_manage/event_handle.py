@@ -8,6 +8,7 @@ import time
 from backend.exceptions import VmDescriptorNotFound
 from backend.helpers import get_redis_logger
 from backend.vm_manage import VmStates, PUBSUB_MB, EventTopics
+from backend.vm_manage.models import set_vm_state_lua_snippet, state_index_keys
 
 
 class Recycle(Thread):
@@ -33,27 +34,29 @@ class Recycle(Thread):
         self._running = False
 
 # KEYS[1]: VMD key
-on_health_check_success_lua = """
+# KEYS[-6:]: state index keys of the VM group, see `state_index_keys()`
+on_health_check_success_lua = set_vm_state_lua_snippet + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "check_health" and old_state ~= "in_use" then
     return nil
 else
     redis.call("HSET", KEYS[1], "check_fails", 0)
     if old_state == "check_health" then
-        redis.call("HSET", KEYS[1], "state", "{}")
+        set_vm_state(KEYS[1], "{}")
     end
 end
 """.format(VmStates.READY)
 
 # KEYS[1]: VMD key
-record_failure_lua = """
+# KEYS[-6:]: state index keys of the VM group, see `state_index_keys()`
+record_failure_lua = set_vm_state_lua_snippet + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "check_health" and old_state ~= "in_use" and old_state ~= "check_health_failed" then
     return nil
 else
     redis.call("HINCRBY", KEYS[1], "check_fails", 1)
     if old_state == "check_health" then
-        redis.call("HSET", KEYS[1], "state", "{}")
+        set_vm_state(KEYS[1], "{}")
     end
 end
 """.format(VmStates.CHECK_HEALTH_FAILED)
@@ -100,11 +103,12 @@ class EventHandler(Process):
             return
 
         if msg["result"] == "OK":
-            self.lua_scripts["on_health_check_success"](keys=[vmd.vm_key], args=[time.time()])
+            self.lua_scripts["on_health_check_success"](
+                keys=[vmd.vm_key] + state_index_keys(vmd.group), args=[time.time()])
             self.log.debug("recording success for ip:{} name:{}".format(vmd.vm_ip, vmd.vm_name))
         else:
             self.log.debug("recording check fail: {}".format(msg))
-            self.lua_scripts["record_failure"](keys=[vmd.vm_key])
+            self.lua_scripts["record_failure"](keys=[vmd.vm_key] + state_index_keys(vmd.group))
             fails_count = int(vmd.get_field(self.vmm.rc, "check_fails") or 0)
             max_check_fails = self.opts.build_groups[vmd.group]["vm_max_check_fails"]
             if fails_count > max_check_fails and vmd.state != VmStates.IN_USE:
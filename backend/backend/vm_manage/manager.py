@@ -7,6 +7,8 @@ from __future__ import absolute_import
 
 from itertools import chain
 import json
+import os
+import socket
 import time
 import weakref
 from cStringIO import StringIO
@@ -14,34 +16,67 @@ import datetime
 from backend.exceptions import VmError, NoVmAvailable, VmDescriptorNotFound
 
 from backend.helpers import get_redis_connection
-from .models import VmDescriptor
+from .models import VmDescriptor, set_vm_state_lua_snippet, state_index_keys
 from . import VmStates, KEY_VM_INSTANCE, KEY_VM_POOL, EventTopics, PUBSUB_MB, KEY_SERVER_INFO, \
-    KEY_VM_POOL_INFO
+    KEY_VM_POOL_INFO, KEY_VM_IN_USE_BY_USER, KEY_VM_STATE_INDEX, PUBSUB_INTERRUPT_BUILDER, \
+    KEY_VM_AFFINITY_STATS, KEY_VM_LEASE, PUBSUB_VM_RELEASED
 from ..helpers import get_redis_logger
 
 # KEYS[1]: VMD key
+# KEYS[-6:]: state index keys of the VM group, see `state_index_keys()`
 # ARGV[1] current timestamp for `last_health_check`
-set_checking_state_lua = """
+set_checking_state_lua = set_vm_state_lua_snippet + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "got_ip" and old_state ~= "ready" and old_state ~= "in_use" and old_state ~= "check_health_failed" then
     return nil
 else
     if old_state ~= "in_use" then
-        redis.call("HSET", KEYS[1], "state", "check_health")
+        set_vm_state(KEYS[1], "check_health")
     end
     redis.call("HSET", KEYS[1], "last_health_check", ARGV[1])
     return "OK"
 end
 """
 
+# Decrements `in_use` counter of the user bound to the VM,
+# `in_use_key` is KEY_VM_IN_USE_BY_USER for the VM group
+decrement_in_use_lua_snippet = """
+local function decrement_in_use(vm_key, in_use_key)
+    local user = redis.call("HGET", vm_key, "bound_to_user")
+    if user then
+        local count = tonumber(redis.call("HGET", in_use_key, user))
+        if count and count > 1 then
+            redis.call("HINCRBY", in_use_key, user, -1)
+        else
+            redis.call("HDEL", in_use_key, user)
+        end
+    end
+end
+"""
+
 # KEYS[1]: VMD key
+# KEYS[2]: server info key
+# KEYS[3]: KEY_VM_IN_USE_BY_USER for the VM group
+# KEYS[4]: KEY_VM_AFFINITY_STATS for the VM group
+# KEYS[5]: KEY_VM_LEASE for the VM
+# KEYS[-6:]: state index keys of the VM group, see `state_index_keys()`
 # ARGV[1]: user to bound;
 # ARGV[2]: pid of the builder process
 # ARGV[3]: current timestamp for `in_use_since`
 # ARGV[4]: task_id
 # ARGV[5]: build_id
 # ARGV[6]: chroot
-acquire_vm_lua = """
+# ARGV[7]: max VMs in use per user
+# ARGV[8]: package name
+# ARGV[9]: affinity kind of this acquisition
+# ARGV[10]: lease owner
+# ARGV[11]: lease duration in seconds
+acquire_vm_lua = set_vm_state_lua_snippet + """
+local in_use_count = tonumber(redis.call("HGET", KEYS[3], ARGV[1])) or 0
+if in_use_count >= tonumber(ARGV[7]) then
+    return "user_limit"
+end
+
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "ready"  then
     return nil
@@ -49,9 +84,14 @@ else
     local last_health_check = tonumber(redis.call("HGET", KEYS[1], "last_health_check"))
     local server_restart_time = tonumber(redis.call("HGET", KEYS[2], "server_start_timestamp"))
     if last_health_check and server_restart_time and last_health_check > server_restart_time  then
-        redis.call("HMSET", KEYS[1], "state", "in_use", "bound_to_user", ARGV[1],
+        set_vm_state(KEYS[1], "in_use")
+        redis.call("HMSET", KEYS[1], "bound_to_user", ARGV[1],
                    "used_by_pid", ARGV[2], "in_use_since", ARGV[3],
-                   "task_id",  ARGV[4], "build_id", ARGV[5], "chroot", ARGV[6])
+                   "task_id",  ARGV[4], "build_id", ARGV[5], "chroot", ARGV[6],
+                   "package_name", ARGV[8], "affinity", ARGV[9])
+        redis.call("HINCRBY", KEYS[3], ARGV[1], 1)
+        redis.call("HINCRBY", KEYS[4], "acquired:" .. ARGV[9], 1)
+        redis.call("SET", KEYS[5], ARGV[10], "EX", ARGV[11])
         return "OK"
     else
         return nil
@@ -60,19 +100,55 @@ end
 """
 
 # KEYS[1]: VMD key
+# KEYS[2]: KEY_VM_LEASE for the VM
+# KEYS[3]: KEY_VM_IN_USE_BY_USER for the VM group
+# KEYS[4]: KEY_VM_AFFINITY_STATS for the VM group
+# KEYS[-6:]: state index keys of the VM group, see `state_index_keys()`
 # ARGV[1] current timestamp for `last_release`
-release_vm_lua = """
+# ARGV[2] how many recently built chroots to remember in `last_chroots`
+# ARGV[3] PUBSUB_VM_RELEASED channel
+release_vm_lua = set_vm_state_lua_snippet + decrement_in_use_lua_snippet + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "in_use" then
     return nil
 else
-    redis.call("HMSET", KEYS[1], "state", "ready", "last_release", ARGV[1])
-    redis.call("HDEL", KEYS[1], "in_use_since", "used_by_pid", "task_id", "build_id", "chroot")
+    decrement_in_use(KEYS[1], KEYS[3])
+    redis.call("DEL", KEYS[2])
+    redis.call("HSET", KEYS[1], "last_release", ARGV[1])
+
+    local vmd = redis.call("HMGET", KEYS[1], "chroot", "package_name", "affinity", "in_use_since",
+                           "last_chroots", "group")
+    local chroot, package_name, affinity, in_use_since = vmd[1], vmd[2], vmd[3], tonumber(vmd[4])
+    if chroot and chroot ~= "" and chroot ~= "None" then
+        local last_chroots = {chroot}
+        for other in string.gmatch(vmd[5] or "", "[^,]+") do
+            if other ~= chroot and #last_chroots < tonumber(ARGV[2]) then
+                table.insert(last_chroots, other)
+            end
+        end
+        redis.call("HSET", KEYS[1], "last_chroots", table.concat(last_chroots, ","))
+    end
+    if package_name and package_name ~= "" and package_name ~= "None" then
+        redis.call("HSET", KEYS[1], "last_package", package_name)
+    end
+    if affinity and in_use_since then
+        redis.call("HINCRBY", KEYS[4], "builds:" .. affinity, 1)
+        redis.call("HINCRBYFLOAT", KEYS[4], "build_seconds:" .. affinity,
+                   tonumber(ARGV[1]) - in_use_since)
+    end
+
+    redis.call("HDEL", KEYS[1], "in_use_since", "used_by_pid", "task_id", "build_id", "chroot",
+               "package_name", "affinity")
     redis.call("HINCRBY", KEYS[1], "builds_count", 1)
 
     local check_fails = tonumber(redis.call("HGET", KEYS[1], "check_fails"))
     if check_fails > 0 then
-        redis.call("HSET", KEYS[1], "state", "check_health_failed")
+        set_vm_state(KEYS[1], "check_health_failed")
+    else
+        set_vm_state(KEYS[1], "ready")
+    end
+    if vmd[6] then
+        redis.call("PUBLISH", ARGV[3], vmd[6])
     end
 
     return "OK"
@@ -80,9 +156,12 @@ end
 """
 
 # KEYS [1]: VMD key
+# KEYS [2]: KEY_VM_LEASE for the VM
+# KEYS [3]: KEY_VM_IN_USE_BY_USER for the VM group
+# KEYS[-6:]: state index keys of the VM group, see `state_index_keys()`
 # ARGS [1]: allowed_pre_state
 # ARGS [2]: timestamp for `terminating_since`
-terminate_vm_lua = """
+terminate_vm_lua = set_vm_state_lua_snippet + decrement_in_use_lua_snippet + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 
 if old_state == "in_use" and ARGV[1] ~= "in_use" then
@@ -94,20 +173,105 @@ if ARGV[1] and ARGV[1] ~= "None" and old_state ~= ARGV[1] then
 elseif old_state == "terminating" and ARGV[1] ~= "terminating" then
     return "Already terminating"
 else
-    redis.call("HMSET", KEYS[1], "state", "terminating", "terminating_since", ARGV[2])
+    if old_state == "in_use" then
+        decrement_in_use(KEYS[1], KEYS[3])
+    end
+    set_vm_state(KEYS[1], "terminating")
+    redis.call("DEL", KEYS[2])
+    redis.call("HSET", KEYS[1], "terminating_since", ARGV[2])
     return "OK"
 end
 """
 
-mark_vm_check_failed_lua = """
+# KEYS[1]: KEY_VM_IN_USE_BY_USER for the group
+# KEYS[2:]: VMD keys of all VMs in the group
+recount_in_use_lua = """
+redis.call("DEL", KEYS[1])
+for i = 2, #KEYS do
+    local vmd = redis.call("HMGET", KEYS[i], "state", "bound_to_user")
+    if vmd[1] == "in_use" and vmd[2] then
+        redis.call("HINCRBY", KEYS[1], vmd[2], 1)
+    end
+end
+"""
+
+# KEYS[1:-6]: VMD keys of all VMs in the group
+# KEYS[-6:]: state index keys of the group, see `state_index_keys()`
+rebuild_state_index_lua = set_vm_state_lua_snippet + """
+local vm_count = #KEYS - {}
+for i = vm_count + 1, #KEYS do
+    redis.call("DEL", KEYS[i])
+end
+for i = 1, vm_count do
+    local vmd = redis.call("HMGET", KEYS[i], "state", "vm_name")
+    if vmd[1] and vmd[2] and state_index_key[vmd[1]] then
+        redis.call("SADD", state_index_key[vmd[1]], vmd[2])
+    end
+end
+""".format(len(VmStates.all_states()))
+
+# KEYS[1]: VMD key
+# KEYS[-6:]: state index keys of the VM group, see `state_index_keys()`
+mark_vm_check_failed_lua = set_vm_state_lua_snippet + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state == "check_health" then
-    redis.call("HMSET", KEYS[1], "state", "check_health_failed")
+    set_vm_state(KEYS[1], "check_health_failed")
     return "OK"
 end
 """
 
 
+class VmPoolSnapshot(object):
+    """
+    VM pool state loaded at one moment, provides the same lookup methods as VmManager
+    without touching redis. Used to share one pool load between several checks.
+
+    Snapshot could be outdated, so state transitions should still be done through
+    VmManager methods which verify the current VM state inside lua scripts.
+
+    :param vmd_list: all VM descriptors in the pool
+    :type vmd_list: list of VmDescriptor
+    """
+    def __init__(self, vmd_list):
+        self.vmd_list = vmd_list
+
+    def get_all_vm(self):
+        """
+        :rtype: list of VmDescriptor
+        """
+        return list(self.vmd_list)
+
+    def get_all_vm_in_group(self, group):
+        """
+        :rtype: list of VmDescriptor
+        """
+        return [vmd for vmd in self.vmd_list if vmd.group == int(group)]
+
+    def get_vm_by_group_and_state_list(self, group, state_list):
+        """
+        Same as :py:meth:`VmManager.get_vm_by_group_and_state_list`
+
+        :rtype: list of VmDescriptor
+        """
+        states = set(state_list)
+        if group is None:
+            vmd_list = self.vmd_list
+        else:
+            vmd_list = self.get_all_vm_in_group(group)
+        return [vmd for vmd in vmd_list if vmd.state in states]
+
+    def lookup_vms_by_ip(self, vm_ip):
+        """
+        :rtype: list of VmDescriptor
+        """
+        return [vmd for vmd in self.vmd_list if vmd.vm_ip == vm_ip]
+
+
+# how many chroots built last by a VM are remembered in `last_chroots`
+AFFINITY_CHROOT_HISTORY = 3
+AFFINITY_KINDS = ["chroot", "package", "none"]
+
+
 class VmManager(object):
     """
     VM manager, it is used for two purposes:
@@ -136,6 +300,8 @@ class VmManager(object):
         self.lua_scripts["release_vm"] = self.rc.register_script(release_vm_lua)
         self.lua_scripts["terminate_vm"] = self.rc.register_script(terminate_vm_lua)
         self.lua_scripts["mark_vm_check_failed"] = self.rc.register_script(mark_vm_check_failed_lua)
+        self.lua_scripts["recount_in_use"] = self.rc.register_script(recount_in_use_lua)
+        self.lua_scripts["rebuild_state_index"] = self.rc.register_script(rebuild_state_index_lua)
 
     def set_logger(self, logger):
         """
@@ -170,6 +336,7 @@ class VmManager(object):
         # print("VMD: {}".format(vmd))
         pipe = self.rc.pipeline()
         pipe.sadd(KEY_VM_POOL.format(group=group), vm_name)
+        pipe.sadd(KEY_VM_STATE_INDEX.format(group=group, state=vmd.state), vm_name)
         pipe.hmset(KEY_VM_INSTANCE.format(vm_name=vm_name), vmd.to_dict())
         pipe.execute()
         self.log.info("registered new VM: {} {}".format(vmd.vm_name, vmd.vm_ip))
@@ -186,36 +353,98 @@ class VmManager(object):
             if vmd.vm_ip == vm_ip
         ]
 
-    def mark_vm_check_failed(self, vm_name):
+    def mark_vm_check_failed(self, vm_name, group):
         vm_key = KEY_VM_INSTANCE.format(vm_name=vm_name)
-        self.lua_scripts["mark_vm_check_failed"](keys=[vm_key])
+        self.lua_scripts["mark_vm_check_failed"](keys=[vm_key] + state_index_keys(group))
 
     def mark_server_start(self):
         self.rc.hset(KEY_SERVER_INFO, "server_start_timestamp", time.time())
+        self.recount_vm_in_use_by_user()
+        self.rebuild_state_index()
+
+    def rebuild_state_index(self):
+        """
+        Rebuild sets of VM names per (group, state) from the VM descriptors,
+        the sets are otherwise maintained by the lua scripts changing VM state.
+        """
+        for group in self.vm_groups:
+            self.lua_scripts["rebuild_state_index"](
+                keys=self._get_vm_keys_in_group(group) + state_index_keys(group))
+
+    def recount_vm_in_use_by_user(self):
+        """
+        Rebuild per-user counters of VMs in `in_use` state from the VM descriptors,
+        the counters are otherwise maintained incrementally by the lua scripts.
+        """
+        for group in self.vm_groups:
+            self.lua_scripts["recount_in_use"](
+                keys=[KEY_VM_IN_USE_BY_USER.format(group=group)] + self._get_vm_keys_in_group(group))
+
+    def _get_vm_keys_in_group(self, group):
+        """
+        :return: VMD keys of all VMs in the group, for scripts going through the whole pool
+        """
+        return [KEY_VM_INSTANCE.format(vm_name=vm_name)
+                for vm_name in self.rc.smembers(KEY_VM_POOL.format(group=group))]
+
+    def get_vm_in_use_count(self, username, group):
+        """
+        :return int: number of VMs from the `group` currently used by `username`
+        """
+        return int(self.rc.hget(KEY_VM_IN_USE_BY_USER.format(group=group), username) or 0)
+
+    def get_vm_in_use_counts(self, group):
+        """
+        :return dict: username -> number of VMs from the `group` currently used by the user
+        """
+        return {username: int(count) for username, count in
+                self.rc.hgetall(KEY_VM_IN_USE_BY_USER.format(group=group)).items()}
 
     def can_user_acquire_more_vm(self, username, group):
         """
         :return bool: True when user are allowed to acquire more VM
+
+        Note: this is only a hint, the limit is enforced atomically by acquire_vm lua script.
         """
-        vmd_list = self.get_all_vm_in_group(group)
-        vm_count_used_by_user = len([
-            vmd for vmd in vmd_list if
-            vmd.bound_to_user == username and vmd.state == VmStates.IN_USE
-        ])
+        vm_count_used_by_user = self.get_vm_in_use_count(username, group)
         self.log.debug("# vm by user: {}, limit:{} ".format(
             vm_count_used_by_user, self.opts.build_groups[group]["max_vm_per_user"]
         ))
         if vm_count_used_by_user >= self.opts.build_groups[group]["max_vm_per_user"]:
-            # TODO: this check isn't reliable, if two (or more) processes check VM list
-            # at the +- same time, they could acquire more VMs
-            #  proper solution: do this check inside lua script
             self.log.debug("No VM are available, user `{}` already acquired #{} VMs"
                            .format(username, vm_count_used_by_user))
             return False
         else:
             return True
 
-    def acquire_vm(self, group, username, pid, task_id=None, build_id=None, chroot=None):
+    @staticmethod
+    def affinity_score(vmd, chroot, package_name):
+        """
+        How well is the VM prepared for the build, mock caches on the builder
+        are per chroot and dist-git clones per package.
+
+        :return: comparable score, higher is better
+        """
+        last_chroots = (getattr(vmd, "last_chroots", None) or "").split(",")
+        chroot_rank = 0
+        if chroot and chroot in last_chroots:
+            chroot_rank = AFFINITY_CHROOT_HISTORY - last_chroots.index(chroot)
+        package_match = bool(package_name) and getattr(vmd, "last_package", None) == package_name
+        return chroot_rank, package_match
+
+    @staticmethod
+    def affinity_kind(score):
+        """
+        :return: "chroot" when the VM built the chroot recently, "package" when
+            it built just the package, "none" otherwise
+        """
+        chroot_rank, package_match = score
+        if chroot_rank:
+            return "chroot"
+        return "package" if package_match else "none"
+
+    def acquire_vm(self, group, username, pid, task_id=None, build_id=None, chroot=None,
+                   package_name=None):
         """
         Try to acquire VM from pool
 
@@ -223,46 +452,87 @@ class VmManager(object):
         :type group: int
         :param username: build owner username, VMM prefer to reuse an existing VM which was used by the same user
         :param pid: builder pid to release VM after build process unhandled death
+        :param chroot: VMs which built this chroot recently are preferred
+        :param package_name: VMs which built this package last are preferred
 
         :rtype: VmDescriptor
         :raises: NoVmAvailable  when manager couldn't find suitable VM for the given group and user
         """
-        vmd_list = self.get_all_vm_in_group(group)
+        user_limit_error = NoVmAvailable("No VM are available, user `{}` already acquired too much VMs"
+                                         .format(username))
         if not self.can_user_acquire_more_vm(username, group):
-            raise NoVmAvailable("No VM are available, user `{}` already acquired too much VMs"
-                                .format(username))
+            raise user_limit_error
 
-        ready_vmd_list = [vmd for vmd in vmd_list if vmd.state == VmStates.READY]
+        ready_vmd_list = self.get_vm_by_group_and_state_list(group, [VmStates.READY])
         # trying to find VM used by this user
         dirtied_by_user = [vmd for vmd in ready_vmd_list if vmd.bound_to_user == username]
         clean_list = [vmd for vmd in ready_vmd_list if vmd.bound_to_user is None]
         all_vms = list(chain(dirtied_by_user, clean_list))
+        # stable sort, keeps the order above for VMs with the same score
+        scores = {vmd.vm_name: self.affinity_score(vmd, chroot, package_name) for vmd in all_vms}
+        all_vms.sort(key=lambda vmd: scores[vmd.vm_name], reverse=True)
 
         for vmd in all_vms:
-            if vmd.get_field(self.rc, "check_fails") != "0":
+            if str(vmd.check_fails) != "0":
                 self.log.debug("VM {} has check fails, skip acquire".format(vmd.vm_name))
             vm_key = KEY_VM_INSTANCE.format(vm_name=vmd.vm_name)
-            if self.lua_scripts["acquire_vm"](keys=[vm_key, KEY_SERVER_INFO],
-                                              args=[username, pid, time.time(),
-                                                    task_id, build_id, chroot]) == "OK":
-                self.log.info("Acquired VM :{} {} for pid: {}".format(vmd.vm_name, vmd.vm_ip, pid))
+            in_use_key = KEY_VM_IN_USE_BY_USER.format(group=group)
+            affinity = self.affinity_kind(scores[vmd.vm_name])
+            lua_result = self.lua_scripts["acquire_vm"](
+                keys=[vm_key, KEY_SERVER_INFO, in_use_key, KEY_VM_AFFINITY_STATS.format(group=group),
+                      KEY_VM_LEASE.format(vm_name=vmd.vm_name)] + state_index_keys(group),
+                args=[username, pid, time.time(), task_id, build_id, chroot,
+                      self.opts.build_groups[group]["max_vm_per_user"], package_name, affinity,
+                      "{}:{}".format(socket.gethostname(), pid), self.opts.vm_lease_seconds])
+            if lua_result == "OK":
+                self.log.info("Acquired VM :{} {} for pid: {}, affinity: {}"
+                              .format(vmd.vm_name, vmd.vm_ip, pid, affinity))
                 return vmd
+            elif lua_result == "user_limit":
+                raise user_limit_error
         else:
             raise NoVmAvailable("No VM are available, please wait in queue. Group: {}".format(group))
 
-    def release_vm(self, vm_name):
+    def release_vm(self, vm_name, group):
         """
         Return VM into the pool.
+
+        :param group: builder group of the VM
         :return: True if successful
         :rtype: bool
         """
         # in_use -> ready
         self.log.info("Releasing VM {}".format(vm_name))
         vm_key = KEY_VM_INSTANCE.format(vm_name=vm_name)
-        lua_result = self.lua_scripts["release_vm"](keys=[vm_key], args=[time.time()])
+        lua_result = self.lua_scripts["release_vm"](
+            keys=[vm_key, KEY_VM_LEASE.format(vm_name=vm_name), KEY_VM_IN_USE_BY_USER.format(group=group),
+                  KEY_VM_AFFINITY_STATS.format(group=group)] + state_index_keys(group),
+            args=[time.time(), AFFINITY_CHROOT_HISTORY, PUBSUB_VM_RELEASED])
         self.log.debug("release vm result `{}`".format(lua_result))
         return lua_result == "OK"
 
+    def renew_lease(self, vm_name):
+        """
+        Extend the lease of the acquired VM by `vm_lease_seconds`, called
+        periodically by the worker using the VM.
+
+        :return: False when the lease already expired or the VM was released
+        :rtype: bool
+        """
+        owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        return bool(self.rc.set(KEY_VM_LEASE.format(vm_name=vm_name), owner,
+                                ex=self.opts.vm_lease_seconds, xx=True))
+
+    def get_vms_without_lease(self, vmd_list):
+        """
+        :param vmd_list: VMs in use
+        :return: VMs from `vmd_list` whose lease expired, checked in one round trip
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        for vmd in vmd_list:
+            pipe.exists(KEY_VM_LEASE.format(vm_name=vmd.vm_name))
+        return [vmd for vmd, has_lease in zip(vmd_list, pipe.execute()) if not has_lease]
+
     def start_vm_termination(self, vm_name, allowed_pre_state=None):
         """
         Initiate VM termination process using redis publish.
@@ -271,7 +541,10 @@ class VmManager(object):
         :type allowed_pre_state: str constant from VmState
         """
         vmd = self.get_vm_by_name(vm_name)
-        lua_result = self.lua_scripts["terminate_vm"](keys=[vmd.vm_key], args=[allowed_pre_state, time.time()])
+        lua_result = self.lua_scripts["terminate_vm"](
+            keys=[vmd.vm_key, KEY_VM_LEASE.format(vm_name=vm_name),
+                  KEY_VM_IN_USE_BY_USER.format(group=vmd.group)] + state_index_keys(vmd.group),
+            args=[allowed_pre_state, time.time()])
         if lua_result == "OK":
             msg = {
                 "group": vmd.group,
@@ -281,12 +554,18 @@ class VmManager(object):
             }
             self.rc.publish(PUBSUB_MB, json.dumps(msg))
             self.log.info("VM {} queued for termination".format(vmd.vm_name))
-
-            # TODO: remove when refactored build management
-            # self.rc.publish(PUBSUB_INTERRUPT_BUILDER.format(vmd.vm_ip), "vm died")
+            self.interrupt_build(vmd.vm_ip, "vm died")
         else:
             self.log.debug("VM  termination `{}` skipped due to: {} ".format(vm_name, lua_result))
 
+    def interrupt_build(self, vm_ip, reason):
+        """
+        Ask the worker building on the VM to kill the build and stop waiting for it.
+
+        :return: number of builders which received the message
+        """
+        return self.rc.publish(PUBSUB_INTERRUPT_BUILDER.format(vm_ip), reason)
+
     def remove_vm_from_pool(self, vm_name):
         """
         Backend forgets about VM after this method
@@ -298,17 +577,29 @@ class VmManager(object):
             raise VmError("VM should have `terminating` state to be removable")
         pipe = self.rc.pipeline()
         pipe.srem(KEY_VM_POOL.format(group=vmd.group), vm_name)
+        pipe.srem(KEY_VM_STATE_INDEX.format(group=vmd.group, state=VmStates.TERMINATING), vm_name)
         pipe.delete(KEY_VM_INSTANCE.format(vm_name=vm_name))
         pipe.execute()
         self.log.info("removed vm `{}` from pool".format(vm_name))
 
     def _load_multi_safe(self, vm_name_list):
-        result = []
+        """
+        Load VM descriptors for all given names in one pipelined round trip,
+        names without VM record are skipped.
+
+        :rtype: list of VmDescriptor
+        """
+        vm_name_list = list(vm_name_list)
+        pipe = self.rc.pipeline(transaction=False)
         for vm_name in vm_name_list:
-            try:
-                result.append(VmDescriptor.load(self.rc, vm_name))
-            except VmDescriptorNotFound:
+            pipe.hgetall(KEY_VM_INSTANCE.format(vm_name=vm_name))
+
+        result = []
+        for vm_name, raw in zip(vm_name_list, pipe.execute()):
+            if not raw:
                 self.log.debug("Failed to load VMD: {}".format(vm_name))
+                continue
+            result.append(VmDescriptor.from_dict(raw))
         return result
 
     def get_all_vm_in_group(self, group):
@@ -322,10 +613,18 @@ class VmManager(object):
         """
         :rtype: list of VmDescriptor
         """
-        vmd_list = []
+        pipe = self.rc.pipeline(transaction=False)
         for group in self.vm_groups:
-            vmd_list.extend(self.get_all_vm_in_group(group))
-        return vmd_list
+            pipe.smembers(KEY_VM_POOL.format(group=group))
+        return self._load_multi_safe(chain.from_iterable(pipe.execute()))
+
+    def get_snapshot(self):
+        """
+        Load the whole VM pool at once.
+
+        :rtype: VmPoolSnapshot
+        """
+        return VmPoolSnapshot(self.get_all_vm())
 
     def get_vm_by_name(self, vm_name):
         """
@@ -344,10 +643,14 @@ class VmManager(object):
         :rtype: list of VmDescriptor
         """
         states = set(state_list)
-        if group is None:
-            vmd_list = self.get_all_vm()
-        else:
-            vmd_list = self.get_all_vm_in_group(group)
+        groups = self.vm_groups if group is None else [group]
+
+        pipe = self.rc.pipeline(transaction=False)
+        for group_id in groups:
+            for state in states:
+                pipe.smembers(KEY_VM_STATE_INDEX.format(group=group_id, state=state))
+        vmd_list = self._load_multi_safe(chain.from_iterable(pipe.execute()))
+        # state could have changed between reading the index and loading the VM
         return [vmd for vmd in vmd_list if vmd.state in states]
 
     def info(self):
@@ -367,6 +670,11 @@ class VmManager(object):
             buf.write("=" * 32)
             header = "\nVM group #{} {} archs: {}\n===\n".format(group_id, bg["name"], bg["archs"])
             buf.write(header)
+            for kind, stats in sorted(self.get_affinity_stats(group_id).items()):
+                avg = stats["avg_build_seconds"]
+                buf.write("affinity {}: {} acquired ({:.0%}), average build {}\n".format(
+                    kind, stats["acquired"], stats["rate"], "-" if avg is None else "{:.0f}s".format(avg)))
+            buf.write("\n")
             vmd_list = self.get_all_vm_in_group(group_id)
             for vmd in vmd_list:
                 buf.write("\t VM {}, ip: {}\n".format(vmd.vm_name, vmd.vm_ip))
@@ -381,6 +689,25 @@ class VmManager(object):
             buf.write("\n")
         return buf.getvalue()
 
+    def get_affinity_stats(self, group):
+        """
+        :return: dict affinity kind -> dict with number of acquired VMs, share
+            of all acquisitions and average time the finished builds held the VM
+        """
+        raw = self.rc.hgetall(KEY_VM_AFFINITY_STATS.format(group=group))
+        total = sum(int(raw.get("acquired:{}".format(kind), 0)) for kind in AFFINITY_KINDS)
+        stats = {}
+        for kind in AFFINITY_KINDS:
+            acquired = int(raw.get("acquired:{}".format(kind), 0))
+            builds = int(raw.get("builds:{}".format(kind), 0))
+            seconds = float(raw.get("build_seconds:{}".format(kind), 0))
+            stats[kind] = {
+                "acquired": acquired,
+                "rate": acquired / total if total else 0.0,
+                "avg_build_seconds": seconds / builds if builds else None,
+            }
+        return stats
+
     def write_vm_pool_info(self, group, key, value):
         self.rc.hset(KEY_VM_POOL_INFO.format(group=group), key, value)
 
@@ -1,10 +1,49 @@
 # coding: utf-8
 
 from pprint import pformat
-from . import KEY_VM_INSTANCE
+from . import VmStates, KEY_VM_INSTANCE, KEY_VM_STATE_INDEX
 from backend.exceptions import VmDescriptorNotFound
 
 
+# Lua helpers to be prepended to scripts which change VM state.
+# `set_vm_state` updates VMD `state` field and moves VM between state index sets.
+# Scripts using it get KEY_VM_STATE_INDEX keys of the VM group as the last KEYS,
+# in the order given by `state_index_keys()`.
+set_vm_state_lua_snippet = """
+local state_index_key = {}
+for i, state in ipairs({%s}) do
+    state_index_key[state] = KEYS[#KEYS - %d + i]
+end
+
+local function set_vm_state(vm_key, new_state)
+    local vmd = redis.call("HMGET", vm_key, "state", "vm_name")
+    local old_state, vm_name = vmd[1], vmd[2]
+    redis.call("HSET", vm_key, "state", new_state)
+    if vm_name and old_state ~= new_state then
+        if old_state and state_index_key[old_state] then
+            redis.call("SREM", state_index_key[old_state], vm_name)
+        end
+        redis.call("SADD", state_index_key[new_state], vm_name)
+    end
+end
+""" % (", ".join('"{}"'.format(state) for state in VmStates.all_states()), len(VmStates.all_states()))
+
+
+def state_index_keys(group):
+    """
+    :return: KEY_VM_STATE_INDEX keys of all states in the group,
+        to be passed to scripts using `set_vm_state_lua_snippet`
+    """
+    return [KEY_VM_STATE_INDEX.format(group=group, state=state) for state in VmStates.all_states()]
+
+# KEYS[1]: VMD key
+# KEYS[2:]: state index keys of the VM group
+# ARGV[1]: new state
+store_vm_state_lua = set_vm_state_lua_snippet + """
+set_vm_state(KEYS[1], ARGV[1])
+"""
+
+
 class VmDescriptor(object):
     def __init__(self, vm_ip, vm_name, group, state):
         self.vm_ip = vm_ip
@@ -64,7 +103,12 @@ class VmDescriptor(object):
         """
         # TODO: add option `save_with_existnse_check`, use lua script to ensure that VMD still exists
         setattr(self, field, value)
-        rc.hset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), field, value)
+        if field == "state":
+            # keep state index in sync
+            keys = [KEY_VM_INSTANCE.format(vm_name=self.vm_name)] + state_index_keys(self.group)
+            rc.eval(store_vm_state_lua, len(keys), *(keys + [value]))
+        else:
+            rc.hset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), field, value)
 
     def get_field(self, rc, field):
         """
@@ -0,0 +1,54 @@
+# coding: utf-8
+
+"""
+Decides how many VMs to spawn or terminate in a group from the build queue.
+
+Without the planner VmMaster spawns at most one VM per cycle whenever a group
+is below `max_vm_total`, so a burst of builds waits for VMs started one by one
+and an empty queue keeps the whole pool running. The planner estimates how many
+builders the group needs within `spawn_planner_lead_time` seconds (about how
+long a VM takes to become ready): the tasks waiting now plus the tasks expected
+to arrive meanwhile, at the arrival rate observed by the frontend in the last
+`spawn_planner_window` seconds.
+"""
+
+from __future__ import division
+
+import math
+from collections import namedtuple
+
+
+SpawnPlan = namedtuple("SpawnPlan", ["spawn", "terminate", "demand"])
+
+
+def group_demand(group_opts, counts, lead_time):
+    """
+    :param group_opts: one item of opts.build_groups
+    :param counts: result of FrontendClient.pending_build_counts()
+    :param lead_time: seconds needed to get a new VM ready
+    :return: number of builders the group needs in `lead_time`
+    """
+    pending = sum(counts["pending"].get(arch, 0) for arch in group_opts["archs"])
+    arrived = sum(counts["arrived"].get(arch, 0) for arch in group_opts["archs"])
+    return pending + int(math.ceil(arrived / max(counts["window"], 1) * lead_time))
+
+
+def plan_group(group_opts, demand, ready, idle_clean, starting, active, spawning):
+    """
+    :param demand: result of group_demand()
+    :param ready: number of VMs in "ready" state
+    :param idle_clean: names of "ready" VMs not bound to any user
+    :param starting: number of VMs which got IP or are checked, not ready yet
+    :param active: number of VMs in any state but "terminating"
+    :param spawning: number of running spawn processes
+    :rtype: SpawnPlan
+    """
+    available = ready + starting + spawning
+    if demand > available:
+        limit = min(group_opts["max_vm_total"] - active - spawning,
+                    group_opts["max_spawn_processes"] - spawning)
+        return SpawnPlan(max(0, min(demand - available, limit)), [], demand)
+
+    # keep some clean VMs for the builds the estimate missed
+    surplus = available - demand - group_opts["vm_idle_reserve"]
+    return SpawnPlan(0, idle_clean[:max(0, surplus)], demand)
@@ -6,6 +6,7 @@ from backend.ans_utils import ans_extra_vars_encode, run_ansible_playbook_cli
 from backend.exceptions import CoprSpawnFailError
 from backend.helpers import get_redis_connection
 from backend.vm_manage import EventTopics, PUBSUB_MB
+from backend.vm_manage.connection import close_connections
 from backend.vm_manage.executor import Executor
 from ..helpers import get_redis_logger
 
@@ -31,6 +32,7 @@ def terminate_vm(opts, terminate_playbook, group, vm_name, vm_ip):
         "result": "OK"
     }
     start_time = time.time()
+    close_connections(opts, vm_ip, log)
     try:
         log.info("starting terminate vm with args: {}".format(term_args))
         run_ansible_playbook_cli(args, "terminate instance", log)
@@ -0,0 +1,122 @@
+#!/usr/bin/python2
+# coding: utf-8
+
+"""
+Measures how long it takes until packages of a burst of builds finishing
+in one chroot are published in the repository metadata.
+
+Every simulated build copies a package into its own build directory
+in the chroot and calls createrepo the same way the backend worker does,
+each build runs in a separate process like the real workers. Reported
+latency is the time from the build finishing (package copied) until its
+createrepo call returned, i.e. until the package is in the repodata.
+
+Needs createrepo_c and one sample rpm, e.g.:
+
+    PYTHONPATH=. python2 benchmarks/createrepo_burst.py --rpm foo.rpm \\
+        --existing 5000 --builds 30 --interval 0.2 --mode coalesce
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from backend.createrepo import createrepo_unsafe, CreaterepoScheduler
+
+
+MODES = {
+    # mode: (debounce, incremental)
+    "legacy": (None, False),
+    "coalesce": (0, False),
+    "debounce": (1, False),
+    "incremental": (0, True),
+    "debounce-incremental": (1, True),
+}
+
+
+def prepare_chroot(path, rpm, existing):
+    for i in range(existing):
+        build_dir = os.path.join(path, "{:08d}-existing".format(i))
+        os.mkdir(build_dir)
+        os.symlink(rpm, os.path.join(build_dir, "existing-{}.rpm".format(i)))
+    createrepo_unsafe(path)
+
+
+def run_build(path, rpm, build_id, mode, max_delay, runs, results):
+    debounce, incremental = MODES[mode]
+    build_dir_name = "{:08d}-new".format(build_id)
+    build_dir = os.path.join(path, build_dir_name)
+    os.mkdir(build_dir)
+    shutil.copy(rpm, os.path.join(build_dir, "new-{}.rpm".format(build_id)))
+    finished_on = time.time()
+
+    def do_createrepo(pkglist=None):
+        with runs.get_lock():
+            runs.value += 1
+        return createrepo_unsafe(path, pkglist=pkglist)
+
+    pkgs = [build_dir_name] if incremental else None
+    if debounce is None:
+        do_createrepo(CreaterepoScheduler(path).expand(pkgs) if pkgs else None)
+    else:
+        CreaterepoScheduler(path, debounce, max_delay).run(do_createrepo, pkgs)
+
+    results.put(time.time() - finished_on)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rpm", required=True, help="sample rpm file")
+    parser.add_argument("--existing", type=int, default=1000,
+                        help="number of packages already in the repository")
+    parser.add_argument("--builds", type=int, default=20, help="number of builds in the burst")
+    parser.add_argument("--interval", type=float, default=0.5,
+                        help="seconds between two builds finishing")
+    parser.add_argument("--max-delay", type=float, default=10)
+    parser.add_argument("--mode", choices=sorted(MODES), action="append",
+                        help="can be given more times, default is all modes")
+    args = parser.parse_args()
+
+    for mode in args.mode or sorted(MODES):
+        path = tempfile.mkdtemp(prefix="createrepo-burst-")
+        try:
+            prepare_chroot(path, os.path.abspath(args.rpm), args.existing)
+
+            runs = multiprocessing.Value("i", 0)
+            results = multiprocessing.Queue()
+            start = time.time()
+            builds = []
+            for build_id in range(args.builds):
+                build = multiprocessing.Process(target=run_build, args=(
+                    path, args.rpm, build_id, mode, args.max_delay, runs, results))
+                build.start()
+                builds.append(build)
+                time.sleep(args.interval)
+
+            latencies = [results.get() for _ in builds]
+            for build in builds:
+                build.join()
+            total = time.time() - start
+
+            print("{:22} createrepo runs: {:3}  latency mean: {:6.2f}s  p50: {:6.2f}s  "
+                  "p95: {:6.2f}s  max: {:6.2f}s  total: {:6.2f}s".format(
+                      mode, runs.value, sum(latencies) / len(latencies),
+                      percentile(latencies, 0.5), percentile(latencies, 0.95),
+                      max(latencies), total))
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,23 +6,31 @@ from __future__ import division
 from __future__ import absolute_import
 
 import os
+import json
+import time
 import shutil
 import sys
 import logging
 import subprocess
 import pwd
+import multiprocessing
 
 log = logging.getLogger(__name__)
 
 from copr.exceptions import CoprException
 from copr.exceptions import CoprRequestException
+from requests import RequestException
 
 sys.path.append("/usr/share/copr/")
 
 from backend.helpers import BackendConfigReader
-from backend.helpers import get_auto_createrepo_status,get_persistent_status
+from backend.project_settings import ProjectSettings
+from backend.createrepo import createrepo_unsafe
 
 DEF_DAYS = 14
+DEF_WORKERS = 4
+DEF_CREATEREPO_WORKERS = 2
+DEF_CHECKPOINT_FILE = "/var/lib/copr/prune_results.checkpoint"
 
 def list_subdir(path):
     dir_names = [d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))]
@@ -57,10 +65,184 @@ def runcmd(cmd):
     return stdout
 
 
+def chroot_signature(chroot_path):
+    """
+    Modification times of the chroot directory and its repodata, they change
+    whenever a build is added or removed or the repository is regenerated
+    """
+    repomd_path = os.path.join(chroot_path, "repodata", "repomd.xml")
+    repomd_mtime = os.stat(repomd_path).st_mtime if os.path.exists(repomd_path) else None
+    return [os.stat(chroot_path).st_mtime, repomd_mtime]
+
+
+def oldest_young_build(chroot_path, prune_days):
+    """
+    Time of the oldest build in the chroot which is younger than `prune_days`,
+    i.e. which prunerepo might have kept only because of its age.
+    Rpm files are written right after they are built, so their modification
+    time is close to the build time prunerepo looks at.
+
+    :return: timestamp or None when all the builds are older
+    """
+    cutoff = time.time() - prune_days * 24 * 3600
+    young = []
+    for dir_name in os.listdir(chroot_path):
+        build_path = os.path.join(chroot_path, dir_name)
+        if not os.path.isfile(os.path.join(build_path, "build.info")):
+            continue
+        # empty build dirs are removed by their own mtime
+        mtimes = [os.stat(build_path).st_mtime] + [
+            os.stat(os.path.join(build_path, name)).st_mtime
+            for name in os.listdir(build_path) if name.endswith(".rpm")]
+        young.extend(mtime for mtime in mtimes if mtime > cutoff)
+    return min(young) if young else None
+
+
+_createrepo_semaphore = None
+
+
+def init_worker(createrepo_semaphore):
+    global _createrepo_semaphore
+    _createrepo_semaphore = createrepo_semaphore
+
+
+def prune_chroot(chroot_path, prune_days):
+    """
+    Prune one chroot, runs in a worker process.
+
+    :return: tuple(chroot_path, signature after pruning or None when pruning
+        failed, time of the oldest build left because it was young or None)
+    """
+    try:
+        cmd = ['prunerepo', '--verbose', '--days={0}'.format(prune_days),
+               '--cleancopr', '--nocreaterepo', '--native', chroot_path]
+        stdout = runcmd(cmd)
+        loginfo(stdout)
+        # createrepo reads the whole repository, don't let all the workers do it at once
+        with _createrepo_semaphore:
+            createrepo_unsafe(chroot_path)
+    except Exception as err:
+        logexception(err)
+        logerror("Error pruning chroot {}".format(chroot_path))
+        return chroot_path, None, None
+
+    loginfo("Pruning done for chroot {}".format(chroot_path))
+    return chroot_path, chroot_signature(chroot_path), oldest_young_build(chroot_path, prune_days)
+
+
+def _prune_chroot_star(args):
+    return prune_chroot(*args)
+
+
+class PruneCheckpoint(object):
+    """
+    Remembers in a file how each chroot was left by the last successful prune,
+    so that an interrupted run can be resumed and chroots which can't have
+    anything new to prune are skipped. When the file can't be written, pruning
+    goes on without the checkpoint.
+    """
+
+    def __init__(self, path, prune_days, save_period=10):
+        self.path = path
+        self.prune_days = prune_days
+        self.save_period = save_period
+        self.started_on = None
+        self.finished_on = None
+        self.chroots = {}
+        self.seen = set()
+        self.saved_on = 0
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as err:
+            loginfo("No usable checkpoint in {}: {}".format(self.path, err))
+            return
+        self.started_on = data.get("started_on")
+        self.finished_on = data.get("finished_on")
+        self.chroots = data.get("chroots", {})
+
+    def save(self, force=False):
+        """
+        Write the checkpoint, unless it was written less than `save_period` seconds ago
+        """
+        if not self.path:
+            return
+        if not force and time.time() - self.saved_on < self.save_period:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"started_on": self.started_on,
+                           "finished_on": self.finished_on,
+                           "chroots": self.chroots}, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as err:
+            logerror("Can't write checkpoint {}, pruning without it: {}".format(self.path, err))
+            self.path = None
+            return
+        self.saved_on = time.time()
+
+    def start_run(self):
+        if self.started_on and not self.finished_on:
+            loginfo("Resuming pruning started on {}".format(time.ctime(self.started_on)))
+            return
+        self.started_on = time.time()
+        self.finished_on = None
+
+    def finish_run(self):
+        # forget chroots which no longer exist or are not pruned anymore
+        self.chroots = {path: state for path, state in self.chroots.items()
+                        if path in self.seen}
+        self.finished_on = time.time()
+        self.save(force=True)
+
+    def is_done(self, chroot_path):
+        """
+        True when the chroot was pruned earlier in this (resumed) run, or it has not
+        changed since the last prune which left nothing to be pruned later
+        """
+        self.seen.add(chroot_path)
+        state = self.chroots.get(chroot_path)
+        if not state:
+            return False
+        if state["pruned_on"] >= self.started_on:
+            return True
+        if state["signature"] != chroot_signature(chroot_path):
+            return False
+        # packages younger than prune_days could have been kept last time,
+        # the oldest of them gets old enough when next_prune passes
+        return state["pruned_on"] >= state["next_prune"] or time.time() < state["next_prune"]
+
+    def record(self, chroot_path, signature, young_since):
+        """
+        Remember successful prune of the chroot
+
+        :param young_since: time of the oldest build kept because it was young,
+            None when the prune saw all the builds as old
+        """
+        pruned_on = time.time()
+        self.chroots[chroot_path] = {
+            "signature": signature,
+            "pruned_on": pruned_on,
+            "next_prune": pruned_on if young_since is None
+                          else young_since + self.prune_days * 24 * 3600,
+        }
+        self.save()
+
+
 class Pruner(object):
     def __init__(self, opts):
         self.opts = opts
         self.prune_days = getattr(self.opts, "prune_days", DEF_DAYS)
+        self.workers = getattr(self.opts, "prune_workers", DEF_WORKERS)
+        self.createrepo_workers = getattr(self.opts, "prune_createrepo_workers", DEF_CREATEREPO_WORKERS)
+        self.project_settings = ProjectSettings(self.opts)
+        self.checkpoint = PruneCheckpoint(
+            getattr(self.opts, "prune_checkpoint_file", DEF_CHECKPOINT_FILE), self.prune_days)
 
     def run(self):
         results_dir = self.opts.destdir
@@ -70,33 +252,79 @@ class Pruner(object):
         loginfo("Going to process total number: {} of user's directories".format(len(user_dir_names)))
         loginfo("Going to process user's directories: {}".format(user_dir_names))
 
+        try:
+            # one request for all projects instead of one per project
+            self.project_settings.prefetch()
+        except (RequestException, ValueError, KeyError) as exception:
+            logerror("Failed to get settings of all projects, going to ask one by one: {}"
+                     .format(exception))
+
+        self.checkpoint.load()
+        self.checkpoint.start_run()
+
+        chroot_paths = []
         loginfo("--------------------------------------------")
         for username, subpath in zip(user_dir_names, user_dirs):
             loginfo("For user `{}` exploring path: {}".format(username, subpath))
             for projectname, project_path in zip(*list_subdir(subpath)):
                 loginfo("Exploring project `{}` with path: {}".format(projectname, project_path))
-                self.prune_project(project_path, username, projectname)
+                chroot_paths.extend(self.list_project_chroots(project_path, username, projectname))
                 loginfo("--------------------------------------------")
 
+        self.prune_chroots(chroot_paths)
+        self.checkpoint.finish_run()
         loginfo("Pruning finished")
 
-    def prune_project(self, project_path, username, projectname):
+    def prune_chroots(self, chroot_paths):
+        """
+        Prune the given chroots in `prune_workers` processes, at most
+        `prune_createrepo_workers` of them run createrepo at the same time
+        """
+        todo = [path for path in chroot_paths if not self.checkpoint.is_done(path)]
+        loginfo("Going to prune {} chroots, {} skipped as already pruned"
+                .format(len(todo), len(chroot_paths) - len(todo)))
+
+        semaphore = multiprocessing.BoundedSemaphore(self.createrepo_workers)
+        args = [(path, self.prune_days) for path in todo]
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers, init_worker, (semaphore,))
+            results = pool.imap_unordered(_prune_chroot_star, args)
+        else:
+            pool = None
+            init_worker(semaphore)
+            results = (prune_chroot(*arg) for arg in args)
+
+        try:
+            for chroot_path, signature, young_since in results:
+                if signature is not None:
+                    self.checkpoint.record(chroot_path, signature, young_since)
+        finally:
+            self.checkpoint.save(force=True)
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def list_project_chroots(self, project_path, username, projectname):
+        """
+        Chroot directories of the project which should be pruned
+        """
         loginfo("Going to prune {}/{}".format(username, projectname))
 
         try:
-            if not get_auto_createrepo_status(self.opts.frontend_base_url, username, projectname):
+            if not self.project_settings.get_auto_createrepo_status(username, projectname):
                 loginfo("Skipped {}/{} since auto createrepo option is disabled"
                           .format(username, projectname))
-                return
-            if get_persistent_status(self.opts.frontend_base_url, username, projectname):
+                return []
+            if self.project_settings.get_persistent_status(username, projectname):
                 loginfo("Skipped {}/{} since the project is persistent"
                           .format(username, projectname))
-                return
-        except (CoprException, CoprRequestException) as exception:
+                return []
+        except (CoprException, CoprRequestException, RequestException) as exception:
             logerror("Failed to get project details for {}/{} with error: {}".format(
                 username, projectname, exception))
-            return
+            return []
 
+        chroot_paths = []
         for sub_dir_name in os.listdir(project_path):
             chroot_path = os.path.join(project_path, sub_dir_name)
 
@@ -106,17 +334,9 @@ class Pruner(object):
             if not os.path.isdir(chroot_path):
                 continue
 
-            try:
-                cmd = ['prunerepo', '--verbose', '--days={0}'.format(self.prune_days), '--cleancopr', chroot_path]
-                stdout = runcmd(cmd)
-                loginfo(stdout)
-            except Exception as err:
-                logexception(err)
-                logerror("Error pruning chroot {}/{}:{}".format(username, projectname, sub_dir_name))
-
-            loginfo("Pruning done for chroot {}/{}:{}".format(username, projectname, sub_dir_name))
+            chroot_paths.append(chroot_path)
 
-        loginfo("Pruning finished for project {}/{}".format(username, projectname))
+        return chroot_paths
 
 
 def main():
@@ -0,0 +1,173 @@
+# coding: utf-8
+
+import json
+
+from munch import Munch
+import pytest
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from backend.actions import ActionType
+from backend.constants import ACTION_METRICS_REDIS_KEY
+from backend.daemons.action_dispatcher import ActionDispatcher, ActionWorker
+
+MODULE_REF = "backend.daemons.action_dispatcher"
+
+"""
+REQUIRES RUNNING REDIS
+"""
+
+
+@pytest.yield_fixture
+def mc_worker():
+    with mock.patch("{}.ActionWorker".format(MODULE_REF)) as handle:
+        yield handle
+
+
+def createrepo_task(action_id, owner, project):
+    return {
+        "id": action_id,
+        "action_type": ActionType.CREATEREPO,
+        "data": json.dumps({"username": owner, "projectname": project, "chroots": []}),
+    }
+
+
+class TestActionDispatcher(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            frontend_base_url="http://example.com",
+            frontend_auth="12345678",
+            frontend_pool_size=10,
+            frontend_retries=3,
+            frontend_timeout=60,
+            frontend_backoff_max=30,
+            frontend_update_batching=False,
+            destdir="/tmp",
+            results_baseurl="http://example.com/results",
+            sleeptime=1,
+            actions_max_workers=2,
+            actions_poll_period=1,
+        )
+        with mock.patch("{}.get_redis_logger".format(MODULE_REF)):
+            self.ad = ActionDispatcher(self.opts)
+        self.ad.frontend_client = MagicMock()
+        self.ad.rc.delete(ACTION_METRICS_REDIS_KEY)
+
+    def teardown_method(self, method):
+        self.ad.rc.delete(ACTION_METRICS_REDIS_KEY)
+
+    def fetch(self, *tasks):
+        self.ad.frontend_client.waiting_actions.return_value = list(tasks)
+        return self.ad.fetch_actions()
+
+    def test_fetch_actions(self):
+        assert self.fetch(createrepo_task(1, "foo", "bar"), createrepo_task(2, "foo", "baz")) == 2
+        assert [action.data["id"] for action, _ in self.ad.queue] == [1, 2]
+
+        self.ad.workers[3] = MagicMock(action=MagicMock(get_lock_keys=lambda: {"foo/qux"}))
+        self.fetch(createrepo_task(4, "foo", "quux"))
+        assert self.ad.frontend_client.waiting_actions.call_args == \
+            mock.call(2, exclude=[1, 2, 3], wait=None)
+
+        assert self.fetch(createrepo_task(5, "foo", "corge")) == 1
+        # queue is full
+        assert self.fetch(createrepo_task(6, "foo", "corge")) == 0
+        assert len(self.ad.queue) == 4
+
+    def test_fetch_actions_skips_blocked(self, mc_worker):
+        mc_worker.side_effect = lambda opts, action, queued_on: MagicMock(action=action)
+        self.fetch(*[createrepo_task(action_id, "foo", "bar") for action_id in range(1, 5)])
+        self.ad.start_actions()
+        assert list(self.ad.workers.keys()) == [1]
+
+        # the queued foo/bar actions wait for the running one, they don't count
+        self.fetch(createrepo_task(5, "foo", "baz"))
+        assert self.ad.frontend_client.waiting_actions.call_args == \
+            mock.call(4, exclude=[2, 3, 4, 1], wait=None)
+        assert self.ad.start_actions() == 1
+        assert sorted(self.ad.workers.keys()) == [1, 5]
+
+    def test_start_actions_serializes_projects(self, mc_worker):
+        self.fetch(createrepo_task(1, "foo", "bar"), createrepo_task(2, "foo", "bar"),
+                   createrepo_task(3, "foo", "baz"))
+        mc_worker.side_effect = lambda opts, action, queued_on: MagicMock(action=action)
+
+        assert self.ad.start_actions() == 2
+        assert sorted(self.ad.workers.keys()) == [1, 3]
+        assert [action.data["id"] for action, _ in self.ad.queue] == [2]
+
+        # still running foo/bar action
+        del self.ad.workers[3]
+        assert self.ad.start_actions() == 0
+
+        del self.ad.workers[1]
+        assert self.ad.start_actions() == 1
+        assert list(self.ad.workers.keys()) == [2]
+
+    def test_start_actions_keeps_project_order(self, mc_worker):
+        self.opts.actions_max_workers = 3
+        self.fetch(createrepo_task(1, "foo", "bar"), createrepo_task(2, "foo", "baz"))
+        mc_worker.side_effect = lambda opts, action, queued_on: MagicMock(action=action)
+        self.ad.workers[0] = MagicMock(action=self.ad.queue[0][0])
+        self.fetch(createrepo_task(3, "foo", "bar"), createrepo_task(4, "foo", "baz"))
+
+        # 1 is blocked by the running action of the same project,
+        # so neither 3 can start; 4 has to wait for 2
+        assert self.ad.start_actions() == 1
+        assert sorted(self.ad.workers.keys()) == [0, 2]
+
+    def test_start_actions_unknown_project_exclusive(self, mc_worker):
+        self.opts.actions_max_workers = 3
+        mc_worker.side_effect = lambda opts, action, queued_on: MagicMock(action=action)
+        unknown = {"id": 2, "action_type": ActionType.CREATEREPO, "data": "{"}
+        self.fetch(createrepo_task(1, "foo", "bar"), unknown, createrepo_task(3, "foo", "baz"))
+
+        # the unknown action waits for 1, 3 waits for the unknown one
+        assert self.ad.start_actions() == 1
+        assert list(self.ad.workers.keys()) == [1]
+
+        del self.ad.workers[1]
+        assert self.ad.start_actions() == 1
+        assert list(self.ad.workers.keys()) == [2]
+
+        del self.ad.workers[2]
+        assert self.ad.start_actions() == 1
+        assert list(self.ad.workers.keys()) == [3]
+
+    def test_clean_finished_workers(self):
+        self.ad.workers = {1: MagicMock(), 2: MagicMock()}
+        self.ad.workers[1].is_alive.return_value = False
+        self.ad.workers[2].is_alive.return_value = True
+        self.ad.clean_finished_workers()
+        assert list(self.ad.workers.keys()) == [2]
+
+    def test_metrics(self):
+        self.fetch(createrepo_task(1, "foo", "bar"))
+        action = self.ad.queue[0][0]
+        action.run = MagicMock()
+
+        with mock.patch("{}.time".format(MODULE_REF)) as mc_time:
+            mc_time.time.side_effect = [1002, 1005]
+            ActionWorker(self.opts, action, queued_on=1000).run()
+            mc_time.time.side_effect = [1004, 1005]
+            ActionWorker(self.opts, action, queued_on=1000).run()
+        assert action.run.call_count == 2
+
+        self.ad.report_metrics()
+        metrics = self.ad.get_metrics()
+        assert metrics["queued"] == 1
+        assert metrics["running"] == 0
+        createrepo_metrics = metrics["types"]["createrepo"]
+        assert createrepo_metrics["count"] == 2
+        assert createrepo_metrics["mean_wait_seconds"] == 3
+        assert createrepo_metrics["mean_run_seconds"] == 2
@@ -92,6 +92,11 @@ class TestBackend(object):
             sleeptime=1,
             frontend_base_url="http://example.com",
             frontend_auth="foobar",
+            frontend_pool_size=10,
+            frontend_retries=3,
+            frontend_timeout=60,
+            frontend_backoff_max=30,
+            frontend_update_batching=False,
 
             log_dir=self.tmp_dir_path,
             log_level="info",
@@ -0,0 +1,184 @@
+# coding: utf-8
+
+from munch import Munch
+from requests import RequestException
+import pytest
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from backend.daemons.build_dispatcher import BuildDispatcher
+from backend.exceptions import NoVmAvailable
+from backend.job import BuildJob
+
+MODULE_REF = "backend.daemons.build_dispatcher"
+
+
+@pytest.yield_fixture
+def mc_time():
+    with mock.patch("{}.time".format(MODULE_REF)) as handle:
+        handle.time.return_value = 1000
+        yield handle
+
+
+@pytest.yield_fixture
+def mc_sleep_for():
+    with mock.patch("{}.sleep_for".format(MODULE_REF)) as handle:
+        yield handle
+
+
+class TestBuildDispatcher(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            frontend_base_url="http://example.com",
+            frontend_auth="12345678",
+            frontend_pool_size=10,
+            frontend_retries=3,
+            frontend_timeout=60,
+            frontend_backoff_max=30,
+            frontend_update_batching=False,
+            redis_host="127.0.0.1",
+            redis_port=7777,
+            redis_db=0,
+            sleeptime=1,
+            build_prefetch_count=2,
+            build_lease_seconds=300,
+            build_groups=[
+                {"id": 0, "name": "PC", "archs": ["x86_64", "i386"], "max_vm_per_user": 4},
+                {"id": 1, "name": "ARM", "archs": ["armhfp"], "max_vm_per_user": 2},
+            ],
+            destdir="/tmp",
+            results_baseurl="http://example.com/results",
+            timeout=1800,
+        )
+        with mock.patch("{}.get_redis_logger".format(MODULE_REF)), \
+                mock.patch("{}.VmManager".format(MODULE_REF)):
+            self.bd = BuildDispatcher(self.opts)
+        self.bd.frontend_client = MagicMock()
+        self.bd.update_process_title = MagicMock()
+
+        task_base = {"repos": "", "project_owner": "foo", "project_name": "bar"}
+        self.tasks = [
+            dict(task_base, task_id="1-fedora-24-x86_64", build_id=1, chroot="fedora-24-x86_64"),
+            dict(task_base, task_id="2-fedora-24-armhfp", build_id=2, chroot="fedora-24-armhfp"),
+        ]
+
+    def test_fetch_jobs(self, mc_time):
+        self.bd.frontend_client.lease_build_tasks.return_value = self.tasks
+        assert self.bd.fetch_jobs() == 2
+        assert self.bd.frontend_client.lease_build_tasks.call_args == \
+            mock.call(["armhfp", "i386", "x86_64"], 2, 300, wait=1)
+        assert [job.task_id for job, _ in self.bd.job_queue] == \
+            ["1-fedora-24-x86_64", "2-fedora-24-armhfp"]
+        assert all(deadline == 1300 for _, deadline in self.bd.job_queue)
+
+    def test_load_job_uses_local_queue(self, mc_time):
+        self.bd.frontend_client.lease_build_tasks.return_value = self.tasks
+        assert self.bd.load_job().task_id == "1-fedora-24-x86_64"
+        assert self.bd.load_job().task_id == "2-fedora-24-armhfp"
+        assert self.bd.frontend_client.lease_build_tasks.call_count == 1
+        assert not mc_time.sleep.called
+
+    def test_load_job_drops_expired_leases(self, mc_time):
+        self.bd.frontend_client.lease_build_tasks.side_effect = [self.tasks, self.tasks[1:]]
+        self.bd.fetch_jobs()
+        mc_time.time.return_value = 1301
+        assert self.bd.load_job().task_id == "2-fedora-24-armhfp"
+        assert not self.bd.job_queue
+
+    def test_load_job_polls_waiting(self, mc_time, mc_sleep_for):
+        self.opts.build_prefetch_count = 0
+        self.bd.frontend_client.waiting.side_effect = [
+            {"build": None}, RequestException(), {"build": self.tasks[0]}]
+        assert self.bd.load_job().task_id == "1-fedora-24-x86_64"
+        assert self.bd.frontend_client.waiting.call_args == \
+            mock.call(wait=1, wait_for=["build"])
+        # long-poll already waited, sleep just the rest of the period
+        assert mc_sleep_for.call_args_list == [mock.call(1, 1000)]
+        # full sleep after error
+        assert mc_time.sleep.call_count == 1
+
+    def test_load_job_waits_for_tasks(self, mc_time, mc_sleep_for):
+        self.bd.frontend_client.lease_build_tasks.side_effect = [[], self.tasks[:1]]
+        assert self.bd.load_job().task_id == "1-fedora-24-x86_64"
+        assert mc_sleep_for.call_count == 1
+        assert not mc_time.sleep.called
+
+    def job(self, task_id, owner="foo"):
+        build_id, chroot = task_id.split("-", 1)
+        return BuildJob(dict(self.tasks[0], task_id=task_id, build_id=int(build_id),
+                             chroot=chroot, project_owner=owner), self.opts)
+
+    def test_acquire_vm_holds_job(self, mc_time):
+        self.bd.vm_manager.acquire_vm.side_effect = NoVmAvailable("no VM")
+        self.bd.vm_manager.can_user_acquire_more_vm.return_value = True
+        self.bd.lease_deadline = 1300
+        job = self.job("1-fedora-24-x86_64")
+        assert self.bd.acquire_vm(job) is None
+        assert list(self.bd.held_jobs[0]) == [(job, 1300)]
+        assert not self.bd.frontend_client.defer_build.called
+
+        # no VM was released in the group yet
+        other = self.job("3-fedora-24-i386")
+        assert self.bd.acquire_vm(other) is None
+        assert self.bd.vm_manager.acquire_vm.call_count == 1
+        assert len(self.bd.held_jobs[0]) == 2
+        assert self.bd.pop_held_job() is None
+
+        # without subscription nothing is released
+        self.bd.read_vm_release_events()
+        assert self.bd.pop_held_job() is None
+        self.bd.vm_release_events = MagicMock()
+        self.bd.vm_release_events.get_message.side_effect = [{"type": "message", "data": "0"}, None]
+        self.bd.read_vm_release_events()
+        self.bd.vm_manager.get_vm_in_use_counts.return_value = {}
+        assert self.bd.pop_held_job() == (job, 1300)
+
+    def test_acquire_vm_defers_without_prefetch(self, mc_time):
+        self.opts.build_prefetch_count = 0
+        self.bd.vm_manager.acquire_vm.side_effect = NoVmAvailable("no VM")
+        assert self.bd.acquire_vm(self.job("1-fedora-24-x86_64")) is None
+        assert self.bd.frontend_client.defer_build.call_args == mock.call(1, "fedora-24-x86_64")
+        assert not self.bd.has_held_jobs()
+
+    def test_pop_held_job_fair(self, mc_time):
+        jobs = [self.job("1-fedora-24-x86_64", "foo"), self.job("2-fedora-24-x86_64", "foo"),
+                self.job("3-fedora-24-x86_64", "bar"), self.job("4-fedora-24-x86_64", "baz"),
+                self.job("5-fedora-24-x86_64", "bar")]
+        for job in jobs:
+            self.bd.hold_job(job, 0, 1300, group_full=False)
+        self.bd.vm_manager.get_vm_in_use_counts.return_value = {"foo": 1, "bar": 1, "baz": 4}
+
+        assert self.bd.pop_held_job()[0] is jobs[0]
+        self.bd.vm_manager.get_vm_in_use_counts.return_value = {"foo": 2, "bar": 1, "baz": 4}
+        assert self.bd.pop_held_job()[0] is jobs[2]
+        # baz reached max_vm_per_user
+        self.bd.vm_manager.get_vm_in_use_counts.return_value = {"foo": 2, "bar": 2, "baz": 4}
+        assert self.bd.pop_held_job()[0] is jobs[1]
+        assert self.bd.pop_held_job()[0] is jobs[4]
+        self.bd.vm_manager.get_vm_in_use_counts.return_value = {"baz": 4}
+        assert self.bd.pop_held_job() is None
+
+        mc_time.time.return_value = 1300
+        assert self.bd.pop_held_job() is None
+        assert not self.bd.has_held_jobs()
+
+    def test_fetch_jobs_skips_groups_with_full_holding_queue(self, mc_time):
+        for idx in range(self.opts.build_prefetch_count):
+            self.bd.hold_job(self.job("{}-fedora-24-x86_64".format(idx)), 0, 1300, group_full=True)
+        self.bd.frontend_client.lease_build_tasks.return_value = self.tasks[1:]
+        assert self.bd.fetch_jobs() == 1
+        assert self.bd.frontend_client.lease_build_tasks.call_args == \
+            mock.call(["armhfp"], 2, 300, wait=0)
+
+        self.bd.hold_job(self.job("9-fedora-24-armhfp"), 1, 1300, group_full=True)
+        self.bd.hold_job(self.job("10-fedora-24-armhfp"), 1, 1300, group_full=True)
+        assert self.bd.fetch_jobs() == 0
+        assert self.bd.frontend_client.lease_build_tasks.call_count == 1
@@ -0,0 +1,140 @@
+# coding: utf-8
+
+import json
+
+from munch import Munch
+from requests import RequestException
+import pytest
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from backend.constants import FRONTEND_UPDATES_REDIS_KEY, FRONTEND_UPDATES_DEAD_REDIS_KEY
+from backend.daemons.update_flusher import UpdateFlusher
+
+MODULE_REF = "backend.daemons.update_flusher"
+
+"""
+REQUIRES RUNNING REDIS
+"""
+
+
+class TestUpdateFlusher(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            frontend_base_url="http://example.com",
+            frontend_auth="12345678",
+            frontend_pool_size=10,
+            frontend_retries=3,
+            frontend_timeout=60,
+            frontend_backoff_max=30,
+            frontend_update_batching=True,
+            frontend_update_flush_period=0.3,
+            frontend_update_batch_size=3,
+            frontend_update_max_failures=2,
+        )
+        with mock.patch("{}.get_redis_logger".format(MODULE_REF)):
+            self.flusher = UpdateFlusher(self.opts)
+        self.flusher.frontend_client.post_update = MagicMock()
+        self.rc = self.flusher.rc
+        self.rc.delete(FRONTEND_UPDATES_REDIS_KEY, FRONTEND_UPDATES_DEAD_REDIS_KEY)
+
+    def teardown_method(self, method):
+        self.rc.delete(FRONTEND_UPDATES_REDIS_KEY, FRONTEND_UPDATES_DEAD_REDIS_KEY)
+
+    def queue(self, *updates):
+        for update in updates:
+            self.rc.rpush(FRONTEND_UPDATES_REDIS_KEY, json.dumps(update))
+
+    def test_flush_empty(self):
+        assert self.flusher.flush() == 0
+        assert not self.flusher.frontend_client.post_update.called
+
+    def test_flush_batches_in_order(self):
+        self.queue(
+            {"builds": [{"id": 1, "chroot": "fedora-24-x86_64", "status": 3}]},
+            {"actions": [{"id": 7, "result": 1}]},
+            {"builds": [{"id": 1, "chroot": "fedora-24-x86_64", "status": 1}]},
+            {"builds": [{"id": 2, "chroot": "fedora-24-x86_64", "status": 3}]},
+        )
+        assert self.flusher.flush() == 3
+        assert self.flusher.frontend_client.post_update.call_args == mock.call({
+            "builds": [
+                {"id": 1, "chroot": "fedora-24-x86_64", "status": 3},
+                {"id": 1, "chroot": "fedora-24-x86_64", "status": 1},
+            ],
+            "actions": [{"id": 7, "result": 1}],
+        })
+        assert self.rc.llen(FRONTEND_UPDATES_REDIS_KEY) == 1
+
+        self.flusher.flush_all()
+        assert self.flusher.frontend_client.post_update.call_args == mock.call({
+            "builds": [{"id": 2, "chroot": "fedora-24-x86_64", "status": 3}],
+        })
+        assert self.rc.llen(FRONTEND_UPDATES_REDIS_KEY) == 0
+
+    def test_flush_keeps_updates_on_failure(self):
+        self.queue({"builds": [{"id": 1}]}, {"builds": [{"id": 2}]})
+        self.flusher.frontend_client.post_update.side_effect = RequestException()
+
+        with pytest.raises(RequestException):
+            self.flusher.flush()
+        assert self.rc.llen(FRONTEND_UPDATES_REDIS_KEY) == 2
+
+        self.flusher.frontend_client.post_update.side_effect = None
+        assert self.flusher.flush() == 2
+        assert self.flusher.frontend_client.post_update.call_args == \
+            mock.call({"builds": [{"id": 1}, {"id": 2}]})
+
+    def test_flush_moves_refused_update_aside(self):
+        self.queue({"builds": [{"id": 1}]}, {"builds": [{"id": 2}]}, {"builds": [{"id": 3}]})
+        sent = []
+
+        def post_update(data, max_repeats=10):
+            if {"id": 2} in data["builds"]:
+                raise RequestException(response=MagicMock(status_code=500))
+            sent.append(data)
+
+        self.flusher.frontend_client.post_update.side_effect = post_update
+
+        # the batch is refused, updates before the bad one get through
+        with pytest.raises(RequestException):
+            self.flusher.flush()
+        assert sent == [{"builds": [{"id": 1}]}]
+        assert self.rc.llen(FRONTEND_UPDATES_REDIS_KEY) == 2
+
+        # refused again, moved aside, the rest is sent
+        assert self.flusher.flush() == 2
+        assert sent[1:] == [{"builds": [{"id": 3}]}]
+        assert self.rc.llen(FRONTEND_UPDATES_REDIS_KEY) == 0
+        assert [json.loads(raw) for raw in self.rc.lrange(FRONTEND_UPDATES_DEAD_REDIS_KEY, 0, -1)] == \
+            [{"builds": [{"id": 2}]}]
+
+    def test_flush_keeps_updates_when_frontend_unavailable(self):
+        self.queue({"builds": [{"id": 1}]}, {"builds": [{"id": 2}]})
+        self.flusher.frontend_client.post_update.side_effect = \
+            RequestException(response=MagicMock(status_code=503))
+
+        for _ in range(3):
+            with pytest.raises(RequestException):
+                self.flusher.flush()
+        assert self.rc.llen(FRONTEND_UPDATES_REDIS_KEY) == 2
+        assert self.rc.llen(FRONTEND_UPDATES_DEAD_REDIS_KEY) == 0
+
+    def test_flush_drops_malformed(self):
+        self.rc.rpush(FRONTEND_UPDATES_REDIS_KEY, "{not a json")
+        self.queue({"builds": [{"id": 1}]})
+
+        assert self.flusher.flush() == 2
+        assert self.flusher.frontend_client.post_update.call_args == \
+            mock.call({"builds": [{"id": 1}]})
+        assert self.rc.llen(FRONTEND_UPDATES_REDIS_KEY) == 0
@@ -22,10 +22,9 @@ import os
 
 import six
 from backend.helpers import get_redis_connection
-from backend.vm_manage import VmStates
+from backend.vm_manage import VmStates, KEY_VM_LEASE
 from backend.vm_manage.manager import VmManager
 from backend.daemons.vm_master import VmMaster
-from backend.constants import JOB_GRAB_TASK_END_PUBSUB
 from backend.exceptions import VmError, VmSpawnLimitReached
 
 
@@ -112,8 +111,11 @@ class TestVmMaster(object):
             fedmsg_enabled=False,
             sleeptime=0.1,
             vm_cycle_timeout=10,
-
-
+            vm_lease_seconds=120,
+            vm_health_check_batch_size=2,
+            spawn_planner=False,
+            spawn_planner_window=600,
+            spawn_planner_lead_time=300,
         )
 
         self.queue = Queue()
@@ -130,6 +132,7 @@ class TestVmMaster(object):
         self.callback = TestCallback()
         # checker = HealthChecker(self.opts, self.callback)
         self.checker = MagicMock()
+        self.checker.is_running.return_value = False
         self.spawner = MagicMock()
         self.terminator = MagicMock()
 
@@ -210,66 +213,32 @@ class TestVmMaster(object):
                                in self.vmm.start_vm_termination.call_args_list])
         assert set(["a1", "b1"]) == terminated_names
 
-    def disabled_test_remove_vm_with_dead_builder(self, mc_time, add_vmd, mc_psutil):
-        # todo: re-enable after psutil.Process.cmdline will be in use
-        mc_time.time.return_value = time.time()
+    def test_remove_vm_with_dead_builder(self, mc_time, add_vmd):
+        mc_time.time.return_value = 1000
         self.vm_master.log = MagicMock()
 
         self.vmm.start_vm_termination = MagicMock()
         self.vmm.start_vm_termination.return_value = "OK"
 
-        for idx, vmd in enumerate([self.vmd_a1, self.vmd_a2,
-                                   self.vmd_b1, self.vmd_b2, self.vmd_b3]):
+        for vmd in [self.vmd_a1, self.vmd_a2, self.vmd_b1, self.vmd_b2]:
             vmd.store_field(self.rc, "state", VmStates.IN_USE)
-            vmd.store_field(self.rc, "chroot", "fedora-20-x86_64")
-            vmd.store_field(self.rc, "task_id", "{}-fedora-20-x86_64".format(idx + 1))
-            vmd.store_field(self.rc, "build_id", idx + 1)
             vmd.store_field(self.rc, "in_use_since", 0)
+        self.vmd_a3.store_field(self.rc, "state", VmStates.READY)
 
-        self.rc.hdel(self.vmd_b3.vm_key, "chroot")
-
-        for idx, vmd in enumerate([self.vmd_a1, self.vmd_a2, self.vmd_b2, self.vmd_b3]):
-            vmd.store_field(self.rc, "used_by_pid", idx + 1)
-
-        for vmd in [self.vmd_a3, self.vmd_a3]:
-            vmd.store_field(self.rc, "state", VmStates.READY)
+        # a1 has a live worker, b2 was acquired just now (e.g. before the upgrade)
+        self.rc.set(KEY_VM_LEASE.format(vm_name="a1"), "host:1", ex=60)
+        self.vmd_b2.store_field(self.rc, "in_use_since", 1000 - 10)
 
-        def mc_psutil_process(pid):
-            p = MagicMock()
-            mapping = {
-                "1": "a1",
-                "2": "a2",
-                "3": "b1",
-                "4": "None",
-                "5": "None",
-            }
-            p.cmdline = ["builder vm_name={} suffix".format(mapping.get(str(pid))),]
-            return p
-
-        def mc_psutil_pid_exists(pid):
-            if str(pid) in ["1", "4"]:
-                return True
-
-            return False
-
-        mc_psutil.Process.side_effect = mc_psutil_process
-        mc_psutil.pid_exists.side_effect = mc_psutil_pid_exists
-
-        self.ps = self.vmm.rc.pubsub(ignore_subscribe_messages=True)
-        self.ps.subscribe(JOB_GRAB_TASK_END_PUBSUB)
         self.vm_master.remove_vm_with_dead_builder()
-
-        msg_list = self.rcv_from_ps_message_bus()
-        assert self.vmm.start_vm_termination.call_args_list == [
-            mock.call('a2', allowed_pre_state='in_use'),
-            mock.call('b2', allowed_pre_state='in_use'),
-            mock.call('b3', allowed_pre_state='in_use')
-        ]
-        # changed logic for the moment
-        # assert set(["2", "4"]) == set([json.loads(m["data"])["build_id"] for m in msg_list])
+        terminated = [call[0][0] for call in self.vmm.start_vm_termination.call_args_list]
+        assert sorted(terminated) == ["a2", "b1"]
+        assert all(call[1] == {"allowed_pre_state": "in_use"}
+                   for call in self.vmm.start_vm_termination.call_args_list)
+        # no sleeping to double check
+        assert not mc_time.sleep.called
 
     def test_check_vms_health(self, mc_time, add_vmd):
-        self.vm_master.start_vm_check = types.MethodType(MagicMock(), self.vmm)
+        self.vm_master.start_vm_checks = types.MethodType(MagicMock(), self.vmm)
         for vmd in [self.vmd_a1, self.vmd_a2, self.vmd_a3, self.vmd_b1, self.vmd_b2, self.vmd_b3]:
             vmd.store_field(self.rc, "last_health_check", 0)
 
@@ -282,21 +251,39 @@ class TestVmMaster(object):
 
         mc_time.time.return_value = 1
         self.vm_master.check_vms_health()
-        assert not self.vm_master.start_vm_check.called
+        assert not self.vm_master.start_vm_checks.called
 
         mc_time.time.return_value = 1 + self.opts.build_groups[0]["vm_health_check_period"]
         self.vm_master.check_vms_health()
-        to_check = set(call[0][1] for call in self.vm_master.start_vm_check.call_args_list)
+        # all VMs due for a check are handed over at once
+        assert self.vm_master.start_vm_checks.call_count == 1
+        to_check = set(self.vm_master.start_vm_checks.call_args[0][1])
         assert set(['a1', 'a3', 'b1', 'b2']) == to_check
 
-        self.vm_master.start_vm_check.reset_mock()
+        self.vm_master.start_vm_checks.reset_mock()
         for vmd in [self.vmd_a1, self.vmd_a2, self.vmd_a3, self.vmd_b1, self.vmd_b2, self.vmd_b3]:
             self.rc.hdel(vmd.vm_key, "last_health_check")
 
         self.vm_master.check_vms_health()
-        to_check = set(call[0][1] for call in self.vm_master.start_vm_check.call_args_list)
+        to_check = set(self.vm_master.start_vm_checks.call_args[0][1])
         assert set(['a1', 'a3', 'b1', 'b2']) == to_check
 
+    def test_check_vms_health_one_batch_at_a_time(self, mc_time, add_vmd):
+        self.vm_master.start_vm_checks = types.MethodType(MagicMock(), self.vmm)
+        for vmd, last_check in [(self.vmd_a1, 30), (self.vmd_b1, 10), (self.vmd_b2, 20)]:
+            vmd.store_field(self.rc, "state", VmStates.READY)
+            vmd.store_field(self.rc, "last_health_check", last_check)
+        mc_time.time.return_value = 1000
+
+        # VMs waiting longest for a check go first, the never checked ones before all
+        self.vm_master.check_vms_health()
+        assert self.vm_master.start_vm_checks.call_args[0][1] == ["a2", "a3", "b3", "b1", "b2", "a1"]
+
+        self.vm_master.start_vm_checks.reset_mock()
+        self.checker.is_running.return_value = True
+        self.vm_master.check_vms_health()
+        assert not self.vm_master.start_vm_checks.called
+
     def test_finalize_long_health_checks(self, mc_time, add_vmd):
 
         mc_time.time.return_value = 0
@@ -422,9 +409,53 @@ class TestVmMaster(object):
         self.vm_master.try_spawn_one = MagicMock()
         self.vm_master.start_spawn_if_required()
         assert self.vm_master.try_spawn_one.call_args_list == [
-            mock.call(group) for group in range(self.opts.build_groups_count)
+            mock.call(group, None) for group in range(self.opts.build_groups_count)
         ]
 
+    def test_start_spawn_if_required_planner(self, mc_time):
+        mc_time.time.return_value = 1000
+        self.opts.spawn_planner = True
+        self.opts.build_groups[0].update(vm_idle_reserve=0)
+        self.vm_master.try_spawn_one = MagicMock()
+        self.vm_master.frontend_client = MagicMock()
+        self.vm_master.frontend_client.pending_build_counts.return_value = {
+            "pending": {"x86_64": 3}, "arrived": {}, "window": 600}
+        self.vm_master.spawner.get_proc_num_per_group.return_value = 0
+        self.vm_master.apply_spawn_plan = MagicMock()
+
+        self.vm_master.start_spawn_if_required()
+        assert not self.vm_master.try_spawn_one.called
+        assert [call[0][0] for call in self.vm_master.apply_spawn_plan.call_args_list] == [0, 1]
+
+        # frontend not available, one VM per cycle as without the planner
+        self.vm_master.frontend_client.pending_build_counts.side_effect = IOError()
+        self.vm_master.start_spawn_if_required()
+        assert self.vm_master.try_spawn_one.call_count == 2
+
+    def test_apply_spawn_plan(self, mc_time):
+        mc_time.time.return_value = 1000
+        self.opts.build_groups[0].update(vm_idle_reserve=0)
+        self.vm_master.spawner.get_proc_num_per_group.return_value = 0
+        counts = {"pending": {"x86_64": 3}, "arrived": {}, "window": 600}
+
+        self.vmm.add_vm_to_pool(self.vm_ip, "vm_ready", 0)
+        self.vmm.get_vm_by_name("vm_ready").store_field(self.rc, "state", VmStates.READY)
+        self.vm_master.apply_spawn_plan(0, counts)
+        assert self.vm_master.spawner.start_spawn.call_args_list == [mock.call(0), mock.call(0)]
+        assert self.vmm.read_vm_pool_info(0, "last_vm_spawn_start")
+
+        # nothing is queued, the clean VM is terminated, the dirty one is kept
+        self.vm_master.spawner.start_spawn.reset_mock()
+        self.vmm.add_vm_to_pool("127.0.0.2", "vm_dirty", 0)
+        vmd_dirty = self.vmm.get_vm_by_name("vm_dirty")
+        vmd_dirty.store_field(self.rc, "state", VmStates.READY)
+        vmd_dirty.store_field(self.rc, "bound_to_user", self.username)
+        self.vmm.start_vm_termination = MagicMock()
+        self.vm_master.apply_spawn_plan(0, dict(counts, pending={}))
+        assert not self.vm_master.spawner.start_spawn.called
+        assert self.vmm.start_vm_termination.call_args_list == [
+            mock.call("vm_ready", allowed_pre_state=VmStates.READY)]
+
     def test__check_total_running_vm_limit_raises(self):
         self.vm_master.log = MagicMock()
         active_vm_states = [VmStates.GOT_IP, VmStates.READY, VmStates.IN_USE, VmStates.CHECK_HEALTH]
@@ -566,22 +597,43 @@ class TestVmMaster(object):
         # can start, no problem to start
         # > can start IN_USE, don't change status
         vmd.store_field(self.rc, "state", VmStates.IN_USE)
-        self.vm_master.start_vm_check(vm_name=self.vm_name)
+        self.vm_master.start_vm_checks([self.vm_name])
 
-        assert self.checker.run_check_health.called
-        self.checker.run_check_health.reset_mock()
+        assert self.checker.run_check_health_batch.called
+        self.checker.run_check_health_batch.reset_mock()
         assert vmd.get_field(self.rc, "state") == VmStates.IN_USE
 
         # > changes status to HEALTH_CHECK
         states = [VmStates.GOT_IP, VmStates.CHECK_HEALTH_FAILED, VmStates.READY]
         for state in states:
             vmd.store_field(self.rc, "state", state)
-            self.vm_master.start_vm_check(vm_name=self.vm_name)
+            self.vm_master.start_vm_checks([self.vm_name])
 
-            assert self.checker.run_check_health.called
-            self.checker.run_check_health.reset_mock()
+            assert self.checker.run_check_health_batch.called
+            self.checker.run_check_health_batch.reset_mock()
             assert vmd.get_field(self.rc, "state") == VmStates.CHECK_HEALTH
 
+    def test_start_vm_checks_batch(self):
+        self.vmm.add_vm_to_pool(self.vm_ip, "vm_ready", self.group)
+        self.vmm.add_vm_to_pool("127.0.0.2", "vm_terminating", self.group)
+        self.vmm.get_vm_by_name("vm_ready").store_field(self.rc, "state", VmStates.READY)
+        self.vmm.get_vm_by_name("vm_terminating").store_field(self.rc, "state", VmStates.TERMINATING)
+
+        assert self.vm_master.start_vm_checks(["vm_ready", "vm_terminating"]) == 1
+        assert self.checker.run_check_health_batch.call_args == mock.call([("vm_ready", self.vm_ip)])
+        assert self.vmm.get_vm_by_name("vm_ready").state == VmStates.CHECK_HEALTH
+
+    def test_start_vm_checks_batch_size(self):
+        for idx in range(3):
+            self.vmm.add_vm_to_pool("127.0.0.{}".format(idx), "vm_{}".format(idx), self.group)
+            self.vmm.get_vm_by_name("vm_{}".format(idx)).store_field(self.rc, "state", VmStates.READY)
+
+        assert self.vm_master.start_vm_checks(["vm_0", "vm_1", "vm_2"]) == 2
+        assert self.checker.run_check_health_batch.call_args == \
+            mock.call([("vm_0", "127.0.0.0"), ("vm_1", "127.0.0.1")])
+        # the last one stays usable until it is checked in a later cycle
+        assert self.vmm.get_vm_by_name("vm_2").state == VmStates.READY
+
     def test_start_vm_check_wrong_old_state(self):
         self.vmm.start_vm_termination = types.MethodType(MagicMock(), self.vmm)
         self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
@@ -590,9 +642,9 @@ class TestVmMaster(object):
         states = [VmStates.TERMINATING, VmStates.CHECK_HEALTH]
         for state in states:
             vmd.store_field(self.rc, "state", state)
-            assert not self.vm_master.start_vm_check(vm_name=self.vm_name)
+            assert self.vm_master.start_vm_checks([self.vm_name]) == 0
 
-            assert not self.checker.run_check_health.called
+            assert not self.checker.run_check_health_batch.called
             assert vmd.get_field(self.rc, "state") == state
 
     def test_start_vm_check_lua_ok_check_spawn_failed(self):
@@ -600,14 +652,14 @@ class TestVmMaster(object):
         self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
         vmd = self.vmm.get_vm_by_name(self.vm_name)
 
-        self.vm_master.checker.run_check_health.side_effect = RuntimeError()
+        self.vm_master.checker.run_check_health_batch.side_effect = RuntimeError()
 
         # restore orig state
         states = [VmStates.GOT_IP, VmStates.CHECK_HEALTH_FAILED, VmStates.READY, VmStates.IN_USE]
         for state in states:
             vmd.store_field(self.rc, "state", state)
-            self.vm_master.start_vm_check(vm_name=self.vm_name)
+            self.vm_master.start_vm_checks([self.vm_name])
 
-            assert self.checker.run_check_health.called
-            self.checker.run_check_health.reset_mock()
+            assert self.checker.run_check_health_batch.called
+            self.checker.run_check_health_batch.reset_mock()
             assert vmd.get_field(self.rc, "state") == state
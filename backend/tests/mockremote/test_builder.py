@@ -1,5 +1,7 @@
 # coding: utf-8
 import copy
+import json
+import base64
 
 from collections import defaultdict
 from pprint import pprint
@@ -87,6 +89,9 @@ class TestBuilder(object):
         remote_basedir=BUILDER_REMOTE_BASEDIR,
         remote_tempdir=BUILDER_REMOTE_TMPDIR,
         results_baseurl="http://example.com",
+        dist_git_url="http://example.com/git",
+        dist_git_cache_dir="/var/tmp/copr-dist-git-cache",
+        incremental_rsync_period=0,
 
         redis_db=9,
         redis_port=7777,
@@ -142,6 +147,15 @@ class TestBuilder(object):
         self.stage = 0
         self.stage_ctx = defaultdict(dict)
 
+    def get_waiting_builder(self, wait_session=None):
+        builder = self.get_test_builder()
+        builder.setup_pubsub_handler = MagicMock()
+        builder.ps = MagicMock()
+        builder.ps.get_message.return_value = None
+        builder.start_wait_session = MagicMock(return_value=wait_session)
+        builder.cancel_build = MagicMock()
+        return builder
+
     @property
     def buildcmd(self):
         return self.gen_mockchain_command(self.BUILDER_PKG)
@@ -327,76 +341,74 @@ class TestBuilder(object):
                 builder.hostname = name
                 builder.check()
 
-    def test_check_missing_required_binaries(self, mc_socket):
+    def test_check_no_remote_calls(self, mc_socket):
         builder = self.get_test_builder()
-        self.stage = 0
-
-        def ans_run():
-            self.stage_ctx[self.stage]["conn"] = copy.deepcopy(builder.conn)
-            ret_map = {
-                0: {"contacted": {self.BUILDER_HOSTNAME: {"rc": 1, }}},
-                1: {"contacted": {self.BUILDER_HOSTNAME: {"rc": 0, }}}
-            }
-            self.stage += 1
-            return ret_map[self.stage - 1]
-
-        builder.conn.run.side_effect = ans_run
-        with pytest.raises(BuilderError) as err:
-            builder.check()
-
-        # import ipdb; ipdb.set_trace()
-        # pprint(self.stage_ctx)
-        assert "/bin/rpm -q mock rsync" in self.stage_ctx[0]["conn"].module_args
-
-        assert "does not have mock or rsync installed" in err.value.msg
+        builder.check()
+        assert not builder.conn.run.called
 
-    def test_check_missing_mockchain_or_mock_config(self, mc_socket):
+    def get_prepared_builder(self, prepared):
         builder = self.get_test_builder()
+        builder.conn.run.return_value = {
+            "contacted": {self.BUILDER_HOSTNAME: {"rc": 0, "stdout": json.dumps(prepared)}},
+            "dark": {},
+        }
+        return builder
 
-        def ans_run():
-            self.stage_ctx[self.stage]["conn"] = copy.deepcopy(builder.conn)
-            ret_map = {
-                0: {"contacted": {self.BUILDER_HOSTNAME: {"rc": 0, }}},
-                1: {"contacted": {self.BUILDER_HOSTNAME: {"rc": 1, }}}
-            }
-            self.stage += 1
-            return ret_map[self.stage - 1]
-
-        builder.conn.run.side_effect = ans_run
+    def test_prepare_build(self):
+        builder = self.get_prepared_builder({
+            "tempdir": "/tmp/mockremote-xyz",
+            "srpm_path": "/tmp/build_package_repo/foo/foo-1.0-1.src.rpm",
+            "phases": {"check": 0.1, "config": 0.1, "srpm": 2},
+        })
+        builder.buildroot_pkgs = "bar"
+
+        prepared = builder.prepare_build()
+        assert "total" in prepared["phases"]
+        assert builder.tempdir == "/tmp/mockremote-xyz"
+        assert builder.remote_pkg_name == "foo-1.0-1"
+
+        # everything is done by one call of the script
+        assert builder.conn.run.call_count == 1
+        assert builder.conn.module_name == "script"
+        script, encoded_params = builder.conn.module_args.split(" ")
+        assert script.endswith("prepare_build.py")
+        params = json.loads(base64.b64decode(encoded_params).decode("utf-8"))
+        assert params["chroot"] == self.BUILDER_CHROOT
+        assert params["tempdir"] == self.BUILDER_REMOTE_TMPDIR
+        assert params["dist_git"]["git_hash"] == self.GIT_HASH
+        assert params["dist_git"]["repo_url"].endswith("{}.git".format(self.job.git_repo))
+        assert params["dist_git"]["cache_dir"] == self.opts.dist_git_cache_dir
+        assert {"line": "config_opts['chroot_setup_cmd'] = 'install \\1 bar'",
+                "regexp": "^.*chroot_setup_cmd.*(@buildsys-build|buildsys-build buildsys-macros).*$",
+                "backrefs": True} in params["config_edits"]
+
+    def prepare_build_error(self, error):
+        builder = self.get_prepared_builder({"error": error, "phases": {}})
         with pytest.raises(BuilderError) as err:
-            builder.check()
-
-        # pprint(self.stage_ctx)
-        assert "/usr/bin/test -f /usr/bin/mockchain" in self.stage_ctx[1]["conn"].module_args
-        # assert "/usr/bin/test -f /etc/mock/{}.cfg".format(self.BUILDER_CHROOT) in \
-        #        self.stage_ctx[1]["conn"].module_args
+            builder.prepare_build()
+        # the build is not started on a broken builder
+        assert builder.conn.run.call_count == 1
+        return err.value.msg
 
-        assert "missing mockchain binary" in err.value.msg
+    def test_prepare_build_missing_required_binaries(self):
+        assert "does not have mock or rsync installed" in self.prepare_build_error("missing_packages")
 
-    def test_check_missing_mock_config(self, mc_socket):
-        builder = self.get_test_builder()
-
-        ret_map = {
-            0: {"contacted": {self.BUILDER_HOSTNAME: {"rc": "0", }}},
-            1: {"contacted": {self.BUILDER_HOSTNAME: {"rc": "0", }}},
-            2: {"contacted": {self.BUILDER_HOSTNAME: {"failed": "fatal_2", }}}
-        }
-
-        def ans_run():
-            self.stage_ctx[self.stage]["conn"] = copy.deepcopy(builder.conn)
-            self.stage += 1
-            return ret_map[self.stage - 1]
+    def test_prepare_build_missing_mockchain(self):
+        msg = self.prepare_build_error("missing_mockchain")
+        assert "missing mockchain binary" in msg
+        assert "/usr/bin/mockchain" in msg
 
-        builder.conn.run.side_effect = ans_run
-        with pytest.raises(BuilderError) as err:
-            builder.check()
+    def test_prepare_build_missing_mock_config(self):
+        msg = self.prepare_build_error("missing_config")
+        assert "missing mock config for chroot `{}`".format(self.BUILDER_CHROOT) in msg
 
-        # pprint(self.stage_ctx)
-        assert "/usr/bin/test -f /usr/bin/mockchain" in self.stage_ctx[1]["conn"].module_args
-        assert "/usr/bin/test -f /etc/mock/{}.cfg".format(self.BUILDER_CHROOT) in \
-               self.stage_ctx[2]["conn"].module_args
+    def test_prepare_build_errors(self):
+        assert "Failed to obtain srpm from dist-git" in self.prepare_build_error("srpm_failed")
 
-        assert "missing mock config for chroot" in err.value.msg
+        builder = self.get_prepared_builder({})
+        builder.conn.run.return_value["contacted"][self.BUILDER_HOSTNAME]["stdout"] = "Traceback"
+        with pytest.raises(BuilderError):
+            builder.prepare_build()
 
     def test_tempdir_nop_when_provided(self):
         builder = self.get_test_builder()
@@ -617,7 +629,7 @@ class TestBuilder(object):
     @mock.patch("backend.mockremote.builder.time")
     def test_run_command_and_wait_timeout(self, mc_time):
         build_cmd = "foo bar"
-        builder = self.get_test_builder()
+        builder = self.get_waiting_builder()
 
         mc_poller = mock.MagicMock()
         mc_poller.poll.return_value = {"contacted": {}, "dark": {}}
@@ -632,7 +644,7 @@ class TestBuilder(object):
     @mock.patch("backend.mockremote.builder.time")
     def test_run_command_and_wait(self, mc_time):
         build_cmd = "foo bar"
-        builder = self.get_test_builder()
+        builder = self.get_waiting_builder()
 
         mc_poller = mock.MagicMock()
         builder.conn.run_async.return_value = None, mc_poller
@@ -679,6 +691,111 @@ class TestBuilder(object):
             #
             # assert mc_popen.call_args[0][0] == expected_arg
 
+    @mock.patch("backend.mockremote.builder.time")
+    def test_run_command_and_wait_downloads_results(self, mc_time):
+        builder = self.get_waiting_builder()
+        builder.opts = Munch(self.opts, incremental_rsync_period=20)
+        builder.download_results_during_build = MagicMock()
+
+        mc_poller = mock.MagicMock()
+        builder.conn.run_async.return_value = None, mc_poller
+        running = {"contacted": {}, "dark": {}}
+        mc_poller.poll.side_effect = [running] * 5 + [{"contacted": {self.BUILDER_HOSTNAME: True}, "dark": {}}]
+
+        builder.run_build_and_wait("foo bar")
+        # polled every 10 seconds, downloaded every 20 seconds
+        assert builder.download_results_during_build.call_args_list == \
+            [mock.call(self.job.results_dir)] * 2
+
+    def test_wrap_build_command(self):
+        builder = self.get_test_builder()
+        assert builder.wrap_build_command("foo bar") == (
+            "rm -f {0}/build.status; foo bar; rc=$?; echo $rc > {0}/build.status; exit $rc"
+            .format(self.BUILDER_REMOTE_TMPDIR))
+
+    @mock.patch("backend.mockremote.builder.time")
+    def test_run_command_and_wait_for_ssh_session(self, mc_time):
+        wait_session = MagicMock()
+        wait_session.poll.side_effect = [None, None, 0]
+        wait_session.returncode = 0
+        wait_session.communicate.return_value = "0\n", ""
+        builder = self.get_waiting_builder(wait_session)
+
+        mc_poller = mock.MagicMock()
+        builder.conn.run_async.return_value = None, mc_poller
+        expected_result = {"contacted": {self.BUILDER_HOSTNAME: True}, "dark": {}}
+        mc_poller.poll.return_value = expected_result
+
+        assert builder.run_build_and_wait("foo bar") == expected_result
+        assert "foo bar; rc=$?" in builder.conn.module_args
+        # ansible is asked only once the session returned
+        assert mc_poller.poll.call_count == 1
+        assert mc_time.sleep.call_args_list == [mock.call(1)] * 2
+        assert builder.ps.close.called
+
+    @mock.patch("backend.mockremote.builder.time")
+    def test_run_command_and_wait_lost_ssh_session(self, mc_time):
+        wait_session = MagicMock()
+        wait_session.poll.return_value = 255
+        wait_session.returncode = 255
+        wait_session.communicate.return_value = "", "Connection reset"
+        builder = self.get_waiting_builder(wait_session)
+
+        mc_poller = mock.MagicMock()
+        builder.conn.run_async.return_value = None, mc_poller
+        running = {"contacted": {}, "dark": {}}
+        mc_poller.poll.side_effect = [running] * 2 + [{"contacted": {self.BUILDER_HOSTNAME: True}, "dark": {}}]
+
+        builder.run_build_and_wait("foo bar")
+        assert mc_time.sleep.call_args_list == [mock.call(10)] * 2
+
+    @mock.patch("backend.mockremote.builder.time")
+    def test_run_command_and_wait_interrupted(self, mc_time):
+        wait_session = MagicMock()
+        wait_session.poll.return_value = None
+        builder = self.get_waiting_builder(wait_session)
+        builder.ps.get_message.side_effect = [None, {"type": "message", "data": "vm died"}]
+        builder.conn.run_async.return_value = None, MagicMock()
+
+        with pytest.raises(VmError):
+            builder.run_build_and_wait("foo bar")
+        assert builder.cancel_build.called
+        assert wait_session.kill.called
+
+    @mock.patch("backend.mockremote.builder.Popen")
+    def test_download_results_transfer_stats(self, mc_popen):
+        builder = self.get_test_builder()
+        target_dir = os.path.join(self.test_root_path, "results")
+        log_path = os.path.join(target_dir, self.job.rsync_log_name)
+
+        def rsync(stats_line):
+            def popen(command, shell):
+                assert ">> '{}'/{} 2>&1".format(target_dir, self.job.rsync_log_name) in command
+                with open(log_path, "a") as log_file:
+                    log_file.write("foo.rpm\n{}\n".format(stats_line))
+                return MagicMock(returncode=0)
+            return popen
+
+        mc_popen.side_effect = rsync("Total bytes received: 1,234,567")
+        builder.download_results_during_build(target_dir)
+        mc_popen.side_effect = rsync("Total bytes received: 1,000")
+        builder.download_results(target_dir)
+
+        assert builder.transfer_stats["bytes"] == 1235567
+        assert builder.transfer_stats["bytes_after_build"] == 1000
+
+    @mock.patch("backend.mockremote.builder.Popen")
+    def test_download_results_during_build_error(self, mc_popen):
+        builder = self.get_test_builder()
+        mc_popen.return_value.returncode = 23
+
+        # e.g. no results on builder yet, the build goes on
+        builder.download_results_during_build(self.test_root_path)
+        assert mc_popen.called
+
+        with pytest.raises(BuilderError):
+            builder.download_results(self.test_root_path)
+
     @mock.patch("backend.mockremote.builder.Popen")
     def test_download_popen_error(self, mc_popen):
         builder = self.get_test_builder()
@@ -690,8 +807,6 @@ class TestBuilder(object):
         builder = self.get_test_builder()
         builder.modify_mock_chroot_config = MagicMock()
         builder.check_if_pkg_local_or_http = MagicMock()
-        builder.download_job_pkg_to_builder = MagicMock()
-        builder.download_job_pkg_to_builder.return_value = "foobar"
         builder.check_if_pkg_local_or_http.return_value = self.BUILDER_PKG
 
         builder.run_build_and_wait = MagicMock()
@@ -87,6 +87,9 @@ class TestMockRemote(object):
             "do_sign": False,
             "results_baseurl": self.BASE_URL,
             "frontend_base_url": self.FRONT_URL,
+            "createrepo_incremental": True,
+            "createrepo_debounce": 0,
+            "createrepo_max_delay": 10,
         })
 
     def teardown_method(self, method):
@@ -146,6 +149,10 @@ class TestMockRemote(object):
             base_url=u"/".join([self.BASE_URL, COPR_OWNER, COPR_NAME, self.CHROOT]),
             username=COPR_OWNER,
             projectname=COPR_NAME,
+            pkgs=[self.JOB.target_dir_name],
+            debounce=0,
+            max_delay=10,
+            opts=self.OPTS,
         )
         assert mc_createrepo.call_args == expected_call
 
@@ -0,0 +1,182 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+
+from backend.mockremote import prepare_build
+from backend.mockremote.prepare_build import lineinfile, prepare, get_srpm
+
+import six
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+
+MOCK_CFG = """config_opts['root'] = 'fedora-20-i386'
+config_opts['chroot_setup_cmd'] = 'install @buildsys-build'
+config_opts['use_host_resolv'] = True
+"""
+
+
+class TestPrepareBuild(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cfg_path = os.path.join(self.tmp_dir, "fedora-20-i386.cfg")
+        with open(self.cfg_path, "w") as f:
+            f.write(MOCK_CFG)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_cfg(self):
+        with open(self.cfg_path) as f:
+            return f.read().splitlines()
+
+    def test_lineinfile_replace(self):
+        lineinfile(self.cfg_path, "^.*use_host_resolv.*$", "config_opts['use_host_resolv'] = False")
+        assert self.read_cfg()[2] == "config_opts['use_host_resolv'] = False"
+        assert len(self.read_cfg()) == 3
+
+    def test_lineinfile_backrefs(self):
+        lineinfile(self.cfg_path,
+                   "^.*chroot_setup_cmd.*(@buildsys-build|buildsys-build buildsys-macros).*$",
+                   "config_opts['chroot_setup_cmd'] = 'install \\1 foo'", backrefs=True)
+        assert self.read_cfg()[1] == "config_opts['chroot_setup_cmd'] = 'install @buildsys-build foo'"
+
+        # no match, nothing happens with backrefs
+        lineinfile(self.cfg_path, "^nomatch$", "foo", backrefs=True)
+        assert len(self.read_cfg()) == 3
+
+    def test_lineinfile_append(self):
+        line = "config_opts['macros']['%dist'] = '.foo'"
+        lineinfile(self.cfg_path, "^nomatch$", line)
+        lineinfile(self.cfg_path, "^nomatch$", line)
+        assert self.read_cfg()[3:] == [line]
+
+    def dist_git(self):
+        return {
+            "repo_url": "http://example.com/git/foo.git",
+            "pkg_name": "foo",
+            "git_hash": "1234abcd",
+            "branch": "f20",
+            "cache_dir": os.path.join(self.tmp_dir, "cache"),
+        }
+
+    def fake_fedpkg(self, returncode=0):
+        """
+        :return: replacement of `run` which pretends fedpkg-copr wrote an srpm
+        """
+        srpm_path = os.path.join(self.tmp_dir, "foo-1.0-1.src.rpm")
+
+        def run(cmd):
+            with open(srpm_path, "w") as f:
+                f.write("srpm")
+            return returncode, "Downloading...\nWrote: {}\n".format(srpm_path)
+        return run
+
+    @mock.patch("backend.mockremote.prepare_build.run")
+    def test_get_srpm_new_clone(self, mc_run):
+        mc_run.side_effect = self.fake_fedpkg()
+        result = {}
+        srpm_path = get_srpm(self.dist_git(), result)
+
+        assert srpm_path == os.path.join(self.tmp_dir, "cache", "srpms", "1234abcd-f20", "foo-1.0-1.src.rpm")
+        assert os.path.exists(srpm_path)
+        assert result["cache"] == {"srpm": False, "clone": False}
+        cmd = mc_run.call_args[0][0]
+        assert cmd.startswith("git clone http://example.com/git/foo.git ")
+        assert "git checkout -f 1234abcd" in cmd
+        assert "fedpkg-copr --dist f20 srpm" in cmd
+
+        # the same hash and branch again, nothing is run
+        mc_run.reset_mock()
+        result = {}
+        assert get_srpm(self.dist_git(), result) == srpm_path
+        assert result["cache"]["srpm"]
+        assert not mc_run.called
+
+    @mock.patch("backend.mockremote.prepare_build.run")
+    def test_get_srpm_cached_clone(self, mc_run):
+        mc_run.side_effect = self.fake_fedpkg()
+        get_srpm(self.dist_git(), {})
+        repo_dir = mc_run.call_args[0][0].split()[3]
+        os.makedirs(os.path.join(repo_dir, ".git"))
+
+        dist_git = dict(self.dist_git(), git_hash="5678efab")
+        result = {}
+        assert get_srpm(dist_git, result).endswith("/5678efab-f20/foo-1.0-1.src.rpm")
+        assert result["cache"] == {"srpm": False, "clone": True}
+        cmd = mc_run.call_args[0][0]
+        assert cmd.startswith("cd {} && git fetch origin && ".format(repo_dir))
+        assert "git checkout -f 5678efab" in cmd
+
+    @mock.patch("backend.mockremote.prepare_build.run")
+    def test_get_srpm_broken_clone(self, mc_run):
+        mc_run.side_effect = self.fake_fedpkg()
+        get_srpm(self.dist_git(), {})
+        repo_dir = mc_run.call_args[0][0].split()[3]
+        os.makedirs(os.path.join(repo_dir, ".git"))
+
+        fetch_failed = (128, "fatal: bad object")
+        mc_run.side_effect = [fetch_failed, self.fake_fedpkg()("")]
+        result = {}
+        assert get_srpm(dict(self.dist_git(), git_hash="5678efab"), result)
+        assert result["cache"]["clone"] is False
+        assert mc_run.call_args[0][0].startswith("git clone ")
+
+        mc_run.side_effect = [(1, "fatal: repository not found")]
+        assert get_srpm(dict(self.dist_git(), git_hash="9abc"), {}) is None
+
+    @mock.patch("backend.mockremote.prepare_build.run")
+    def test_prepare(self, mc_run):
+        fedpkg = self.fake_fedpkg()
+        mc_run.side_effect = lambda cmd: (0, "") if cmd.startswith("/bin/rpm") else fedpkg(cmd)
+
+        params = {
+            "mockchain": "/usr/bin/mockchain",
+            "chroot": "fedora-20-i386",
+            "tempdir": None,
+            "basedir": self.tmp_dir,
+            "config_edits": [{"regexp": "^.*use_host_resolv.*$",
+                              "line": "config_opts['use_host_resolv'] = False"}],
+            "dist_git": self.dist_git(),
+        }
+        result = {"phases": {}}
+        copy = shutil.copy
+        with mock.patch.object(prepare_build.os.path, "isfile", return_value=True), \
+                mock.patch.object(prepare_build.shutil, "copy",
+                                  side_effect=lambda src, dst: copy(self.cfg_path, dst)):
+            assert prepare(params, result) is None
+
+        assert result["srpm_path"].endswith("/srpms/1234abcd-f20/foo-1.0-1.src.rpm")
+        assert sorted(result["phases"]) == ["check", "config", "srpm"]
+        with open(os.path.join(result["tempdir"], "fedora-20-i386.cfg")) as f:
+            assert "config_opts['use_host_resolv'] = False" in f.read()
+
+    @mock.patch("backend.mockremote.prepare_build.run")
+    def test_prepare_missing_required_packages(self, mc_run):
+        params = {"mockchain": "/usr/bin/mockchain", "chroot": "fedora-20-i386"}
+        for output in ["package mock is not installed", "package rsync is not installed"]:
+            mc_run.return_value = (1, output)
+            with mock.patch.object(prepare_build.os.path, "isfile", return_value=True):
+                assert prepare(params, {"phases": {}}) == "missing_packages"
+            assert mc_run.call_args == mock.call("/bin/rpm -q mock rsync")
+
+    @mock.patch("backend.mockremote.prepare_build.run")
+    def test_prepare_missing_mockchain(self, mc_run):
+        mc_run.return_value = (0, "")
+        params = {"mockchain": "/nonexistent/mockchain", "chroot": "fedora-20-i386"}
+        assert prepare(params, {"phases": {}}) == "missing_mockchain"
+
+    @mock.patch("backend.mockremote.prepare_build.run")
+    def test_prepare_missing_mock_config(self, mc_run):
+        mc_run.return_value = (0, "")
+        params = {"mockchain": "/usr/bin/mockchain", "chroot": "fedora-20-i386"}
+        with mock.patch.object(prepare_build.os.path, "isfile",
+                               side_effect=lambda path: path == "/usr/bin/mockchain"):
+            assert prepare(params, {"phases": {}}) == "missing_config"
+        # nothing was prepared
+        assert mc_run.call_count == 1
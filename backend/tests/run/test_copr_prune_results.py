@@ -1,6 +1,7 @@
 # coding: utf-8
 import os
 import sys
+import time
 import shutil
 import tarfile
 import tempfile
@@ -28,15 +29,20 @@ def mc_runcmd():
     with mock.patch('{}.runcmd'.format(MODULE_REF)) as handle:
         yield handle
 
+@pytest.yield_fixture
+def mc_createrepo():
+    with mock.patch('{}.createrepo_unsafe'.format(MODULE_REF)) as handle:
+        yield handle
+
 @pytest.yield_fixture
 def mc_bcr():
     with mock.patch('{}.BackendConfigReader'.format(MODULE_REF)) as handle:
         yield handle
 
 @pytest.yield_fixture
-def mc_gacs():
-    with mock.patch('{}.get_auto_createrepo_status'.format(MODULE_REF)) as handle:
-        yield handle
+def mc_project_settings():
+    with mock.patch('{}.ProjectSettings'.format(MODULE_REF)) as handle:
+        yield handle.return_value
 
 @pytest.yield_fixture
 def mc_pruner():
@@ -63,6 +69,9 @@ class TestPruneResults(object):
 
         self.opts = Munch(
             prune_days=14,
+            prune_workers=1,
+            prune_createrepo_workers=1,
+            prune_checkpoint_file=os.path.join(self.tmp_dir, 'checkpoint'),
             frontend_base_url = '<frontend_url>',
             destdir=self.testresults_dir
         )
@@ -77,31 +86,170 @@ class TestPruneResults(object):
         with tarfile.open(src_path, 'r:gz') as tar_file:
             tar_file.extractall(target)
 
+    def chroot_paths(self):
+        return [os.path.join(self.opts.destdir, userdir, projectdir, chrootdir)
+                for userdir in self.testresults
+                for projectdir in self.testresults[userdir]
+                for chrootdir in self.testresults[userdir][projectdir]]
+
+    def set_build_times(self, chroot_path, mtime):
+        for dir_name in os.listdir(chroot_path):
+            build_path = os.path.join(chroot_path, dir_name)
+            if not os.path.isfile(os.path.join(build_path, 'build.info')):
+                continue
+            for name in os.listdir(build_path):
+                os.utime(os.path.join(build_path, name), (mtime, mtime))
+            os.utime(build_path, (mtime, mtime))
+
+    def pruned_paths(self, mc_runcmd):
+        return sorted(call[0][0][-1] for call in mc_runcmd.call_args_list)
+
     ################################ tests ################################
 
-    def test_run(self, mc_runcmd, mc_gacs):
-        mc_gacs.return_value = True
+    def test_run(self, mc_runcmd, mc_createrepo, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = True
+        mc_project_settings.get_persistent_status.return_value = False
 
         pruner = Pruner(self.opts)
         pruner.run()
 
+        # settings of all projects are loaded at once
+        assert mc_project_settings.prefetch.call_args == mock.call()
+
         expected_call_count = 0
         for userdir in self.testresults:
             for projectdir in self.testresults[userdir]:
                 for chrootdir in self.testresults[userdir][projectdir]:
                     prune_path = os.path.join(self.opts.destdir, userdir, projectdir, chrootdir)
-                    mc_runcmd.assert_has_calls(
-                        mock.call(
-                            ['prunerepo', '--verbose', '--days={0}'.format(self.opts.prune_days), '--cleancopr', prune_path]
-                        )
-                    )
+                    assert mock.call(
+                        ['prunerepo', '--verbose', '--days={0}'.format(self.opts.prune_days),
+                         '--cleancopr', '--nocreaterepo', '--native', prune_path]
+                    ) in mc_runcmd.call_args_list
+                    assert mock.call(prune_path) in mc_createrepo.call_args_list
                     expected_call_count += 1
         assert mc_runcmd.call_count == expected_call_count
+        assert mc_createrepo.call_count == expected_call_count
+
+    def test_run_skips_unchanged_chroots(self, mc_runcmd, mc_createrepo, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = True
+        mc_project_settings.get_persistent_status.return_value = False
+        # all the packages are older than prune_days, nothing left for later
+        for path in self.chroot_paths():
+            os.utime(path, (1, 1))
+            os.utime(os.path.join(path, 'repodata', 'repomd.xml'), (1, 1))
+
+        Pruner(self.opts).run()
+        assert self.pruned_paths(mc_runcmd) == sorted(self.chroot_paths())
+
+        mc_runcmd.reset_mock()
+        Pruner(self.opts).run()
+        assert not mc_runcmd.called
+
+        changed = self.chroot_paths()[0]
+        os.utime(changed, None)
+        Pruner(self.opts).run()
+        assert self.pruned_paths(mc_runcmd) == [changed]
+
+    def test_run_prunes_again_when_packages_get_old(self, mc_runcmd, mc_createrepo, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = True
+        mc_project_settings.get_persistent_status.return_value = False
+        for path in self.chroot_paths():
+            self.set_build_times(path, time.time())
+            os.utime(path, None)
+
+        Pruner(self.opts).run()
+        mc_runcmd.reset_mock()
+
+        # recently built packages might have been kept
+        Pruner(self.opts).run()
+        assert not mc_runcmd.called
+
+        later = time.time() + (self.opts.prune_days + 1) * 24 * 3600
+        with mock.patch('{}.time.time'.format(MODULE_REF)) as mc_time:
+            mc_time.return_value = later
+            Pruner(self.opts).run()
+        # there is nothing to get old in the chroot without builds
+        assert self.pruned_paths(mc_runcmd) == sorted(
+            path for path in self.chroot_paths() if not path.endswith('motionpaint/fedora-24-x86_64'))
+
+    def test_run_prunes_again_when_oldest_kept_package_gets_old(
+            self, mc_runcmd, mc_createrepo, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = True
+        mc_project_settings.get_persistent_status.return_value = False
+        day = 24 * 3600
+        for path in self.chroot_paths():
+            self.set_build_times(path, time.time() - 10 * day)
+        # newest build is fresh, the older ones get old in 4 days
+        fresh = self.chroot_paths()[0]
+        os.mkdir(os.path.join(fresh, '00000099-fresh'))
+        open(os.path.join(fresh, '00000099-fresh', 'build.info'), 'w').close()
+
+        Pruner(self.opts).run()
+        mc_runcmd.reset_mock()
+
+        later = time.time() + 5 * day
+        with mock.patch('{}.time.time'.format(MODULE_REF)) as mc_time:
+            mc_time.return_value = later
+            Pruner(self.opts).run()
+        assert fresh in self.pruned_paths(mc_runcmd)
+
+    def test_run_resumes_interrupted_run(self, mc_runcmd, mc_createrepo, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = True
+        mc_project_settings.get_persistent_status.return_value = False
+        mc_runcmd.side_effect = [None, None, KeyboardInterrupt()]
+
+        with pytest.raises(KeyboardInterrupt):
+            Pruner(self.opts).run()
+        first_pruned = [call[0][0][-1] for call in mc_runcmd.call_args_list]
+        assert len(first_pruned) == 3
+
+        mc_runcmd.reset_mock()
+        mc_runcmd.side_effect = None
+        # the chroots were modified meanwhile, but the run is resumed
+        for path in first_pruned:
+            os.utime(path, None)
+        Pruner(self.opts).run()
+        assert self.pruned_paths(mc_runcmd) == \
+            sorted(set(self.chroot_paths()) - set(first_pruned[:2]))
+
+    def test_failed_chroot_is_pruned_again(self, mc_runcmd, mc_createrepo, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = True
+        mc_project_settings.get_persistent_status.return_value = False
+        failing = self.chroot_paths()[0]
+        mc_createrepo.side_effect = lambda path: 1 / int(path != failing)
+
+        Pruner(self.opts).run()
+        mc_runcmd.reset_mock()
+        mc_createrepo.side_effect = None
+
+        Pruner(self.opts).run()
+        assert self.pruned_paths(mc_runcmd) == [failing]
+
+    def test_run_without_writable_checkpoint(self, mc_runcmd, mc_createrepo, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = True
+        mc_project_settings.get_persistent_status.return_value = False
+        self.opts.prune_checkpoint_file = os.path.join(self.tmp_dir, 'missing', 'checkpoint')
+
+        Pruner(self.opts).run()
+        assert self.pruned_paths(mc_runcmd) == sorted(self.chroot_paths())
+
+        # nothing was remembered, everything is pruned again
+        mc_runcmd.reset_mock()
+        Pruner(self.opts).run()
+        assert self.pruned_paths(mc_runcmd) == sorted(self.chroot_paths())
+
+    def test_project_skipped_when_acr_disabled(self, mc_runcmd, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = False
+        pruner = Pruner(self.opts)
+        assert pruner.list_project_chroots('<project_path>', '<username>', '<coprname>') == []
+
+        assert not mc_runcmd.called
 
-    def test_project_skipped_when_acr_disabled(self, mc_runcmd, mc_gacs):
-        mc_gacs.return_value = False
+    def test_project_skipped_when_persistent(self, mc_runcmd, mc_project_settings):
+        mc_project_settings.get_auto_createrepo_status.return_value = True
+        mc_project_settings.get_persistent_status.return_value = True
         pruner = Pruner(self.opts)
-        pruner.prune_project('<project_path>', '<username>', '<coprname>')
+        assert pruner.list_project_chroots('<project_path>', '<username>', '<coprname>') == []
 
         assert not mc_runcmd.called
 
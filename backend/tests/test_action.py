@@ -54,6 +54,9 @@ class TestAction(object):
             results_baseurl=RESULTS_ROOT_URL,
 
             do_sign=True,
+
+            createrepo_debounce=None,
+            createrepo_max_delay=10,
         )
 
     def teardown_method(self, method):
@@ -102,6 +105,25 @@ class TestAction(object):
 
         self.dummy = str(test_action)
 
+    def test_get_lock_keys(self, mc_time):
+        def make_action(**data):
+            return Action(opts=self.opts, action=dict(data, id=1), frontend_client=MagicMock())
+
+        assert make_action(action_type=ActionType.LEGAL_FLAG).get_lock_keys() == set()
+        assert make_action(action_type=ActionType.DELETE, object_type="copr",
+                           old_value="foo/bar").get_lock_keys() == {"foo/bar"}
+        assert make_action(action_type=ActionType.FORK, old_value="foo/bar",
+                           new_value="baz/bar").get_lock_keys() == {"foo/bar", "baz/bar"}
+        assert make_action(action_type=ActionType.DELETE, object_type="build", old_value="foo/bar",
+                           data=self.ext_data_for_delete_build).get_lock_keys() == {"foo/bar"}
+        assert make_action(action_type=ActionType.CREATEREPO, data=json.dumps(
+            {"username": "foo", "projectname": "bar", "chroots": []})).get_lock_keys() == {"foo/bar"}
+        assert make_action(action_type=ActionType.UPDATE_COMPS, data=json.dumps(
+            {"ownername": "foo", "projectname": "bar"})).get_lock_keys() == {"foo/bar"}
+        assert make_action(action_type=ActionType.RAWHIDE_TO_RELEASE, data=json.dumps(
+            {"user": "foo", "copr": "bar"})).get_lock_keys() == {"foo/bar"}
+        assert make_action(action_type=ActionType.CREATEREPO, data="{").get_lock_keys() == {"*"}
+
     def test_action_run_rename(self, mc_time):
 
         mc_time.time.return_value = self.test_time
@@ -123,7 +145,7 @@ class TestAction(object):
             frontend_client=mc_front_cb,
         )
         test_action.run()
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
 
         assert result_dict["id"] == 1
         assert result_dict["result"] == ActionResult.SUCCESS
@@ -153,7 +175,7 @@ class TestAction(object):
             frontend_client=mc_front_cb,
         )
         test_action.run()
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
 
         assert result_dict["id"] == 1
         assert result_dict["result"] == ActionResult.SUCCESS
@@ -182,7 +204,7 @@ class TestAction(object):
             frontend_client=mc_front_cb,
         )
         test_action.run()
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
 
         assert result_dict["id"] == 1
         assert result_dict["result"] == ActionResult.FAILURE
@@ -212,7 +234,7 @@ class TestAction(object):
         )
         test_action.run()
 
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
         assert result_dict["id"] == 6
         assert result_dict["result"] == ActionResult.SUCCESS
         assert result_dict["job_ended_on"] == self.test_time
@@ -237,7 +259,7 @@ class TestAction(object):
         )
         test_action.run()
 
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
         assert result_dict["id"] == 6
         assert result_dict["result"] == ActionResult.SUCCESS
         assert result_dict["job_ended_on"] == self.test_time
@@ -315,7 +337,10 @@ class TestAction(object):
             projectname=u'bar',
             base_url=u'http://example.com/results/foo/bar/fedora20',
             path='{}/old_dir/fedora20'.format(self.tmp_dir_name),
-            front_url=None
+            front_url=None,
+            debounce=None,
+            max_delay=10,
+            opts=self.opts,
         )
         assert mc_createrepo.call_args == create_repo_expected_call
 
@@ -547,7 +572,7 @@ class TestAction(object):
         )
         test_action.run()
 
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
 
         assert result_dict["id"] == 8
         assert result_dict["result"] == ActionResult.SUCCESS
@@ -586,7 +611,7 @@ class TestAction(object):
         )
         test_action.run()
 
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
 
         assert result_dict["id"] == 9
         assert result_dict["result"] == ActionResult.FAILURE
@@ -617,7 +642,7 @@ class TestAction(object):
         )
         test_action.run()
 
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
 
         assert result_dict["id"] == 10
         assert result_dict["result"] == ActionResult.FAILURE
@@ -646,7 +671,7 @@ class TestAction(object):
 
         test_action.run()
 
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
         assert result_dict["id"] == 11
         assert result_dict["result"] == ActionResult.SUCCESS
 
@@ -657,7 +682,7 @@ class TestAction(object):
         mc_front_cb.reset_mock()
         test_action.run()
 
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
 
         assert result_dict["id"] == 11
         assert result_dict["result"] == ActionResult.FAILURE
@@ -669,14 +694,14 @@ class TestAction(object):
         test_action.run()
 
         assert not mc_cuk.called
-        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        result_dict = mc_front_cb.post_update.call_args[0][0]["actions"][0]
         assert result_dict["id"] == 11
         assert result_dict["result"] == ActionResult.SUCCESS
 
     def test_request_exception_is_taken_care_of_when_posting_to_frontend(self, mc_time):
         mc_time.time.return_value = self.test_time
         mc_frontend_client = MagicMock()
-        mc_frontend_client.update = MagicMock(side_effect=RequestException)
+        mc_frontend_client.post_update = MagicMock(side_effect=RequestException)
 
         tmp_dir = self.make_temp_dir()
         self.opts.destdir = os.path.join(tmp_dir, "dir-not-exists")
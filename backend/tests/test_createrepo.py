@@ -17,7 +17,8 @@ else:
     from mock import MagicMock
 
 
-from backend.createrepo import createrepo, createrepo_unsafe, add_appdata, run_cmd_unsafe
+from backend.createrepo import createrepo, createrepo_unsafe, add_appdata, run_cmd_unsafe, \
+    CreaterepoScheduler
 from backend.exceptions import CreateRepoError
 
 @mock.patch('backend.createrepo.createrepo_unsafe')
@@ -50,7 +51,55 @@ def test_createrepo_conditional_false(mc_client, mc_create_unsafe):
     createrepo(path="/tmp/", front_url="http://example.com/api",
                username="foo", projectname="bar", base_url=base_url)
 
-    assert mc_create_unsafe.call_args == mock.call('/tmp/', dest_dir='devel', base_url=base_url)
+    assert mc_create_unsafe.call_args == mock.call('/tmp/', dest_dir='devel', base_url=base_url,
+                                                   pkglist=None)
+
+
+@mock.patch('backend.createrepo.CreaterepoScheduler.run')
+@mock.patch('backend.createrepo.add_module_md')
+@mock.patch('backend.createrepo.add_appdata')
+@mock.patch('backend.createrepo.createrepo_unsafe')
+def test_createrepo_debounce(mc_create_unsafe, mc_add_appdata, mc_add_module_md,
+                             mc_scheduler_run, tmpdir):
+    mc_create_unsafe.return_value = mc_add_appdata.return_value = mc_add_module_md.return_value = ""
+    path = str(tmpdir)
+    createrepo(path=path, front_url="http://example.com/api", username="foo",
+               projectname="bar", override_acr_flag=True, debounce=0)
+    assert mc_create_unsafe.called
+    assert not mc_scheduler_run.called
+    assert not os.path.exists(os.path.join(path, ".createrepo"))
+
+    mc_create_unsafe.reset_mock()
+    createrepo(path=path, front_url="http://example.com/api", username="foo",
+               projectname="bar", override_acr_flag=True, debounce=2)
+    assert not mc_create_unsafe.called
+    assert mc_scheduler_run.called
+
+
+@mock.patch('backend.createrepo.createrepo_unsafe')
+@mock.patch('backend.createrepo.add_appdata')
+@mock.patch('backend.createrepo.add_module_md')
+@mock.patch('backend.createrepo.ProjectSettings')
+@mock.patch('backend.createrepo.get_auto_createrepo_status')
+def test_createrepo_project_settings(mc_gacs, mc_project_settings, mc_add_module_md,
+                                     mc_add_appdata, mc_create_unsafe):
+    mc_create_unsafe.return_value = ""
+    mc_add_appdata.return_value = ""
+    mc_add_module_md.return_value = ""
+
+    # no need to ask for settings at all
+    createrepo(path="/tmp/", front_url="http://example.com/api",
+               username="foo", projectname="bar", override_acr_flag=True)
+    assert not mc_gacs.called
+    assert not mc_project_settings.called
+
+    opts = MagicMock()
+    mc_project_settings.return_value.get_auto_createrepo_status.return_value = False
+    createrepo(path="/tmp/", front_url="http://example.com/api",
+               username="foo", projectname="bar", opts=opts)
+    assert mc_project_settings.call_args == mock.call(opts)
+    assert mc_create_unsafe.call_args[1]["dest_dir"] == "devel"
+    assert not mc_gacs.called
 
 
 @pytest.yield_fixture
@@ -246,3 +295,97 @@ class TestCreaterepo(object):
 
             createrepo_unsafe(path, base_url=self.base_url, dest_dir="devel")
             assert os.path.exists(os.path.join(path, "devel"))
+
+    def test_createrepo_generated_commands_pkglist(self, mc_run_cmd_unsafe):
+        path = os.path.join(self.tmp_dir_name, "fedora-21")
+        os.makedirs(os.path.join(path, "repodata"))
+
+        # no metadata to recycle yet
+        createrepo_unsafe(path, pkglist={"foo/foo.rpm"})
+        assert "--pkglist" not in mc_run_cmd_unsafe.call_args[0][0]
+
+        open(os.path.join(path, "repodata", "repomd.xml"), "w").close()
+        pkglists = []
+
+        def read_pkglist(cmd, lock_path):
+            pkglist_path = cmd.split("--pkglist ")[1].split()[0]
+            with open(pkglist_path) as f:
+                pkglists.append(f.read())
+            return ""
+
+        mc_run_cmd_unsafe.side_effect = read_pkglist
+        createrepo_unsafe(path, pkglist={"foo/foo.rpm", "bar/bar.rpm"})
+        cmd = mc_run_cmd_unsafe.call_args[0][0]
+        assert "--update --recycle-pkglist --pkglist " in cmd
+        assert pkglists == ["bar/bar.rpm\nfoo/foo.rpm\n"]
+        # temporary pkglist is removed
+        assert not os.path.exists(cmd.split("--pkglist ")[1].split()[0])
+
+
+class TestCreaterepoScheduler(object):
+    def setup_method(self, method):
+        self.path = tempfile.mkdtemp(prefix="test_createrepo_scheduler_")
+        for build_dir in ["00001-foo", "00002-bar"]:
+            os.mkdir(os.path.join(self.path, build_dir))
+            for name in ["{}.rpm".format(build_dir), "build.log.gz"]:
+                open(os.path.join(self.path, build_dir, name), "w").close()
+        self.scheduler = CreaterepoScheduler(self.path)
+        self.runs = []
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.path)
+
+    def do_createrepo(self, pkglist):
+        self.runs.append(pkglist)
+        return "out"
+
+    def test_run_incremental(self):
+        assert self.scheduler.run(self.do_createrepo, ["00001-foo"]) == "out"
+        assert self.scheduler.run(self.do_createrepo, ["00002-bar/00002-bar.rpm", "missing.rpm"]) == "out"
+        assert self.runs == [{"00001-foo/00001-foo.rpm"}, {"00002-bar/00002-bar.rpm"}]
+
+    def test_run_full(self):
+        self.scheduler.run(self.do_createrepo)
+        assert self.runs == [None]
+
+    def test_run_coalesced(self):
+        requested_on = self.scheduler.request(["00001-foo"])
+        # another build finished later and its createrepo run covered our packages too
+        self.scheduler.run(self.do_createrepo, ["00002-bar"])
+        assert self.runs == [{"00001-foo/00001-foo.rpm", "00002-bar/00002-bar.rpm"}]
+
+        assert self.scheduler.run_requested(self.do_createrepo, requested_on) is None
+        assert len(self.runs) == 1
+
+    def test_run_nothing_pending(self):
+        self.scheduler.run(self.do_createrepo, ["00001-foo"])
+        # a run took our request, but started before we made it
+        assert self.scheduler.run_requested(self.do_createrepo, time.time()) is None
+        assert len(self.runs) == 1
+
+    def test_state_hidden(self):
+        self.scheduler.run(self.do_createrepo, ["00001-foo"])
+        assert sorted(os.listdir(self.path)) == [".createrepo", "00001-foo", "00002-bar"]
+
+    def test_run_failure_forces_full_scan(self):
+        def fail(pkglist):
+            raise CreateRepoError("test exception", ["foo", "bar"], 1)
+
+        with pytest.raises(CreateRepoError):
+            self.scheduler.run(fail, ["00001-foo"])
+
+        self.scheduler.run(self.do_createrepo, ["00002-bar"])
+        assert self.runs == [None]
+
+    def test_wait_for_quiet(self):
+        self.scheduler.debounce = 0.2
+        self.scheduler.max_delay = 1
+        requested_on = self.scheduler.request(["00001-foo"])
+        self.scheduler.wait_for_quiet(requested_on)
+        assert 0.2 <= time.time() - requested_on < 1
+
+        # a build which waits for too long doesn't wait for the others anymore
+        self.scheduler.max_delay = 0.1
+        requested_on = self.scheduler.request(["00001-foo"]) - 1
+        self.scheduler.wait_for_quiet(requested_on)
+        assert time.time() - requested_on < 1.2
@@ -1,12 +1,15 @@
 # coding: utf-8
 
+import json
 import multiprocessing
 
 from munch import Munch
 from requests import RequestException
 import six
 
+from backend.constants import FRONTEND_UPDATES_REDIS_KEY
 from backend.frontend import FrontendClient
+from backend.helpers import get_redis_connection
 
 
 if six.PY3:
@@ -20,11 +23,16 @@ import pytest
 
 
 @pytest.yield_fixture
-def post_req():
-    with mock.patch("backend.frontend.post") as obj:
+def mc_session():
+    with mock.patch("backend.frontend.Session") as obj:
         yield obj
 
 
+@pytest.yield_fixture
+def post_req(mc_session):
+    yield mc_session.return_value.post
+
+
 @pytest.yield_fixture
 def mc_time():
     with mock.patch("backend.frontend.time") as obj:
@@ -37,6 +45,11 @@ class TestFrontendClient(object):
         self.opts = Munch(
             frontend_base_url="http://example.com/",
             frontend_auth="12345678",
+            frontend_pool_size=10,
+            frontend_retries=3,
+            frontend_timeout=60,
+            frontend_backoff_max=30,
+            frontend_update_batching=False,
         )
         self.fc = FrontendClient(self.opts)
 
@@ -60,6 +73,59 @@ class TestFrontendClient(object):
 
         assert post_req.called
 
+    def test_session_reused(self, mc_session, post_req):
+        post_req.return_value.status_code = 200
+        self.fc._post_to_frontend(self.data, self.url_path)
+        self.fc._post_to_frontend(self.data, self.url_path)
+
+        assert mc_session.call_count == 1
+        assert post_req.call_count == 2
+        assert post_req.call_args[1]["timeout"] == 60
+
+    def test_session_recreated_after_fork(self, mc_session, post_req):
+        post_req.return_value.status_code = 200
+        self.fc._post_to_frontend(self.data, self.url_path)
+        with mock.patch("backend.frontend.os.getpid", return_value=-1):
+            self.fc._post_to_frontend(self.data, self.url_path)
+
+        assert mc_session.call_count == 2
+
+    def test_backoff_delay(self):
+        for attempt, max_delay in [(0, 1), (1, 2), (3, 8), (10, 30)]:
+            for _ in range(10):
+                assert max_delay / 2.0 <= self.fc.backoff_delay(attempt) <= max_delay
+
+    def test_waiting(self, mc_session):
+        mc_get = mc_session.return_value.get
+        mc_get.return_value.status_code = 200
+        mc_get.return_value.json.return_value = {"build": None, "action": None}
+
+        assert self.fc.waiting() == {"build": None, "action": None}
+        assert mc_get.call_args[0][0] == "http://example.com//backend/waiting/"
+
+        mc_get.return_value.status_code = 500
+        with pytest.raises(RequestException):
+            self.fc.waiting()
+
+    def test_waiting_long_poll(self, mc_session):
+        mc_get = mc_session.return_value.get
+        mc_get.return_value.status_code = 200
+        mc_get.return_value.json.return_value = {"build": None, "action": None}
+
+        self.fc.waiting(wait=5, wait_for=["build", "action"])
+        assert mc_get.call_args[1]["params"] == {"wait": 5, "wait_for": "build,action"}
+        # request must not time out before frontend stops waiting
+        assert mc_get.call_args[1]["timeout"] > 5
+
+    def test_waiting_actions(self, mc_session):
+        mc_get = mc_session.return_value.get
+        mc_get.return_value.status_code = 200
+        mc_get.return_value.json.return_value = {"actions": [{"id": 3}]}
+
+        assert self.fc.waiting_actions(4, exclude=[1, 2], wait=5) == [{"id": 3}]
+        assert mc_get.call_args[0][0] == "http://example.com//backend/waiting_actions/"
+        assert mc_get.call_args[1]["params"] == {"count": 4, "exclude": "1,2", "wait": 5}
+
     def test_post_to_frontend_not_200(self, post_req):
         post_req.return_value.status_code = 501
         with pytest.raises(RequestException):
@@ -90,6 +156,7 @@ class TestFrontendClient(object):
 
         assert self.fc._post_to_frontend_repeatedly(self.data, self.url_path) == response
         assert mc_time.sleep.called
+        assert mc_time.sleep.call_args[0][0] <= 1
 
     def test_post_to_frontend_repeated_all_attempts_failed(self, mask_post_to_fe, mc_time):
         self.ptf.side_effect = RequestException()
@@ -99,11 +166,49 @@ class TestFrontendClient(object):
 
         assert mc_time.sleep.called
 
+    def test_post_to_frontend_repeated_keeps_response(self, mask_post_to_fe, mc_time):
+        response = MagicMock(status_code=500)
+        self.ptf.side_effect = RequestException(response=response)
+
+        with pytest.raises(RequestException) as err:
+            self.fc._post_to_frontend_repeatedly(self.data, self.url_path, max_repeats=1)
+        assert err.value.response is response
+        assert not mc_time.sleep.called
+
     def test_update(self):
         ptfr = MagicMock()
         self.fc._post_to_frontend_repeatedly = ptfr
         self.fc.update(self.data)
-        assert ptfr.call_args == mock.call(self.data, "update")
+        assert ptfr.call_args == mock.call(self.data, "update", 10)
+
+    def test_update_batching(self):
+        self.opts.update(redis_db=9, redis_port=7777, frontend_update_batching=True)
+        fc = FrontendClient(self.opts)
+        ptfr = MagicMock()
+        fc._post_to_frontend_repeatedly = ptfr
+        rc = get_redis_connection(self.opts)
+        rc.delete(FRONTEND_UPDATES_REDIS_KEY)
+
+        fc.update(self.data)
+        assert not ptfr.called
+        assert [json.loads(raw) for raw in rc.lrange(FRONTEND_UPDATES_REDIS_KEY, 0, -1)] == [self.data]
+        rc.delete(FRONTEND_UPDATES_REDIS_KEY)
+
+        fc.post_update(self.data)
+        assert ptfr.call_args == mock.call(self.data, "update", 10)
+
+    def test_update_batching_redis_per_process(self):
+        self.opts.update(frontend_update_batching=True)
+        fc = FrontendClient(self.opts)
+        with mock.patch("backend.frontend.get_redis_connection") as mc_grc:
+            fc.update(self.data)
+            fc.update(self.data)
+            assert mc_grc.call_count == 1
+            assert mc_grc.return_value.rpush.call_count == 2
+
+            with mock.patch("backend.frontend.os.getpid", return_value=-1):
+                fc.update(self.data)
+            assert mc_grc.call_count == 2
 
     def test_starting_build(self):
         ptfr = MagicMock()
@@ -135,3 +240,26 @@ class TestFrontendClient(object):
         expected = mock.call({'build_id': self.build_id, 'chroot': self.chroot_name},
                              'reschedule_build_chroot')
         assert ptfr.call_args == expected
+
+    def test_get_project_settings(self):
+        ptfr = MagicMock()
+        ptfr.return_value.json.return_value = {"projects": {"foo/bar": {"persistent": True}}}
+        self.fc._post_to_frontend_repeatedly = ptfr
+
+        assert self.fc.get_project_settings() == {"foo/bar": {"persistent": True}}
+        assert ptfr.call_args == mock.call({}, "project_settings")
+
+        self.fc.get_project_settings(["foo/bar"])
+        assert ptfr.call_args == mock.call({"projects": ["foo/bar"]}, "project_settings")
+
+    def test_lease_build_tasks(self, mask_post_to_fe):
+        self.ptf.return_value.json.return_value = {"builds": [{"task_id": "1-foo"}]}
+        assert self.fc.lease_build_tasks(["x86_64"], 5, 300) == [{"task_id": "1-foo"}]
+        expected = mock.call({"archs": ["x86_64"], "count": 5, "lease": 300},
+                             "lease_build_tasks", timeout=self.fc.timeout)
+        assert self.ptf.call_args == expected
+
+        self.fc.lease_build_tasks(["x86_64"], 5, 300, wait=10)
+        expected = mock.call({"archs": ["x86_64"], "count": 5, "lease": 300, "wait": 10},
+                             "lease_build_tasks", timeout=self.fc.timeout + 10)
+        assert self.ptf.call_args == expected
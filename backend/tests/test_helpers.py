@@ -18,7 +18,7 @@ from backend.exceptions import CoprSpawnFailError
 from backend.exceptions import BuilderError
 from backend.helpers import get_redis_connection, get_redis_logger, BackendConfigReader
 from backend.vm_manage import EventTopics, PUBSUB_MB
-from backend.vm_manage.check import HealthChecker, check_health
+from backend.vm_manage.check import HealthChecker
 
 if six.PY3:
     from unittest import mock
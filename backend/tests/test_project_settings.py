@@ -0,0 +1,70 @@
+# coding: utf-8
+
+from munch import Munch
+import pytest
+
+import six
+
+if six.PY3:
+    from unittest.mock import MagicMock
+else:
+    from mock import MagicMock
+
+from copr.exceptions import CoprRequestException
+
+from backend.project_settings import ProjectSettings
+
+"""
+REQUIRES RUNNING REDIS
+"""
+
+
+class TestProjectSettings(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            project_settings_ttl=600,
+        )
+        self.frontend_client = MagicMock()
+        self.frontend_client.get_project_settings.return_value = {
+            "foo/bar": {"auto_createrepo": False, "persistent": False},
+            "@group/baz": {"auto_createrepo": True, "persistent": True},
+        }
+        self.ps = ProjectSettings(self.opts, frontend_client=self.frontend_client)
+        self.ps.rc.flushdb()
+
+    def teardown_method(self, method):
+        self.ps.rc.flushdb()
+
+    def test_get_cached(self):
+        assert not self.ps.get_auto_createrepo_status("foo", "bar")
+        assert not self.ps.get_persistent_status("foo", "bar")
+        assert self.frontend_client.get_project_settings.call_count == 1
+        assert self.frontend_client.get_project_settings.call_args[0][0] == ["foo/bar"]
+
+        ttl = self.ps.rc.ttl(ProjectSettings.KEY.format("foo/bar"))
+        assert 0 < ttl <= 600
+
+    def test_prefetch(self):
+        self.ps.prefetch()
+        assert self.frontend_client.get_project_settings.call_args[0][0] is None
+
+        assert self.ps.get_auto_createrepo_status("@group", "baz")
+        assert self.ps.get_persistent_status("@group", "baz")
+        assert not self.ps.get_auto_createrepo_status("foo", "bar")
+        assert self.frontend_client.get_project_settings.call_count == 1
+
+    def test_invalidate(self):
+        self.ps.prefetch()
+        self.ps.invalidate("foo", "bar")
+        self.ps.get("@group", "baz")
+        assert self.frontend_client.get_project_settings.call_count == 1
+        self.ps.get("foo", "bar")
+        assert self.frontend_client.get_project_settings.call_count == 2
+
+    def test_get_nonexisting(self):
+        with pytest.raises(CoprRequestException) as err:
+            self.ps.get("foo", "nonexisting")
+        assert "does not exists" in str(err.value)
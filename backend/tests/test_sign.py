@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import tempfile
 import shutil
@@ -16,7 +17,10 @@ else:
     import mock
     from mock import MagicMock
 
-from backend.sign import get_pubkey, _sign_one, sign_rpms_in_dir, create_user_keys
+from backend.constants import KNOWN_SIGN_KEYS_REDIS_KEY
+from backend.helpers import get_redis_connection
+from backend.sign import get_pubkey, _sign_one, _sign_many, sign_rpms_in_dir, create_user_keys, \
+    ensure_user_keys
 
 
 STDOUT = "stdout"
@@ -33,9 +37,13 @@ class TestSign(object):
         self.test_time = time.time()
         self.tmp_dir_path = None
 
-        self.opts = Munch(keygen_host="example.com")
+        self.opts = Munch(keygen_host="example.com", sign_workers=4, sign_batch_size=1,
+                          redis_db=9, redis_port=7777)
+        self.rc = get_redis_connection(self.opts)
+        self.rc.delete(KNOWN_SIGN_KEYS_REDIS_KEY)
 
     def teardown_method(self, method):
+        self.rc.delete(KNOWN_SIGN_KEYS_REDIS_KEY)
         if self.tmp_dir_path:
             shutil.rmtree(self.tmp_dir_path)
 
@@ -277,3 +285,95 @@ class TestSign(object):
 
         assert mc_so.called
 
+
+    @mock.patch("backend.sign.create_user_keys")
+    @mock.patch("backend.sign._sign_one")
+    @mock.patch("backend.sign.Popen")
+    def test_sign_rpms_in_dir_key_cached(self, mc_popen, mc_so, mc_cuk, tmp_dir, tmp_files):
+        mc_popen.return_value.communicate.return_value = (STDOUT, STDERR)
+        mc_popen.return_value.returncode = 0
+
+        for _ in range(3):
+            sign_rpms_in_dir(self.username, self.projectname,
+                             self.tmp_dir_path, self.opts, log=MagicMock())
+
+        # key was looked up only once
+        assert mc_popen.call_count == 1
+        assert mc_so.call_count == 6
+        assert not mc_cuk.called
+
+    def test_ensure_user_keys_cached_across_processes(self):
+        # every build is signed in a separate worker process
+        for expected_lookups in [1, 0]:
+            worker = multiprocessing.Process(target=_ensure_user_keys_exit_with_lookups,
+                                             args=(self.username, self.projectname, self.opts))
+            worker.start()
+            worker.join()
+            assert worker.exitcode == expected_lookups
+
+    @mock.patch("backend.sign.create_user_keys")
+    @mock.patch("backend.sign.get_pubkey")
+    def test_ensure_user_keys_remembers_created(self, mc_gp, mc_cuk):
+        mc_gp.side_effect = CoprSignNoKeyError("foobar")
+        ensure_user_keys(self.username, self.projectname, self.opts)
+        ensure_user_keys(self.username, self.projectname, self.opts)
+        assert mc_gp.call_count == 1
+        assert mc_cuk.call_count == 1
+
+    @mock.patch("backend.sign.Popen")
+    def test_sign_many(self, mc_popen):
+        mc_popen.return_value.communicate.return_value = (STDOUT, STDERR)
+        mc_popen.return_value.returncode = 0
+
+        assert _sign_many(["/tmp/foo.rpm", "/tmp/bar.rpm"], self.usermail) == (STDOUT, STDERR)
+        assert mc_popen.call_args[0][0] == ["sudo", "/bin/sign", "-u", self.usermail, "-r",
+                                            "/tmp/foo.rpm", "/tmp/bar.rpm"]
+
+        mc_popen.return_value.returncode = 1
+        with pytest.raises(CoprSignError):
+            _sign_many(["/tmp/foo.rpm", "/tmp/bar.rpm"], self.usermail)
+
+    @mock.patch("backend.sign._sign_many")
+    @mock.patch("backend.sign._sign_one")
+    @mock.patch("backend.sign.get_pubkey")
+    def test_sign_rpms_in_dir_batch(self, mc_gp, mc_so, mc_sm, tmp_dir):
+        for i in range(5):
+            open(os.path.join(self.tmp_dir_path, "{}.rpm".format(i)), "w").close()
+        self.opts.sign_batch_size = 2
+
+        sign_rpms_in_dir(self.username, self.projectname,
+                         self.tmp_dir_path, self.opts, log=MagicMock())
+        assert sorted(len(call[0][0]) for call in mc_sm.call_args_list) == [2, 2]
+        # the remaining one is signed alone
+        assert mc_so.call_count == 1
+
+    @mock.patch("backend.sign._sign_many")
+    @mock.patch("backend.sign._sign_one")
+    @mock.patch("backend.sign.get_pubkey")
+    def test_sign_rpms_in_dir_batch_error(self, mc_gp, mc_so, mc_sm, tmp_dir, tmp_files):
+        self.opts.sign_batch_size = 10
+        mc_sm.side_effect = CoprSignError("foobar")
+        bad_rpm = os.path.join(self.tmp_dir_path, "bar.rpm")
+        mc_so.side_effect = lambda path, email: _raise(CoprSignError("foobar")) \
+            if path == bad_rpm else None
+
+        with pytest.raises(CoprSignError) as err:
+            sign_rpms_in_dir(self.username, self.projectname,
+                             self.tmp_dir_path, self.opts, log=MagicMock())
+
+        # failed batch is retried rpm by rpm to find out the wrong ones
+        assert mc_so.call_count == 2
+        assert bad_rpm in str(err.value)
+        assert os.path.join(self.tmp_dir_path, "foo.rpm") not in str(err.value)
+
+
+def _raise(error):
+    raise error
+
+
+def _ensure_user_keys_exit_with_lookups(username, projectname, opts):
+    with mock.patch("backend.sign.Popen") as mc_popen:
+        mc_popen.return_value.communicate.return_value = (STDOUT, STDERR)
+        mc_popen.return_value.returncode = 0
+        ensure_user_keys(username, projectname, opts)
+    os._exit(mc_popen.call_count)
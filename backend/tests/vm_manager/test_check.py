@@ -15,7 +15,7 @@ from backend.exceptions import CoprSpawnFailError
 
 from backend.helpers import get_redis_connection
 from backend.vm_manage import EventTopics, PUBSUB_MB
-from backend.vm_manage.check import HealthChecker, check_health
+from backend.vm_manage.check import HealthChecker, check_health_batch
 
 if six.PY3:
     from unittest import mock
@@ -62,6 +62,12 @@ def mc_ans_runner():
         yield handle
 
 
+@pytest.yield_fixture
+def mc_start_ssh():
+    with mock.patch("{}.start_ssh".format(MODULE_REF)) as handle:
+        yield handle
+
+
 @pytest.yield_fixture
 def mc_grc():
     with mock.patch("{}.get_redis_connection".format(MODULE_REF)) as handle:
@@ -127,11 +133,12 @@ class TestChecker(object):
 
         mc_rc = MagicMock()
         mc_grc.return_value = mc_rc
+        mc_pipe = mc_rc.pipeline.return_value
 
         # didn't raise exception
-        check_health(self.opts, self.vm_name, self.vm_ip)
-        assert mc_rc.publish.call_args[0][0] == PUBSUB_MB
-        dict_result = json.loads(mc_rc.publish.call_args[0][1])
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip)])
+        assert mc_pipe.publish.call_args[0][0] == PUBSUB_MB
+        dict_result = json.loads(mc_pipe.publish.call_args[0][1])
         assert dict_result["result"] == "failed"
         assert "VM is not responding to the testing playbook." in dict_result["msg"]
 
@@ -142,11 +149,12 @@ class TestChecker(object):
 
         mc_rc = MagicMock()
         mc_grc.return_value = mc_rc
+        mc_pipe = mc_rc.pipeline.return_value
 
         # didn't raise exception
-        check_health(self.opts, self.vm_name, self.vm_ip)
-        assert mc_rc.publish.call_args[0][0] == PUBSUB_MB
-        dict_result = json.loads(mc_rc.publish.call_args[0][1])
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip)])
+        assert mc_pipe.publish.call_args[0][0] == PUBSUB_MB
+        dict_result = json.loads(mc_pipe.publish.call_args[0][1])
         assert dict_result["result"] == "failed"
         assert "Failed to check  VM" in dict_result["msg"]
         assert "due to ansible error:" in dict_result["msg"]
@@ -158,11 +166,12 @@ class TestChecker(object):
 
         mc_rc = MagicMock()
         mc_grc.return_value = mc_rc
+        mc_pipe = mc_rc.pipeline.return_value
 
         # didn't raise exception
-        check_health(self.opts, self.vm_name, self.vm_ip)
-        assert mc_rc.publish.call_args[0][0] == PUBSUB_MB
-        dict_result = json.loads(mc_rc.publish.call_args[0][1])
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip)])
+        assert mc_pipe.publish.call_args[0][0] == PUBSUB_MB
+        dict_result = json.loads(mc_pipe.publish.call_args[0][1])
         assert dict_result["result"] == "OK"
 
     def test_check_health_pubsub_publish_error(self, mc_ans_runner, mc_grc):
@@ -173,8 +182,61 @@ class TestChecker(object):
         mc_grc.side_effect = ConnectionError()
 
         # didn't raise exception
-        check_health(self.opts, self.vm_name, self.vm_ip)
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip)])
 
         assert mc_conn.run.called
         assert mc_grc.called
 
+
+    def test_check_health_multiplex_ok(self, mc_ans_runner, mc_start_ssh, mc_grc):
+        self.opts.ssh.multiplex = True
+        mc_start_ssh.return_value.communicate.return_value = ("hello\n", "")
+        mc_start_ssh.return_value.returncode = 0
+        mc_pipe = mc_grc.return_value.pipeline.return_value
+
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip)])
+
+        assert not mc_ans_runner.called
+        assert mc_start_ssh.call_args[0][1:5] == (self.vm_ip, "mockbuilder", "echo hello", 2)
+        dict_result = json.loads(mc_pipe.publish.call_args[0][1])
+        assert dict_result["result"] == "OK"
+
+    def test_check_health_multiplex_failed(self, mc_ans_runner, mc_start_ssh, mc_grc):
+        self.opts.ssh.multiplex = True
+        mc_start_ssh.return_value.communicate.return_value = ("", "Connection refused")
+        mc_start_ssh.return_value.returncode = 255
+        mc_pipe = mc_grc.return_value.pipeline.return_value
+
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip)])
+
+        dict_result = json.loads(mc_pipe.publish.call_args[0][1])
+        assert dict_result["result"] == "failed"
+        assert "Connection refused" in dict_result["msg"]
+
+    def test_check_health_batch(self, mc_ans_runner, mc_grc):
+        mc_ans_runner.return_value.run.return_value = {
+            "contacted": {"10.0.0.1": {}, "10.0.0.2": {}},
+            "dark": {"10.0.0.3": {"msg": "timed out"}},
+        }
+        mc_pipe = mc_grc.return_value.pipeline.return_value
+
+        vms = [("vm_1", "10.0.0.1"), ("vm_2", "10.0.0.2"), ("vm_3", "10.0.0.3")]
+        check_health_batch(self.opts, vms)
+
+        # one runner for all the VMs
+        assert mc_ans_runner.call_count == 1
+        assert mc_ans_runner.call_args[1]["host_list"] == "10.0.0.1,10.0.0.2,10.0.0.3,"
+        assert mc_ans_runner.call_args[1]["forks"] == 3
+
+        # results published together
+        assert mc_pipe.execute.call_count == 1
+        results = [json.loads(call[0][1]) for call in mc_pipe.publish.call_args_list]
+        assert [(r["vm_name"], r["result"]) for r in results] == [
+            ("vm_1", "OK"), ("vm_2", "OK"), ("vm_3", "failed")]
+        assert "timed out" in results[2]["msg"]
+        assert all(r["topic"] == EventTopics.HEALTH_CHECK for r in results)
+
+    def test_is_running(self):
+        assert not self.checker.is_running()
+        self.checker.child_processes = [MagicMock(is_alive=lambda: False), MagicMock(is_alive=lambda: True)]
+        assert self.checker.is_running()
@@ -0,0 +1,99 @@
+# coding: utf-8
+
+import shutil
+import tempfile
+
+from munch import Munch
+import six
+
+import ansible.constants
+from backend.vm_manage.connection import (ssh_options, ssh_command, configure_ansible,
+                                          start_ssh, close_connections)
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+import pytest
+
+
+MODULE_REF = "backend.vm_manage.connection"
+
+
+@pytest.yield_fixture
+def mc_popen():
+    with mock.patch("{}.Popen".format(MODULE_REF)) as handle:
+        handle.return_value.communicate.return_value = ("out", "err")
+        handle.return_value.returncode = 0
+        yield handle
+
+
+class TestConnection(object):
+
+    def setup_method(self, method):
+        self.control_dir = tempfile.mkdtemp()
+        self.opts = Munch(
+            build_user="mockbuilder",
+            ssh=Munch(
+                transport="ssh",
+                multiplex=True,
+                control_dir=self.control_dir,
+                control_persist=60,
+            ),
+        )
+        self.log = mock.MagicMock()
+        self.vm_ip = "127.0.0.1"
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.control_dir)
+
+    def test_ssh_options(self):
+        options = ssh_options(self.opts)
+        assert "ControlMaster=auto" in options
+        assert "ControlPath={}/%r@%h:%p".format(self.control_dir) in options
+        assert "ControlPersist=60" in options
+
+        self.opts.ssh.multiplex = False
+        assert ssh_options(self.opts) == [
+            "-o", "PasswordAuthentication=no", "-o", "StrictHostKeyChecking=no"]
+
+    def test_ssh_command(self):
+        self.opts.ssh.control_dir = "/tmp/with space"
+        assert "'ControlPath=/tmp/with space/%r@%h:%p'" in ssh_command(self.opts)
+
+    def test_configure_ansible(self):
+        original = ansible.constants.ANSIBLE_SSH_ARGS
+        try:
+            self.opts.ssh.transport = "paramiko"
+            configure_ansible(self.opts, self.log)
+            assert ansible.constants.ANSIBLE_SSH_ARGS == original
+
+            self.opts.ssh.transport = "ssh"
+            configure_ansible(self.opts, self.log)
+            assert "ControlPersist=60" in ansible.constants.ANSIBLE_SSH_ARGS
+        finally:
+            ansible.constants.ANSIBLE_SSH_ARGS = original
+
+    def test_start_ssh(self, mc_popen):
+        assert start_ssh(self.opts, self.vm_ip, "root", "echo hello", 5, self.log) == mc_popen.return_value
+        cmd = mc_popen.call_args[0][0]
+        assert cmd[:4] == ["timeout", "5", "ssh", "-o"]
+        assert "ControlMaster=auto" in cmd
+        assert cmd[-2:] == ["root@127.0.0.1", "echo hello"]
+
+    def test_close_connections(self, mc_popen):
+        close_connections(self.opts, self.vm_ip, self.log)
+        targets = sorted(call[0][0][-1] for call in mc_popen.call_args_list)
+        assert targets == ["mockbuilder@127.0.0.1", "root@127.0.0.1"]
+        assert all("exit" in call[0][0] for call in mc_popen.call_args_list)
+
+        mc_popen.reset_mock()
+        self.opts.ssh.multiplex = False
+        close_connections(self.opts, self.vm_ip, self.log)
+        assert not mc_popen.called
+
+    def test_close_connections_error(self, mc_popen):
+        mc_popen.side_effect = OSError("no ssh")
+        close_connections(self.opts, self.vm_ip, self.log)
+        assert self.log.exception.called
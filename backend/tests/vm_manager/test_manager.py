@@ -11,8 +11,11 @@ import six
 
 from backend import exceptions
 from backend.exceptions import VmError, NoVmAvailable
-from backend.vm_manage import VmStates, KEY_VM_POOL, PUBSUB_MB, EventTopics, KEY_SERVER_INFO
+from backend.vm_manage import VmStates, KEY_VM_POOL, PUBSUB_MB, EventTopics, KEY_SERVER_INFO, \
+    KEY_VM_IN_USE_BY_USER, KEY_VM_STATE_INDEX, PUBSUB_INTERRUPT_BUILDER, KEY_VM_LEASE, \
+    PUBSUB_VM_RELEASED
 from backend.vm_manage.manager import VmManager
+from backend.vm_manage.models import state_index_keys
 from backend.daemons.vm_master import VmMaster
 from backend.helpers import get_redis_connection
 
@@ -68,6 +71,7 @@ class TestManager(object):
             timeout=1800,
             # destdir=self.tmp_dir_path,
             results_baseurl="/tmp",
+            vm_lease_seconds=120,
         )
         self.queue = Queue()
 
@@ -122,13 +126,13 @@ class TestManager(object):
         vmd.store_field(self.rc, "state", VmStates.CHECK_HEALTH)
         vmd.store_field(self.rc, "last_health_check", 12345)
 
-        self.vmm.mark_vm_check_failed(self.vm_name)
+        self.vmm.mark_vm_check_failed(self.vm_name, self.group)
 
         assert vmd.get_field(self.rc, "state") == VmStates.CHECK_HEALTH_FAILED
         states = [VmStates.GOT_IP, VmStates.IN_USE, VmStates.READY, VmStates.TERMINATING]
         for state in states:
             vmd.store_field(self.rc, "state", state)
-            self.vmm.mark_vm_check_failed(self.vm_name)
+            self.vmm.mark_vm_check_failed(self.vm_name, self.group)
             assert vmd.get_field(self.rc, "state") == state
 
     def test_acquire_vm_no_vm_after_server_restart(self, mc_time):
@@ -213,12 +217,64 @@ class TestManager(object):
         for idx in range(max_vm_per_user):
             vmd = self.vmm.acquire_vm(0, self.username, idx)
 
+        assert self.vmm.get_vm_in_use_count(self.username, 0) == max_vm_per_user
         with pytest.raises(NoVmAvailable):
             self.vmm.acquire_vm(0, self.username, 42)
 
-        acquired_vmd_list[-1].store_field(self.rc, "state", VmStates.READY)
+        # other users are not affected
+        self.vmm.acquire_vm(0, "alice", 43)
+
+        self.vmm.release_vm(vmd.vm_name, vmd.group)
+        assert self.vmm.get_vm_in_use_count(self.username, 0) == max_vm_per_user - 1
         self.vmm.acquire_vm(0, self.username, 42)
 
+    def test_acquire_vm_per_user_limit_check_inside_lua(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+
+        # concurrent dispatcher has passed the python-side check but another one
+        # acquired the last allowed VM in the meantime
+        self.vmm.can_user_acquire_more_vm = MagicMock(return_value=True)
+        self.rc.hset(KEY_VM_IN_USE_BY_USER.format(group=self.group), self.username,
+                     self.opts.build_groups[0]["max_vm_per_user"])
+
+        with pytest.raises(NoVmAvailable):
+            self.vmm.acquire_vm(0, self.username, 42)
+        assert vmd.get_field(self.rc, "state") == VmStates.READY
+
+    def test_in_use_counter_on_termination(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+        self.vmm.acquire_vm(0, self.username, 42)
+        assert self.vmm.get_vm_in_use_count(self.username, 0) == 1
+
+        self.vmm.start_vm_termination(self.vm_name, allowed_pre_state=VmStates.IN_USE)
+        assert self.vmm.get_vm_in_use_count(self.username, 0) == 0
+
+        # counter never goes below zero
+        assert not self.vmm.release_vm(self.vm_name, self.group)
+        assert self.vmm.get_vm_in_use_count(self.username, 0) == 0
+
+    def test_mark_server_start_recounts_in_use(self, mc_time):
+        mc_time.time.return_value = 0
+        for idx, state in enumerate([VmStates.IN_USE, VmStates.IN_USE, VmStates.READY]):
+            vmd = self.vmm.add_vm_to_pool("127.0.{}.1".format(idx), "vm_{}".format(idx), self.group)
+            vmd.store_field(self.rc, "state", state)
+            vmd.store_field(self.rc, "bound_to_user", self.username)
+        self.rc.hset(KEY_VM_IN_USE_BY_USER.format(group=self.group), "alice", 5)
+
+        self.vmm.mark_server_start()
+        assert self.vmm.get_vm_in_use_count(self.username, 0) == 2
+        assert self.vmm.get_vm_in_use_count("alice", 0) == 0
+
     def test_acquire_only_ready_state(self, mc_time):
         mc_time.time.return_value = 0
         self.vmm.mark_server_start()
@@ -249,13 +305,122 @@ class TestManager(object):
         vmd_got_first = self.vmm.acquire_vm(group=self.group, username=self.username, pid=self.pid)
         assert vmd_got_first.vm_name == "alternative"
 
-        self.vmm.release_vm("alternative")
+        self.vmm.release_vm("alternative", self.group)
         vmd_got_again = self.vmm.acquire_vm(group=self.group, username=self.username, pid=self.pid)
         assert vmd_got_again.vm_name == "alternative"
 
         vmd_got_another = self.vmm.acquire_vm(group=self.group, username=self.username, pid=self.pid)
         assert vmd_got_another.vm_name == self.vm_name
 
+    def test_acquire_vm_chroot_affinity(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+
+        vm_names = ["vm_none", "vm_package", "vm_old_chroot", "vm_chroot"]
+        for vm_name in vm_names:
+            vmd = self.vmm.add_vm_to_pool(self.vm_ip, vm_name, self.group)
+            vmd.store_field(self.rc, "state", VmStates.READY)
+            vmd.store_field(self.rc, "last_health_check", 2)
+            vmd.store_field(self.rc, "bound_to_user", self.username)
+        self.rc.hset("copr:backend:vm_instance:hset::vm_package", "last_package", "foo")
+        self.rc.hset("copr:backend:vm_instance:hset::vm_old_chroot", "last_chroots",
+                     "fedora-24-x86_64,fedora-rawhide-x86_64")
+        self.rc.hset("copr:backend:vm_instance:hset::vm_chroot", "last_chroots",
+                     "fedora-rawhide-x86_64,fedora-24-x86_64")
+
+        self.opts.build_groups[0]["max_vm_per_user"] = 4
+        got = [self.vmm.acquire_vm(self.group, self.username, self.pid,
+                                   chroot="fedora-rawhide-x86_64", package_name="foo").vm_name
+               for _ in vm_names]
+        assert got == ["vm_chroot", "vm_old_chroot", "vm_package", "vm_none"]
+
+        stats = self.vmm.get_affinity_stats(self.group)
+        assert stats["chroot"]["acquired"] == 2
+        assert stats["package"]["acquired"] == 1
+        assert stats["none"]["rate"] == 0.25
+
+    def test_acquire_vm_affinity_fallback(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+        vmd_main = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd_alt = self.vmm.add_vm_to_pool(self.vm_ip, "alternative", self.group)
+        for vmd in [vmd_main, vmd_alt]:
+            vmd.store_field(self.rc, "state", VmStates.READY)
+            vmd.store_field(self.rc, "last_health_check", 2)
+        vmd_alt.store_field(self.rc, "bound_to_user", self.username)
+        vmd_alt.store_field(self.rc, "last_chroots", "epel-7-x86_64")
+
+        # nothing matches, VM dirtied by the user still goes first
+        vmd_got = self.vmm.acquire_vm(self.group, self.username, self.pid, chroot="fedora-24-x86_64")
+        assert vmd_got.vm_name == "alternative"
+
+    def test_release_vm_records_history(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+
+        for idx, chroot in enumerate(["fedora-23-x86_64", "fedora-24-x86_64", "fedora-23-x86_64",
+                                      "epel-7-x86_64", "fedora-rawhide-x86_64"]):
+            mc_time.time.return_value = 10 * idx
+            self.vmm.acquire_vm(self.group, self.username, self.pid, chroot=chroot, package_name="foo")
+            mc_time.time.return_value = 10 * idx + 5
+            assert self.vmm.release_vm(self.vm_name, self.group)
+
+        assert vmd.get_field(self.rc, "last_chroots") == \
+            "fedora-rawhide-x86_64,epel-7-x86_64,fedora-23-x86_64"
+        assert vmd.get_field(self.rc, "last_package") == "foo"
+        assert vmd.get_field(self.rc, "chroot") is None
+
+        stats = self.vmm.get_affinity_stats(self.group)
+        # only the second fedora-23-x86_64 build hits a chroot built before
+        assert stats["none"]["acquired"] == 1
+        assert stats["package"]["acquired"] == 3
+        assert stats["chroot"]["acquired"] == 1
+        assert stats["chroot"]["avg_build_seconds"] == 5
+
+    def test_vm_lease(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+        lease_key = KEY_VM_LEASE.format(vm_name=self.vm_name)
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+
+        assert not self.vmm.renew_lease(self.vm_name)
+        self.vmm.acquire_vm(self.group, self.username, self.pid)
+        assert self.rc.get(lease_key).endswith(":{}".format(self.pid))
+        assert 0 < self.rc.ttl(lease_key) <= 120
+
+        assert self.vmm.renew_lease(self.vm_name)
+        assert self.vmm.get_vms_without_lease([vmd]) == []
+
+        self.vmm.release_vm(self.vm_name, self.group)
+        assert not self.rc.exists(lease_key)
+        assert self.vmm.get_vms_without_lease([vmd]) == [vmd]
+        assert not self.vmm.renew_lease(self.vm_name)
+
+        # termination drops the lease as well
+        self.vmm.acquire_vm(self.group, self.username, self.pid)
+        self.vmm.start_vm_termination(self.vm_name, allowed_pre_state=VmStates.IN_USE)
+        assert not self.rc.exists(lease_key)
+
+    def test_release_vm_publishes_group(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+        self.ps = self.rc.pubsub(ignore_subscribe_messages=True)
+        self.ps.subscribe(PUBSUB_VM_RELEASED)
+
+        self.vmm.acquire_vm(self.group, self.username, self.pid)
+        assert self.vmm.get_vm_in_use_counts(self.group) == {self.username: 1}
+        self.vmm.release_vm(self.vm_name, self.group)
+        assert self.vmm.get_vm_in_use_counts(self.group) == {}
+        assert [msg["data"] for msg in self.rcv_from_ps_message_bus()] == [str(self.group)]
+
     def test_release_only_in_use(self):
         vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
 
@@ -263,7 +428,9 @@ class TestManager(object):
                       VmStates.TERMINATING, VmStates.CHECK_HEALTH_FAILED]:
             vmd.store_field(self.rc, "state", state)
 
-            assert not self.vmm.release_vm(self.vm_name)
+            assert not self.vmm.release_vm(self.vm_name, self.group)
+
+        assert not self.vmm.release_vm("unknown_vm", self.group)
 
     def rcv_from_ps_message_bus(self):
         # don't forget to subscribe self.ps
@@ -290,6 +457,16 @@ class TestManager(object):
         assert data["topic"] == EventTopics.VM_TERMINATION_REQUEST
         assert data["vm_name"] == self.vm_name
 
+    def test_start_vm_termination_interrupts_build(self):
+        self.ps = self.vmm.rc.pubsub(ignore_subscribe_messages=True)
+        self.ps.subscribe(PUBSUB_INTERRUPT_BUILDER.format(self.vm_ip))
+        self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+
+        self.vmm.start_vm_termination(self.vm_name)
+        rcv_msg_list = self.rcv_from_ps_message_bus()
+        assert len(rcv_msg_list) == 1
+        assert rcv_msg_list[0]["data"] == "vm died"
+
     def test_start_vm_termination_2(self):
         self.ps = self.vmm.rc.pubsub(ignore_subscribe_messages=True)
         self.ps.subscribe(PUBSUB_MB)
@@ -387,6 +564,87 @@ class TestManager(object):
         assert r3[0].vm_name == "a1"
         assert r3[1].vm_name == "a2"
 
+    def test_get_all_vm_single_round_trip(self, f_second_group):
+        for idx in range(10):
+            self.vmm.add_vm_to_pool("127.0.0.{}".format(idx), "vm_{}".format(idx), idx % 2)
+        # record without VMD should be skipped
+        self.rc.sadd(KEY_VM_POOL.format(group=0), "missing")
+
+        with mock.patch.object(self.vmm.rc, "hgetall") as mc_hgetall:
+            vmd_list = self.vmm.get_all_vm()
+        assert not mc_hgetall.called
+        assert sorted(vmd.vm_name for vmd in vmd_list) == ["vm_{}".format(idx) for idx in range(10)]
+
+    def test_snapshot(self, f_second_group):
+        vmd_a1 = self.vmm.add_vm_to_pool("127.0.0.1", "a1", 0)
+        self.vmm.add_vm_to_pool("127.0.0.2", "a2", 0)
+        self.vmm.add_vm_to_pool("127.0.0.1", "b1", 1)
+        vmd_a1.store_field(self.rc, "state", VmStates.READY)
+        vmd_a1.store_field(self.rc, "last_release", 123)
+
+        snapshot = self.vmm.get_snapshot()
+        # further changes are not visible in the snapshot
+        self.vmm.add_vm_to_pool("127.0.0.3", "b2", 1)
+
+        assert len(snapshot.get_all_vm()) == 3
+        assert sorted(vmd.vm_name for vmd in snapshot.get_all_vm_in_group(0)) == ["a1", "a2"]
+        ready = snapshot.get_vm_by_group_and_state_list(None, [VmStates.READY])
+        assert [vmd.vm_name for vmd in ready] == ["a1"]
+        assert ready[0].last_release == "123"
+        assert snapshot.get_vm_by_group_and_state_list(1, [VmStates.READY]) == []
+        assert sorted(vmd.vm_name for vmd in snapshot.lookup_vms_by_ip("127.0.0.1")) == ["a1", "b1"]
+
+    def get_state_index(self, state, group=0):
+        return self.rc.smembers(KEY_VM_STATE_INDEX.format(group=group, state=state))
+
+    def test_state_index(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        assert self.get_state_index(VmStates.GOT_IP) == {self.vm_name}
+
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+        assert self.get_state_index(VmStates.GOT_IP) == set()
+        assert self.get_state_index(VmStates.READY) == {self.vm_name}
+
+        self.vmm.acquire_vm(self.group, self.username, self.pid)
+        assert self.get_state_index(VmStates.READY) == set()
+        assert self.get_state_index(VmStates.IN_USE) == {self.vm_name}
+        assert [x.vm_name for x in self.vmm.get_vm_by_group_and_state_list(
+            None, [VmStates.IN_USE])] == [self.vm_name]
+
+        self.vmm.release_vm(self.vm_name, self.group)
+        assert self.get_state_index(VmStates.IN_USE) == set()
+        assert self.get_state_index(VmStates.READY) == {self.vm_name}
+
+        assert self.vmm.lua_scripts["set_checking_state"](
+            keys=[vmd.vm_key] + state_index_keys(self.group), args=[1]) == "OK"
+        assert self.get_state_index(VmStates.CHECK_HEALTH) == {self.vm_name}
+        self.vmm.mark_vm_check_failed(self.vm_name, self.group)
+        assert self.get_state_index(VmStates.CHECK_HEALTH) == set()
+        assert self.get_state_index(VmStates.CHECK_HEALTH_FAILED) == {self.vm_name}
+
+        self.vmm.start_vm_termination(self.vm_name)
+        assert self.get_state_index(VmStates.CHECK_HEALTH_FAILED) == set()
+        assert self.get_state_index(VmStates.TERMINATING) == {self.vm_name}
+
+        self.vmm.remove_vm_from_pool(self.vm_name)
+        assert self.get_state_index(VmStates.TERMINATING) == set()
+
+    def test_mark_server_start_rebuilds_state_index(self, mc_time):
+        mc_time.time.return_value = 0
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        # simulate index which got out of sync
+        self.rc.hset(vmd.vm_key, "state", VmStates.READY)
+        self.rc.sadd(KEY_VM_STATE_INDEX.format(group=self.group, state=VmStates.IN_USE), "foo")
+
+        self.vmm.mark_server_start()
+        assert self.get_state_index(VmStates.GOT_IP) == set()
+        assert self.get_state_index(VmStates.IN_USE) == set()
+        assert self.get_state_index(VmStates.READY) == {self.vm_name}
+
     def test_mark_server_start(self, mc_time):
         assert self.rc.hget(KEY_SERVER_INFO, "server_start_timestamp") is None
         for i in range(100):
@@ -0,0 +1,46 @@
+# coding: utf-8
+
+from backend.vm_manage.planner import group_demand, plan_group, SpawnPlan
+
+
+GROUP_OPTS = {
+    "archs": ["i386", "x86_64"],
+    "max_vm_total": 10,
+    "max_spawn_processes": 4,
+    "vm_idle_reserve": 1,
+}
+
+
+def test_group_demand():
+    counts = {
+        "pending": {"i386": 2, "x86_64": 3, "armhfp": 7},
+        "arrived": {"x86_64": 4, "armhfp": 100},
+        "window": 600,
+    }
+    # 4 tasks in 10 minutes, one more expected in 100 seconds
+    assert group_demand(GROUP_OPTS, counts, 100) == 6
+    assert group_demand(GROUP_OPTS, counts, 0) == 5
+    assert group_demand(GROUP_OPTS, {"pending": {}, "arrived": {}, "window": 600}, 300) == 0
+
+
+def test_plan_group_spawn():
+    # 3 VMs available for 8 builds, at most 4 spawn processes
+    assert plan_group(GROUP_OPTS, 8, ready=1, idle_clean=["a"], starting=1, active=4, spawning=1) == \
+        SpawnPlan(3, [], 8)
+    # total limit
+    assert plan_group(GROUP_OPTS, 8, ready=1, idle_clean=[], starting=0, active=9, spawning=0) == \
+        SpawnPlan(1, [], 8)
+    assert plan_group(GROUP_OPTS, 8, ready=0, idle_clean=[], starting=0, active=10, spawning=0).spawn == 0
+    assert plan_group(GROUP_OPTS, 8, ready=0, idle_clean=[], starting=0, active=2, spawning=4).spawn == 0
+
+
+def test_plan_group_terminate():
+    idle_clean = ["a", "b", "c"]
+    # enough VMs, one kept in reserve
+    assert plan_group(GROUP_OPTS, 2, ready=3, idle_clean=idle_clean, starting=0, active=5, spawning=0) == \
+        SpawnPlan(0, [], 2)
+    assert plan_group(GROUP_OPTS, 0, ready=3, idle_clean=idle_clean, starting=1, active=5, spawning=0) == \
+        SpawnPlan(0, ["a", "b", "c"], 0)
+    # dirty VMs are not terminated
+    assert plan_group(GROUP_OPTS, 0, ready=3, idle_clean=["c"], starting=0, active=3, spawning=0) == \
+        SpawnPlan(0, ["c"], 0)
@@ -178,6 +178,11 @@ class TestTerminate(object):
             '"topic": "vm_terminated", "group": 0, "result": "OK"}')
         assert mc_rc.publish.call_args == expected_call
 
+    @mock.patch("{}.close_connections".format(MODULE_REF))
+    def test_terminate_vm_closes_connections(self, mc_close, mc_run_ans, mc_grc):
+        terminate_vm(self.opts, self.terminate_pb_path, 0, self.vm_name, self.vm_ip)
+        assert mc_close.call_args[0][:2] == (self.opts, self.vm_ip)
+
     def test_do_spawn_and_publish_error(self, mc_run_ans, mc_grc):
         mc_grc.side_effect = ConnectionError()
 
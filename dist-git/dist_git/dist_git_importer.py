@@ -420,8 +420,10 @@ class DistGitImporter(object):
     def try_to_obtain_new_tasks(self, exclude=[], limit=1):
         log.debug("1. Try to get task data")
         try:
-            # get the data
-            r = get(self.get_url)
+            # get the data, frontend holds the request for a while when there is nothing to import
+            r = get(self.get_url,
+                    params={"wait": self.opts.sleep_time, "exclude": ",".join(exclude)},
+                    timeout=self.opts.sleep_time + 60)
             # take the first task
             builds_list = filter(lambda x: x["task_id"] not in exclude, r.json()["builds"])
             if len(builds_list) == 0:
@@ -566,10 +568,12 @@ class DistGitImporter(object):
                 time.sleep(self.opts.pool_busy_sleep_time)
                 continue
 
+            poll_start = time.time()
             mb_tasks = self.try_to_obtain_new_tasks(exclude=[w.id for w in pool],
                                                     limit=pool.workers - len(pool))
             if not mb_tasks:
-                time.sleep(self.opts.sleep_time)
+                # the request itself may have already waited for new tasks
+                time.sleep(max(0, self.opts.sleep_time - (time.time() - poll_start)))
                 continue
 
             for mb_task in mb_tasks:
@@ -190,6 +190,12 @@ class TestDistGitImporter(object):
         assert task.branch == self.BRANCH
         assert task.package_url == "http://front/tmp/tmp_2/pkg_2.src.rpm"
 
+    def test_try_to_obtain_long_polls(self, mc_get):
+        mc_get.return_value.json.return_value = {"builds": [self.task_data_1, self.task_data_2]}
+        task = self.dgi.try_to_obtain_new_tasks(exclude=[self.task_data_1["task_id"]])[0]
+        assert task.task_id == self.task_data_2["task_id"]
+        assert mc_get.call_args[1]["params"] == {"wait": 10, "exclude": self.task_data_1["task_id"]}
+
     def test_try_to_obtain_new_task_unknown_source_type(self, mc_get):
         task_data = copy.deepcopy(self.task_data_1)
         task_data["source_type"] = 999999
@@ -337,6 +343,7 @@ class TestDistGitImporter(object):
             self.dgi.is_running = False
 
         mc_time.sleep.side_effect = stop_run
+        mc_time.time.return_value = 1000
 
         self.dgi.try_to_obtain_new_tasks.return_value = None
         self.dgi.run()
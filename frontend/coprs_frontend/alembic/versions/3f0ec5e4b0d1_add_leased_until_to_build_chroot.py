@@ -0,0 +1,22 @@
+"""add leased_until column to build_chroot
+
+Revision ID: 3f0ec5e4b0d1
+Revises: 149da7c4ac2f
+Create Date: 2026-10-18 10:12:31.420518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f0ec5e4b0d1'
+down_revision = '149da7c4ac2f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('build_chroot', sa.Column('leased_until', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('build_chroot', 'leased_until')
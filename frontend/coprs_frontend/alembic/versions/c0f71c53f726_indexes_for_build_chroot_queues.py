@@ -0,0 +1,39 @@
+"""partial indexes for queries on unfinished build chroots
+
+Revision ID: c0f71c53f726
+Revises: cd8e0519c225
+Create Date: 2026-10-18 22:37:45.108311
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c0f71c53f726'
+down_revision = 'cd8e0519c225'
+
+from alembic import op
+import sqlalchemy as sa
+
+from coprs.helpers import StatusEnum
+
+
+def status_condition(*statuses):
+    return "status IN ({})".format(", ".join(str(StatusEnum(status)) for status in statuses))
+
+
+UNFINISHED_STATUS_CONDITION = status_condition("importing", "pending", "starting", "running")
+QUEUED_STATUS_CONDITION = status_condition("pending", "running")
+
+
+def upgrade():
+    op.create_index('build_chroot_unfinished_status_build_id', 'build_chroot', ['status', 'build_id'],
+                    unique=False, postgresql_where=sa.text(UNFINISHED_STATUS_CONDITION))
+    # same order as BuildsLogic.get_build_task_candidates, so the index can be used for it
+    op.create_index('build_chroot_queued_queue_tag', 'build_chroot', [sa.text('queue_tag NULLS FIRST')],
+                    unique=False, postgresql_where=sa.text(QUEUED_STATUS_CONDITION))
+    op.create_index('build_submitted_on', 'build', ['submitted_on'], unique=False)
+
+
+def downgrade():
+    op.drop_index('build_submitted_on', table_name='build')
+    op.drop_index('build_chroot_queued_queue_tag', table_name='build_chroot')
+    op.drop_index('build_chroot_unfinished_status_build_id', table_name='build_chroot')
@@ -0,0 +1,44 @@
+"""fair-share build queue: queue_tag column and build_queue_owner table
+
+Revision ID: cd8e0519c225
+Revises: 3f0ec5e4b0d1
+Create Date: 2026-10-18 21:04:12.573019
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'cd8e0519c225'
+down_revision = '3f0ec5e4b0d1'
+
+from alembic import op
+import sqlalchemy as sa
+
+from coprs.helpers import StatusEnum
+
+
+UNFINISHED_STATUSES = [StatusEnum(status) for status in ["importing", "pending", "starting", "running"]]
+
+
+def upgrade():
+    op.create_table('build_queue_owner',
+        sa.Column('owner_name', sa.String(length=150), nullable=False),
+        sa.Column('weight', sa.Float(), server_default='1', nullable=False),
+        sa.Column('last_tag', sa.Float(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('owner_name'),
+        sa.CheckConstraint('weight > 0', name='build_queue_owner_weight_positive')
+    )
+    op.add_column('build_chroot', sa.Column('queue_tag', sa.Float(), nullable=True))
+
+    # unfinished tasks keep their order, background ones go after the others
+    # (1e12 is BACKGROUND_QUEUE_TAG_OFFSET)
+    op.execute("""
+UPDATE build_chroot SET queue_tag = CASE WHEN build.is_background THEN 1e12 + build.submitted_on
+                                         ELSE build_chroot.build_id END
+FROM build
+WHERE build.id = build_chroot.build_id AND build_chroot.status IN ({})
+""".format(", ".join(map(str, UNFINISHED_STATUSES))))
+
+
+def downgrade():
+    op.drop_column('build_chroot', 'queue_tag')
+    op.drop_table('build_queue_owner')
@@ -0,0 +1,149 @@
+#!/usr/bin/python2
+# coding: utf-8
+
+"""
+Simulates a build farm fed by a skewed submission pattern and compares how
+long builds wait for a builder with the old FIFO order of build tasks and
+with the fair-share queue (BuildsLogic.get_build_task).
+
+One heavy user submits a big batch of builds at the start, several light
+users submit a few builds each, spread over the simulated period. Builders
+take the next task whenever they are free, every build takes a random time
+around --duration. Time is simulated, the tasks are stored in and picked
+from a real database, so it also shows how long picking one task takes.
+
+Creates its tables in the database from the config, run it with a throwaway
+one, e.g. the in-memory sqlite from the unit test config:
+
+    COPR_CONFIG=config/copr_unit_test.conf PYTHONPATH=. \\
+        python2 benchmarks/fair_share.py --heavy 2000 --light-users 5 --light-builds 20
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import argparse
+import random
+import time
+
+from coprs import db, models
+from coprs.helpers import StatusEnum
+from coprs.logic.builds_logic import BuildsLogic
+
+
+def pick_fifo():
+    return (BuildsLogic.get_build_task_candidates().order_by(None)
+            .order_by(models.Build.is_background.asc(), models.BuildChroot.build_id.asc())
+            .first())
+
+
+MODES = {
+    "fifo": pick_fifo,
+    "fair": BuildsLogic.get_build_task,
+}
+
+
+def prepare_db(light_users):
+    db.drop_all()
+    db.create_all()
+    chroot = models.MockChroot(os_release="fedora", os_version="25", arch="x86_64", is_active=True)
+    coprs = {}
+    for name in ["heavy"] + ["light{}".format(i) for i in range(light_users)]:
+        user = models.User(username=name, mail="{}@example.com".format(name))
+        copr = models.Copr(name="project", user=user)
+        copr.copr_chroots.append(models.CoprChroot(mock_chroot=chroot))
+        db.session.add_all([user, copr])
+        coprs[name] = copr
+    db.session.commit()
+    return coprs
+
+
+def submissions(args):
+    """
+    :return: sorted list of (simulated time, owner name)
+    """
+    result = [(0, "heavy")] * args.heavy
+    for user in range(args.light_users):
+        result.extend((random.uniform(0, args.span), "light{}".format(user))
+                      for _ in range(args.light_builds))
+    return sorted(result)
+
+
+def simulate(args, mode):
+    random.seed(args.seed)
+    coprs = prepare_db(args.light_users)
+    pending = submissions(args)
+    pick = MODES[mode]
+
+    submitted = {}
+    waits = {"heavy": [], "light": []}
+    running = []  # (end time, build chroot)
+    pick_times = []
+    now = 0
+    while pending or running or submitted:
+        while pending and pending[0][0] <= now:
+            _, owner = pending.pop(0)
+            build = BuildsLogic.add(coprs[owner].user, "pkg", coprs[owner], skip_import=True)
+            db.session.flush()
+            submitted[build.id] = (now, owner)
+
+        for end, task in [item for item in running if item[0] <= now]:
+            running.remove((end, task))
+            task.status = StatusEnum("succeeded")
+            task.ended_on = int(time.time())
+
+        while len(running) < args.builders:
+            start = time.time()
+            task = pick()
+            pick_times.append(time.time() - start)
+            if not task:
+                break
+            task.status = StatusEnum("running")
+            task.started_on = int(time.time())
+            submitted_at, owner = submitted.pop(task.build_id)
+            waits["heavy" if owner == "heavy" else "light"].append(now - submitted_at)
+            running.append((now + random.expovariate(1 / args.duration), task))
+        db.session.commit()
+
+        if not pending and not submitted and running:
+            now = min(end for end, _ in running)
+        else:
+            now += args.step
+    return waits, now, pick_times
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--builders", type=int, default=20)
+    parser.add_argument("--heavy", type=int, default=2000, help="builds of the heavy user submitted at once")
+    parser.add_argument("--light-users", type=int, default=5)
+    parser.add_argument("--light-builds", type=int, default=20, help="builds of each light user")
+    parser.add_argument("--span", type=float, default=6 * 3600,
+                        help="light users submit within this many simulated seconds")
+    parser.add_argument("--duration", type=float, default=600, help="mean build duration in seconds")
+    parser.add_argument("--step", type=float, default=30, help="simulation step in seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mode", choices=sorted(MODES), action="append",
+                        help="can be given more times, default is all modes")
+    args = parser.parse_args()
+
+    print("{:6} {:>14} {:>14} {:>14} {:>14} {:>10} {:>12}".format(
+        "mode", "light avg [s]", "light p95 [s]", "heavy avg [s]", "heavy p95 [s]",
+        "end [h]", "pick [ms]"))
+    for mode in args.mode or sorted(MODES):
+        waits, end, pick_times = simulate(args, mode)
+        print("{:6} {:14.0f} {:14.0f} {:14.0f} {:14.0f} {:10.1f} {:12.2f}".format(
+            mode,
+            sum(waits["light"]) / max(len(waits["light"]), 1), percentile(waits["light"], 0.95),
+            sum(waits["heavy"]) / max(len(waits["heavy"]), 1), percentile(waits["heavy"], 0.95),
+            end / 3600, 1000 * sum(pick_times) / max(len(pick_times), 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python2
+# coding: utf-8
+
+"""
+Measures the queries backend polls for build tasks on a large synthetic
+database and prints their query plans.
+
+Seeds --builds builds with --chroots build chroots each, all but
+--unfinished of them finished, then runs every query --runs times and prints
+the median latency. With --drop-indexes the partial indexes on build_chroot
+(and the build.submitted_on index) are dropped first, to compare with the
+plans the queries had before them.
+
+Creates its tables in the database from the config, run it with a throwaway
+one; the in-memory sqlite from the unit test config works, postgresql gives
+the plans that matter in production:
+
+    COPR_CONFIG=config/copr_unit_test.conf PYTHONPATH=. \\
+        python2 benchmarks/queue_queries.py --builds 200000 --chroots 10
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import argparse
+import random
+import time
+
+from sqlalchemy.sql import text
+
+from coprs import db, models
+from coprs.constants import FAIR_SHARE_CANDIDATES
+from coprs.helpers import StatusEnum
+from coprs.logic.builds_logic import BuildsLogic
+
+
+INDEXES = [
+    "build_chroot_unfinished_status_build_id",
+    "build_chroot_queued_queue_tag",
+    "build_submitted_on",
+]
+
+UNFINISHED = ["importing", "pending", "starting", "running"]
+
+QUERIES = [
+    ("get_build_task", lambda: BuildsLogic.get_build_task_candidates().limit(FAIR_SHARE_CANDIDATES)),
+    ("get_build_task_queue", lambda: BuildsLogic.get_build_task_queue().limit(200)),
+    ("get_build_importing_queue", lambda: BuildsLogic.get_build_importing_queue().limit(200)),
+    ("get_build_tasks(running)", lambda: BuildsLogic.get_build_tasks(StatusEnum("running"))),
+    # the two queries of get_pending_counts_by_arch, without grouping
+    ("pending counts by arch", lambda: (
+        db.session.query(models.BuildChroot.build_id)
+        .join(models.Build).join(models.MockChroot)
+        .filter(models.Build.canceled == False)
+        .filter(text(models.UNFINISHED_STATUS_CONDITION))
+        .filter(models.BuildChroot.status == StatusEnum("pending")))),
+    ("arrived counts by arch", lambda: (
+        db.session.query(models.BuildChroot.build_id)
+        .join(models.Build).join(models.MockChroot)
+        .filter(models.Build.submitted_on > int(time.time()) - 600))),
+]
+
+
+def seed(args):
+    db.drop_all()
+    db.create_all()
+    engine = db.engine
+    engine.execute(models.User.__table__.insert(), username="user", mail="user@example.com")
+    engine.execute(models.Copr.__table__.insert(), [
+        {"id": copr_id, "name": "project{}".format(copr_id), "user_id": 1} for copr_id in range(1, 101)])
+    engine.execute(models.MockChroot.__table__.insert(), [
+        {"id": chroot_id, "os_release": "fedora", "os_version": str(chroot_id), "arch": "x86_64",
+         "is_active": True} for chroot_id in range(1, args.chroots + 1)])
+
+    now = int(time.time())
+    batch = 10000
+    for first in range(1, args.builds + 1, batch):
+        builds, build_chroots = [], []
+        for build_id in range(first, min(first + batch, args.builds + 1)):
+            unfinished = random.random() < args.unfinished
+            builds.append({
+                "id": build_id, "copr_id": random.randint(1, 100), "user_id": 1,
+                "submitted_on": now - (args.builds - build_id) * 60,
+                "canceled": random.random() < 0.01, "is_background": random.random() < 0.05,
+            })
+            for chroot_id in range(1, args.chroots + 1):
+                status = random.choice(UNFINISHED) if unfinished else random.choice(["succeeded", "failed"])
+                build_chroots.append({
+                    "build_id": build_id, "mock_chroot_id": chroot_id, "status": StatusEnum(status),
+                    "started_on": None if unfinished else now, "ended_on": None if unfinished else now,
+                    "queue_tag": float(build_id) if unfinished else None,
+                })
+        engine.execute(models.Build.__table__.insert(), builds)
+        engine.execute(models.BuildChroot.__table__.insert(), build_chroots)
+
+    if args.drop_indexes:
+        for index in INDEXES:
+            engine.execute("DROP INDEX {}".format(index))
+    engine.execute("ANALYZE")
+
+
+def explain(query):
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+    if db.engine.dialect.name == "sqlite":
+        return "\n".join(tuple(row)[-1] for row in db.session.execute("EXPLAIN QUERY PLAN " + sql))
+    return "\n".join(row[0] for row in db.session.execute("EXPLAIN ANALYZE " + sql))
+
+
+def measure(query_factory, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        query_factory().all()
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--builds", type=int, default=200000)
+    parser.add_argument("--chroots", type=int, default=10, help="build chroots per build")
+    parser.add_argument("--unfinished", type=float, default=0.005,
+                        help="share of builds which are not finished")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--drop-indexes", action="store_true", help="measure without the partial indexes")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start = time.time()
+    seed(args)
+    print("seeded {} build chroots in {:.1f}s, indexes {}\n".format(
+        args.builds * args.chroots, time.time() - start, "dropped" if args.drop_indexes else "present"))
+
+    for name, query_factory in QUERIES:
+        print("== {}: {:.2f} ms".format(name, 1000 * measure(query_factory, args.runs)))
+        print(explain(query_factory()))
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 from __future__ import with_statement
 
 import os
+import sqlite3
 import flask
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from flask_openid import OpenID
 from flask_whooshee import Whooshee
 from openid_teams.teams import TeamsResponse
@@ -33,6 +36,21 @@ db = SQLAlchemy(app)
 whooshee = Whooshee(app)
 
 
+# pysqlite begins transactions on its own and commits them before anything
+# but DML, which breaks SAVEPOINTs (session.begin_nested); let sqlalchemy
+# emit BEGIN itself
+@event.listens_for(Engine, "connect")
+def _sqlite_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, "begin")
+def _sqlite_begin(conn):
+    if conn.dialect.name == "sqlite":
+        conn.execute("BEGIN")
+
+
 import coprs.filters
 import coprs.log
 from coprs.log import setup_log
@@ -96,3 +114,10 @@ app.register_blueprint(rest_api_bp, url_prefix=URL_PREFIX)
 
 from flask.ext.sqlalchemy import models_committed
 models_committed.connect(coprs.whoosheers.CoprWhoosheer.on_commit, sender=app)
+
+from sqlalchemy import event
+from flask.ext.sqlalchemy import SignallingSession
+from coprs.logic.backend_logic import BackendLogic
+event.listen(SignallingSession, "after_flush", BackendLogic.on_flush)
+event.listen(SignallingSession, "after_commit", BackendLogic.on_commit)
+event.listen(SignallingSession, "after_rollback", BackendLogic.on_rollback)
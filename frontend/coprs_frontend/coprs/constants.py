@@ -12,3 +12,28 @@ DEFAULT_BUILD_TIMEOUT = 3600 * 24  # 24 hours
 MIN_BUILD_TIMEOUT = 0
 MAX_BUILD_TIMEOUT = 86400
 DEFER_BUILD_SECONDS = 60
+
+# build tasks leased by backend are hidden from other dispatchers for this long
+DEFAULT_BUILD_LEASE_SECONDS = 300
+MAX_BUILD_LEASE_SECONDS = 3600
+MAX_LEASED_BUILD_TASKS = 100
+
+# fair-share build scheduling: the next build task is chosen among this many
+# pending tasks with the lowest queue tags, by running builds of their owners
+FAIR_SHARE_CANDIDATES = 20
+# queue tags of background builds start here, so they go after all normal builds
+BACKGROUND_QUEUE_TAG_OFFSET = 1e12
+
+# max number of actions handed over to backend by one /backend/waiting_actions/ request
+MAX_WAITING_ACTIONS = 100
+
+# longest period (in seconds) for which /backend/pending_build_counts/ counts submitted builds
+MAX_ARRIVAL_WINDOW_SECONDS = 24 * 3600
+
+# frontend publishes on these redis channels when new work of the given kind
+# (build, action, import) appears, long-polling backend endpoints wait for it
+WORK_AVAILABLE_PUBSUB = "copr:frontend:work_available:pubsub::{kind}"
+# maximum time (in seconds) for which long-polling backend endpoints wait for new work;
+# each waiting request holds a WSGI thread for that long, size the WSGI daemon for
+# one such request per backend dispatcher (builds, actions) on top of the web traffic
+MAX_WORK_WAIT_SECONDS = 30
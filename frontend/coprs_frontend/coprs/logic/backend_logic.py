@@ -1,8 +1,11 @@
 # coding: utf-8
 
 import json
+import time
+from redis.exceptions import RedisError
 from sqlalchemy import or_
 from sqlalchemy import and_
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.sql import false
 
 from coprs import app
@@ -10,6 +13,8 @@ from coprs import db
 from coprs import exceptions
 from coprs import models
 from coprs import helpers
+from coprs import rcp
+from coprs.constants import WORK_AVAILABLE_PUBSUB, MAX_WORK_WAIT_SECONDS
 
 from coprs.logic.coprs_logic import MockChrootsLogic
 
@@ -17,4 +22,106 @@ log = app.logger
 
 
 class BackendLogic(object):
-    pass
+
+    @classmethod
+    def get_work_kinds(cls, session):
+        """
+        :param session: session in the pre-flush state, i.e. from after_flush event
+        :return: set of work kinds ("build", "action", "import") made available by the flush
+        """
+        queued_kinds = {
+            helpers.StatusEnum("pending"): "build",
+            helpers.StatusEnum("importing"): "import",
+        }
+        kinds = set()
+        for obj in session.new:
+            if isinstance(obj, models.Action):
+                kinds.add("action")
+            elif isinstance(obj, models.BuildChroot) and obj.status in queued_kinds:
+                kinds.add(queued_kinds[obj.status])
+
+        # only status changes add work, e.g. leasing a pending task doesn't
+        for obj in session.dirty:
+            if isinstance(obj, models.BuildChroot):
+                kinds.update(queued_kinds[status] for status in get_history(obj, "status").added
+                             if status in queued_kinds)
+        return kinds
+
+    @classmethod
+    def publish_work_available(cls, kinds):
+        """
+        Wake up backend and dist-git requests waiting for new work of the given kinds
+        """
+        try:
+            rc = rcp.get_connection()
+            for kind in kinds:
+                rc.publish(WORK_AVAILABLE_PUBSUB.format(kind=kind), "")
+        except RedisError as err:
+            # waiting requests still time out and poll again
+            log.exception("Failed to publish new work notification: {}".format(err))
+
+    @classmethod
+    def on_flush(cls, session, flush_context):
+        """Should be registered as after_flush event of the session class."""
+        session.info.setdefault("work_kinds", set()).update(cls.get_work_kinds(session))
+
+    @classmethod
+    def on_commit(cls, session):
+        """Should be registered as after_commit event of the session class."""
+        kinds = session.info.pop("work_kinds", None)
+        if kinds:
+            cls.publish_work_available(kinds)
+
+    @classmethod
+    def on_rollback(cls, session):
+        """Should be registered as after_rollback event of the session class."""
+        session.info.pop("work_kinds", None)
+
+    @classmethod
+    def wait_for_work(cls, kinds, wait, check):
+        """
+        Long-polling helper, call `check` and if it doesn't find any work,
+        wait up to `wait` seconds for notifications about new work
+        of the given kinds and call `check` again after each of them.
+
+        Subscription is done before the first `check`, so work committed
+        in the meantime is not missed.
+
+        :param kinds: list of work kinds to wait for
+        :param wait: max time to wait in seconds, 0 means don't wait
+        :param check: callable returning the found work (anything falsy if none)
+        :return: result of the last `check` call
+        """
+        wait = min(wait, MAX_WORK_WAIT_SECONDS)
+        if wait <= 0:
+            return check()
+
+        try:
+            pubsub = rcp.get_connection().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*[WORK_AVAILABLE_PUBSUB.format(kind=kind) for kind in kinds])
+        except RedisError as err:
+            log.exception("Failed to subscribe for new work notifications: {}".format(err))
+            return check()
+
+        try:
+            result = check()
+            if result:
+                return result
+
+            # don't keep the database transaction open while waiting
+            db.session.rollback()
+
+            deadline = time.time() + wait
+            while time.time() < deadline:
+                if pubsub.get_message(timeout=deadline - time.time()):
+                    # somebody else could have taken the work already, keep waiting then
+                    result = check()
+                    if result:
+                        return result
+                    db.session.rollback()
+            return result
+        except RedisError as err:
+            log.exception("Failed to wait for new work notification: {}".format(err))
+            return check()
+        finally:
+            pubsub.close()
@@ -9,11 +9,12 @@ import sqlite3
 from sqlalchemy.sql import text
 from sqlalchemy import or_
 from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import false,true
 from werkzeug.utils import secure_filename
-from sqlalchemy import desc,asc, bindparam, Integer
+from sqlalchemy import desc,asc, bindparam, Integer, func
 from collections import defaultdict
 
 from coprs import app
@@ -21,7 +22,8 @@ from coprs import db
 from coprs import exceptions
 from coprs import models
 from coprs import helpers
-from coprs.constants import DEFAULT_BUILD_TIMEOUT, MAX_BUILD_TIMEOUT, DEFER_BUILD_SECONDS
+from coprs.constants import DEFAULT_BUILD_TIMEOUT, MAX_BUILD_TIMEOUT, DEFER_BUILD_SECONDS, \
+    FAIR_SHARE_CANDIDATES, BACKGROUND_QUEUE_TAG_OFFSET
 from coprs.exceptions import MalformedArgumentException, ActionInProgressException, InsufficientRightsException
 from coprs.helpers import StatusEnum
 
@@ -48,6 +50,8 @@ class BuildsLogic(object):
         result = models.BuildChroot.query.join(models.Build)\
             .filter(models.BuildChroot.status == status)\
             .order_by(models.BuildChroot.build_id.asc())
+        if status in models.UNFINISHED_STATUSES:
+            result = result.filter(text(models.UNFINISHED_STATUS_CONDITION))
         if background is not None:
             result = result.filter(models.Build.is_background == (true() if background else false()))
         return result
@@ -79,6 +83,7 @@ class BuildsLogic(object):
         """
         query = (models.BuildChroot.query.join(models.Build)
                  .filter(models.Build.canceled == false())
+                 .filter(text(models.UNFINISHED_STATUS_CONDITION))
                  .filter(models.BuildChroot.status == helpers.StatusEnum("importing")))
         query = query.order_by(models.BuildChroot.build_id.asc())
         return query
@@ -93,6 +98,7 @@ class BuildsLogic(object):
         query = (models.BuildChroot.query.join(models.Build)
                  .filter(models.Build.canceled == false())
                  .filter(models.Build.is_background == (true() if is_background else false()))
+                 .filter(text(models.UNFINISHED_STATUS_CONDITION))
                  .filter(or_(
                      models.BuildChroot.status == helpers.StatusEnum("pending"),
                      models.BuildChroot.status == helpers.StatusEnum("starting"),
@@ -116,23 +122,192 @@ class BuildsLogic(object):
         return query
 
     @classmethod
-    def get_build_task(cls):
+    def get_build_task_candidates(cls):
+        """
+        Returns BuildChroots which can be handed over to the backend,
+        i.e. pending (or stuck in running state for too long), not deferred
+        and not leased by some backend dispatcher, in the fair-share queue order
+        """
+        now = int(time.time())
         query = (models.BuildChroot.query.join(models.Build)
                  .filter(models.Build.canceled == false())
+                 .filter(text(models.QUEUED_STATUS_CONDITION))
                  .filter(or_(
                      models.BuildChroot.status == helpers.StatusEnum("pending"),
                      and_(
                          models.BuildChroot.status == helpers.StatusEnum("running"),
-                         models.BuildChroot.started_on < int(time.time() - 1.1 * MAX_BUILD_TIMEOUT),
+                         models.BuildChroot.started_on < int(now - 1.1 * MAX_BUILD_TIMEOUT),
                          models.BuildChroot.ended_on.is_(None)
                      )
                  ))
                  .filter(or_(
                      models.BuildChroot.last_deferred.is_(None),
-                     models.BuildChroot.last_deferred < int(time.time() - DEFER_BUILD_SECONDS)
+                     models.BuildChroot.last_deferred < int(now - DEFER_BUILD_SECONDS)
                  ))
-        ).order_by(models.Build.is_background.asc(), models.BuildChroot.build_id.asc())
-        return query.first()
+                 .filter(or_(
+                     models.BuildChroot.leased_until.is_(None),
+                     models.BuildChroot.leased_until < now
+                 ))
+        # tasks created without BuildsLogic.add() have no tag, don't let them starve
+        ).order_by(models.BuildChroot.queue_tag.asc().nullsfirst(), models.BuildChroot.build_id.asc())
+        return query
+
+    @classmethod
+    def get_build_task(cls):
+        candidates = (cls.get_build_task_candidates()
+                      .options(joinedload(models.BuildChroot.build).joinedload(models.Build.copr))
+                      .limit(FAIR_SHARE_CANDIDATES).all())
+        tasks = cls.pick_fair_share(candidates, 1)
+        return tasks[0] if tasks else None
+
+    @classmethod
+    def get_queue_virtual_time(cls):
+        """
+        Queue tag of the first pending (not background) task, or of the last
+        queued task when nothing is pending
+        """
+        virtual_time = (db.session.query(func.min(models.BuildChroot.queue_tag))
+                        .filter(models.BuildChroot.status == helpers.StatusEnum("pending"))
+                        .filter(models.BuildChroot.queue_tag < BACKGROUND_QUEUE_TAG_OFFSET)
+                        .scalar())
+        if virtual_time is None:
+            virtual_time = db.session.query(func.max(models.BuildQueueOwner.last_tag)).scalar()
+        return virtual_time or 0.0
+
+    @classmethod
+    def assign_queue_tags(cls, build):
+        """
+        Put build tasks of a new build into the fair-share queue.
+
+        Each task of an owner is queued one slot (1 / weight of the owner) after the
+        owner's previous task, but not before the virtual time, i.e. the first pending
+        task. An owner submitting many builds thus gets every n-th builder when n owners
+        are waiting, instead of all builders until the backlog drains, and an owner who
+        was idle can't claim the time saved. Background builds are queued after all
+        the others, in the order they were submitted.
+        """
+        if build.is_background:
+            for build_chroot in build.build_chroots:
+                build_chroot.queue_tag = BACKGROUND_QUEUE_TAG_OFFSET + build.submitted_on
+            return
+
+        owner = cls.get_queue_owner(build.copr.owner_name)
+        tag = max(owner.last_tag, cls.get_queue_virtual_time())
+        for build_chroot in build.build_chroots:
+            tag += 1.0 / owner.weight
+            build_chroot.queue_tag = tag
+        owner.last_tag = tag
+
+    @classmethod
+    def get_queue_owner(cls, owner_name):
+        """
+        :return: BuildQueueOwner of the owner, locked until the end of
+            the transaction, created if the owner has none yet
+        """
+        query = (models.BuildQueueOwner.query
+                 .filter(models.BuildQueueOwner.owner_name == owner_name)
+                 .with_for_update())
+        owner = query.first()
+        if owner is None:
+            # a missing row can't be locked, another submission of the same
+            # owner may insert it meanwhile; use that one then
+            try:
+                with db.session.begin_nested():
+                    db.session.add(models.BuildQueueOwner(owner_name=owner_name))
+            except IntegrityError:
+                pass
+            owner = query.one()
+        return owner
+
+    @classmethod
+    def get_running_counts_by_owner(cls):
+        """
+        :return: dict owner name -> number of build tasks starting or running
+        """
+        per_copr = dict(db.session.query(models.Build.copr_id, func.count(models.BuildChroot.build_id))
+                        .select_from(models.BuildChroot).join(models.Build)
+                        .filter(models.BuildChroot.status.in_([helpers.StatusEnum("starting"),
+                                                               helpers.StatusEnum("running")]))
+                        .group_by(models.Build.copr_id))
+        counts = defaultdict(int)
+        if per_copr:
+            for copr in models.Copr.query.filter(models.Copr.id.in_(per_copr.keys())):
+                counts[copr.owner_name] += per_copr[copr.id]
+        return counts
+
+    @classmethod
+    def pick_fair_share(cls, candidates, limit):
+        """
+        Select build tasks for backend, each next one of the owner with the fewest
+        running builds per weight, so that owners with many queued builds don't take
+        all builders. Tasks of owners with the same share go in the queue order.
+
+        :param candidates: BuildChroots in the queue order
+        :return: list of up to `limit` BuildChroots
+        """
+        if len(candidates) <= 1:
+            return candidates[:limit]
+
+        running = cls.get_running_counts_by_owner()
+        owners = [task.build.copr.owner_name for task in candidates]
+        weights = dict(db.session.query(models.BuildQueueOwner.owner_name, models.BuildQueueOwner.weight)
+                       .filter(models.BuildQueueOwner.owner_name.in_(set(owners))))
+
+        remaining = list(range(len(candidates)))
+        picked = []
+        while remaining and len(picked) < limit:
+            index = min(remaining, key=lambda i: (running[owners[i]] / weights.get(owners[i], 1.0), i))
+            remaining.remove(index)
+            running[owners[index]] += 1
+            picked.append(candidates[index])
+        return picked
+
+    @classmethod
+    def lease_build_tasks(cls, limit, lease_seconds, archs=None):
+        """
+        Selects up to `limit` build tasks and marks them as leased for `lease_seconds`,
+        so that they are not offered to another dispatcher until the lease expires.
+
+        :param archs: when provided, only tasks for mock chroots with these archs are leased
+        :return: list of BuildChroot
+        """
+        query = cls.get_build_task_candidates()
+        if archs:
+            query = (query.join(models.MockChroot)
+                     .filter(models.MockChroot.arch.in_(archs)))
+
+        candidates = (query.options(joinedload(models.BuildChroot.build).joinedload(models.Build.copr))
+                      .limit(max(limit, FAIR_SHARE_CANDIDATES))
+                      .with_for_update(of=models.BuildChroot).all())
+        tasks = cls.pick_fair_share(candidates, limit)
+        leased_until = int(time.time() + lease_seconds)
+        for task in tasks:
+            task.leased_until = leased_until
+            db.session.add(task)
+        return tasks
+
+    @classmethod
+    def get_pending_counts_by_arch(cls, since):
+        """
+        Counts build tasks waiting for a builder and tasks submitted recently,
+        backend plans how many builders to start from these numbers.
+
+        :param since: timestamp, tasks of builds submitted after it count as arrived
+        :return: tuple of dicts arch -> number of tasks, (pending, arrived)
+        """
+        pending = (db.session.query(models.MockChroot.arch, func.count(models.BuildChroot.build_id))
+                   .select_from(models.BuildChroot)
+                   .join(models.Build).join(models.MockChroot)
+                   .filter(models.Build.canceled == false())
+                   .filter(text(models.UNFINISHED_STATUS_CONDITION))
+                   .filter(models.BuildChroot.status == helpers.StatusEnum("pending"))
+                   .group_by(models.MockChroot.arch))
+        arrived = (db.session.query(models.MockChroot.arch, func.count(models.BuildChroot.build_id))
+                   .select_from(models.BuildChroot)
+                   .join(models.Build).join(models.MockChroot)
+                   .filter(models.Build.submitted_on > since)
+                   .group_by(models.MockChroot.arch))
+        return dict(pending.all()), dict(arrived.all())
 
     @classmethod
     def get_multiple(cls):
@@ -531,6 +706,7 @@ GROUP BY
 
             db.session.add(buildchroot)
 
+        cls.assign_queue_tags(build)
         return build
 
     @classmethod
@@ -564,6 +740,7 @@ GROUP BY
 
             db.session.add(buildchroot)
 
+        cls.assign_queue_tags(build)
         return build
 
 
@@ -642,6 +819,11 @@ GROUP BY
                     if "last_deferred" in upd_dict:
                         build_chroot.last_deferred = upd_dict["last_deferred"]
 
+                    if "leased_until" in upd_dict:
+                        build_chroot.leased_until = upd_dict["leased_until"]
+                    elif upd_dict.get("status") == StatusEnum("pending"):
+                        build_chroot.leased_until = None
+
                     db.session.add(build_chroot)
 
         for attr in ["results", "built_packages"]:
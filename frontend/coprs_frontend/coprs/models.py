@@ -475,7 +475,8 @@ class Build(db.Model, helpers.Serializer):
     """
     Representation of one build in one copr
     """
-    __table_args__ = (db.Index('build_canceled', "canceled"), )
+    __table_args__ = (db.Index('build_canceled', "canceled"),
+                      db.Index('build_submitted_on', "submitted_on"), )
 
     id = db.Column(db.Integer, primary_key=True)
     # single url to the source rpm, should not contain " ", "\n", "\t"
@@ -869,11 +870,45 @@ class CoprChroot(db.Model, helpers.Serializer):
         return self.mock_chroot.is_active
 
 
+UNFINISHED_STATUSES = [StatusEnum(status) for status in ["importing", "pending", "starting", "running"]]
+# tasks which can be handed over to backend, see BuildsLogic.get_build_task_candidates
+QUEUED_STATUSES = [StatusEnum(status) for status in ["pending", "running"]]
+
+# where clauses of the partial indexes on build_chroot; queries repeat them
+# literally, planners (sqlite at least) use a partial index only when they
+# can prove the query implies its where clause
+UNFINISHED_STATUS_CONDITION = "status IN ({})".format(", ".join(map(str, UNFINISHED_STATUSES)))
+QUEUED_STATUS_CONDITION = "status IN ({})".format(", ".join(map(str, QUEUED_STATUSES)))
+
+
+class BuildQueueOwner(db.Model):
+
+    """
+    Fair-share scheduling state of one project owner (user or @group)
+    """
+    # queue tags and shares are computed per weight
+    __table_args__ = (
+        db.CheckConstraint("weight > 0", name="build_queue_owner_weight_positive"),
+    )
+
+    owner_name = db.Column(db.String(150), primary_key=True)
+    # share of builders relative to other owners
+    weight = db.Column(db.Float, nullable=False, default=1.0, server_default="1")
+    # queue tag of the last build task queued by this owner
+    last_tag = db.Column(db.Float, nullable=False, default=0.0, server_default="0")
+
+
 class BuildChroot(db.Model, helpers.Serializer):
 
     """
     Representation of Build<->MockChroot relation
     """
+    # backend polls for unfinished tasks all the time, they are a small part of the table
+    __table_args__ = (
+        db.Index("build_chroot_unfinished_status_build_id", "status", "build_id",
+                 postgresql_where=db.text(UNFINISHED_STATUS_CONDITION),
+                 sqlite_where=db.text(UNFINISHED_STATUS_CONDITION)),
+    )
 
     mock_chroot_id = db.Column(db.Integer, db.ForeignKey("mock_chroot.id"),
                                primary_key=True)
@@ -888,6 +923,11 @@ class BuildChroot(db.Model, helpers.Serializer):
     ended_on = db.Column(db.Integer, index=True)
 
     last_deferred = db.Column(db.Integer)
+    # build task was handed over to a backend dispatcher, don't offer it again until then
+    leased_until = db.Column(db.Integer)
+    # virtual finish time in the fair-share queue, pending tasks are built in this order
+    # (see BuildsLogic.assign_queue_tags)
+    queue_tag = db.Column(db.Float)
 
     @property
     def name(self):
@@ -963,6 +1003,17 @@ class BuildChroot(db.Model, helpers.Serializer):
         return "<BuildChroot: {}>".format(self.to_dict())
 
 
+# same order as BuildsLogic.get_build_task_candidates, so the index can be used
+# for it; sqlite sorts NULLs first by itself and rejects NULLS FIRST in indexes
+QUEUED_QUEUE_TAG_INDEX = "CREATE INDEX build_chroot_queued_queue_tag ON build_chroot ({}) WHERE {}"
+db.event.listen(BuildChroot.__table__, "after_create", db.DDL(
+    QUEUED_QUEUE_TAG_INDEX.format("queue_tag NULLS FIRST", QUEUED_STATUS_CONDITION)
+).execute_if(dialect="postgresql"))
+db.event.listen(BuildChroot.__table__, "after_create", db.DDL(
+    QUEUED_QUEUE_TAG_INDEX.format("queue_tag", QUEUED_STATUS_CONDITION)
+).execute_if(dialect="sqlite"))
+
+
 class LegalFlag(db.Model, helpers.Serializer):
     id = db.Column(db.Integer, primary_key=True)
     # message from user who raised the flag (what he thinks is wrong)
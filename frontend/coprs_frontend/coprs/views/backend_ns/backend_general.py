@@ -4,11 +4,14 @@ import time
 from coprs import db, app
 from coprs import helpers
 from coprs import models
+from coprs.constants import DEFAULT_BUILD_LEASE_SECONDS, MAX_BUILD_LEASE_SECONDS, MAX_LEASED_BUILD_TASKS, \
+    MAX_WAITING_ACTIONS, MAX_ARRIVAL_WINDOW_SECONDS
 from coprs.helpers import StatusEnum
 from coprs.logic import actions_logic
+from coprs.logic.backend_logic import BackendLogic
 from coprs.logic.builds_logic import BuildsLogic
 from coprs.logic.complex_logic import ComplexLogic
-from coprs.logic.coprs_logic import CoprChrootsLogic
+from coprs.logic.coprs_logic import CoprsLogic, CoprChrootsLogic
 from coprs.logic.packages_logic import PackagesLogic
 
 from coprs.views import misc
@@ -19,12 +22,9 @@ import logging
 log = logging.getLogger(__name__)
 
 
-@backend_ns.route("/importing/")
-# FIXME I'm commented
-#@misc.backend_authenticated
-def dist_git_importing_queue():
+def get_importing_builds():
     """
-    Return list of builds that are waiting for dist git to import the sources.
+    :return: list of builds that are waiting for dist git to import the sources
     """
     builds_list = []
     builds_for_import = BuildsLogic.get_build_importing_queue().filter(models.Build.is_background == false()).limit(200).all()
@@ -45,6 +45,25 @@ def dist_git_importing_queue():
         if task_dict not in builds_list:
             builds_list.append(task_dict)
 
+    return builds_list
+
+
+@backend_ns.route("/importing/")
+# FIXME I'm commented
+#@misc.backend_authenticated
+def dist_git_importing_queue():
+    """
+    Return list of builds that are waiting for dist git to import the sources.
+
+    Optional query arguments:
+        - `wait`: when there is nothing to import, wait up to this many seconds for new builds
+        - `exclude`: comma separated task ids which are being imported already
+    """
+    exclude = set(filter(None, flask.request.args.get("exclude", "").split(",")))
+    builds_list = BackendLogic.wait_for_work(
+        ["import"], get_wait_arg(),
+        lambda: [task for task in get_importing_builds() if task["task_id"] not in exclude])
+
     response_dict = {"builds": builds_list}
 
     return flask.jsonify(response_dict)
@@ -114,57 +133,200 @@ def dist_git_upload_completed():
     return flask.jsonify(result)
 
 
+def get_build_record(task):
+    if not task:
+        return None
+
+    build_record = None
+    try:
+        build_record = {
+            "task_id": task.task_id,
+            "build_id": task.build.id,
+            "project_owner": task.build.copr.owner_name,
+            "project_name": task.build.copr.name,
+            "submitter": task.build.user.name if task.build.user else None, # there is no user for webhook builds
+            "pkgs": task.build.pkgs,  # TODO to be removed
+            "chroot": task.mock_chroot.name,
+
+            "repos": task.build.repos,
+            "memory_reqs": task.build.memory_reqs,
+            "timeout": task.build.timeout,
+            "enable_net": task.build.enable_net,
+            "git_repo": task.build.package.dist_git_repo,
+            "git_hash": task.git_hash,
+            "git_branch": helpers.chroot_to_branch(task.mock_chroot.name),
+            "package_name": task.build.package.name,
+            "package_version": task.build.pkg_version
+        }
+
+        copr_chroot = CoprChrootsLogic.get_by_name_safe(task.build.copr, task.mock_chroot.name)
+        if copr_chroot:
+            build_record["buildroot_pkgs"] = copr_chroot.buildroot_pkgs
+        else:
+            build_record["buildroot_pkgs"] = ""
+
+    except Exception as err:
+        app.logger.exception(err)
+
+    return build_record
+
+
+def get_wait_arg():
+    """
+    :return: number of seconds the long-polling request should wait for new work
+    """
+    try:
+        return max(float(flask.request.args.get("wait", 0)), 0)
+    except ValueError:
+        return 0
+
+
 @backend_ns.route("/waiting/")
 #@misc.backend_authenticated
 def waiting():
     """
     Return a single action and a single build.
+
+    Optional query arguments:
+        - `wait`: when there is nothing to do, wait up to this many seconds for new work
+        - `wait_for`: comma separated kinds of work ("build", "action") to wait for,
+          default is both
     """
-    action_record = None
-    build_record = None
+    kinds = [kind for kind in flask.request.args.get("wait_for", "build,action").split(",")
+             if kind in ["build", "action"]]
+    if not kinds:
+        return flask.jsonify({"error": "`wait_for` should list \"build\" and/or \"action\""}), 400
+    # what the last check found, returned even when none of the `kinds` showed up
+    response_dict = {"action": None, "build": None}
+
+    def check():
+        action_record = None
+
+        action = actions_logic.ActionsLogic.get_waiting().first()
+        if action:
+            action_record = action.to_dict(options={
+                "__columns_except__": ["result", "message", "ended_on"]
+            })
 
-    action = actions_logic.ActionsLogic.get_waiting().first()
-    if action:
-        action_record = action.to_dict(options={
-            "__columns_except__": ["result", "message", "ended_on"]
-        })
-
-    task = BuildsLogic.get_build_task()
-    if task:
-        try:
-            build_record = {
-                "task_id": task.task_id,
-                "build_id": task.build.id,
-                "project_owner": task.build.copr.owner_name,
-                "project_name": task.build.copr.name,
-                "submitter": task.build.user.name if task.build.user else None, # there is no user for webhook builds
-                "pkgs": task.build.pkgs,  # TODO to be removed
-                "chroot": task.mock_chroot.name,
-
-                "repos": task.build.repos,
-                "memory_reqs": task.build.memory_reqs,
-                "timeout": task.build.timeout,
-                "enable_net": task.build.enable_net,
-                "git_repo": task.build.package.dist_git_repo,
-                "git_hash": task.git_hash,
-                "git_branch": helpers.chroot_to_branch(task.mock_chroot.name),
-                "package_name": task.build.package.name,
-                "package_version": task.build.pkg_version
-            }
-
-            copr_chroot = CoprChrootsLogic.get_by_name_safe(task.build.copr, task.mock_chroot.name)
-            if copr_chroot:
-                build_record["buildroot_pkgs"] = copr_chroot.buildroot_pkgs
-            else:
-                build_record["buildroot_pkgs"] = ""
+        build_record = get_build_record(BuildsLogic.get_build_task())
 
-        except Exception as err:
-            app.logger.exception(err)
+        response_dict.update(action=action_record, build=build_record)
+        return any(response_dict[kind] for kind in kinds)
 
-    response_dict = {"action": action_record, "build": build_record}
+    BackendLogic.wait_for_work(kinds, get_wait_arg(), check)
     return flask.jsonify(response_dict)
 
 
+@backend_ns.route("/waiting_actions/")
+#@misc.backend_authenticated
+def waiting_actions():
+    """
+    Return several waiting actions in the order they were created,
+    for backends which run actions in parallel.
+
+    Optional query arguments:
+        - `count`: maximum number of actions to return
+        - `exclude`: comma separated ids of actions which backend already processes
+        - `wait`: when there is no action, wait up to this many seconds for a new one
+    """
+    try:
+        count = min(int(flask.request.args.get("count", 1)), MAX_WAITING_ACTIONS)
+        exclude = [int(action_id) for action_id in
+                   flask.request.args.get("exclude", "").split(",") if action_id]
+    except ValueError:
+        return flask.jsonify({"error": "`count` and `exclude` should be numbers"}), 400
+
+    def check():
+        query = actions_logic.ActionsLogic.get_waiting()
+        if exclude:
+            query = query.filter(models.Action.id.notin_(exclude))
+        return [action.to_dict(options={"__columns_except__": ["result", "message", "ended_on"]})
+                for action in query.limit(count)]
+
+    actions = BackendLogic.wait_for_work(["action"], get_wait_arg(), check)
+    return flask.jsonify({"actions": actions})
+
+
+@backend_ns.route("/lease_build_tasks/", methods=["POST"])
+@misc.backend_authenticated
+def lease_build_tasks():
+    """
+    Hand over several build tasks at once. Returned tasks are not offered
+    to anybody else until the lease expires or the build is started/deferred.
+
+    Expected (optional) request fields:
+        - `count`: maximum number of tasks to lease
+        - `lease`: lease duration in seconds
+        - `archs`: list of architectures the dispatcher is able to build
+        - `wait`: when there is no task, wait up to this many seconds for new builds
+    """
+    request_data = flask.request.json or {}
+    try:
+        count = min(int(request_data.get("count", 1)), MAX_LEASED_BUILD_TASKS)
+        lease = min(int(request_data.get("lease", DEFAULT_BUILD_LEASE_SECONDS)),
+                    MAX_BUILD_LEASE_SECONDS)
+        wait = max(float(request_data.get("wait", 0)), 0)
+    except (TypeError, ValueError):
+        return "Bad request, `count`, `lease` and `wait` should be numbers\n", 400
+
+    tasks = BackendLogic.wait_for_work(
+        ["build"], wait,
+        lambda: BuildsLogic.lease_build_tasks(count, lease, archs=request_data.get("archs")))
+    builds = [record for record in map(get_build_record, tasks) if record]
+    db.session.commit()
+
+    return flask.jsonify({"builds": builds})
+
+
+@backend_ns.route("/pending_build_counts/")
+#@misc.backend_authenticated
+def pending_build_counts():
+    """
+    Return numbers of pending build tasks per architecture, and how many tasks
+    per architecture were submitted recently.
+
+    Optional query arguments:
+        - `window`: count tasks of builds submitted in last `window` seconds, default 600
+    """
+    try:
+        window = min(max(int(flask.request.args.get("window", 600)), 1), MAX_ARRIVAL_WINDOW_SECONDS)
+    except ValueError:
+        return flask.jsonify({"error": "`window` should be a number"}), 400
+
+    pending, arrived = BuildsLogic.get_pending_counts_by_arch(int(time.time()) - window)
+    return flask.jsonify({"pending": pending, "arrived": arrived, "window": window})
+
+
+@backend_ns.route("/project_settings/", methods=["POST"])
+@misc.backend_authenticated
+def project_settings():
+    """
+    Return settings backend needs to know about many projects at once,
+    e.g. for pruning all the results.
+
+    Expected (optional) request field:
+        - `projects`: list of project full names (owner/name), all projects when missing
+    """
+    request_data = flask.request.json or {}
+    full_names = request_data.get("projects")
+
+    query = CoprsLogic.get_multiple()
+    if full_names is not None:
+        full_names = set(full_names)
+        query = query.filter(models.Copr.name.in_(
+            set(full_name.split("/", 1)[-1] for full_name in full_names)))
+
+    settings = {}
+    for copr in query:
+        if full_names is not None and copr.full_name not in full_names:
+            continue
+        settings[copr.full_name] = {
+            "auto_createrepo": copr.auto_createrepo,
+            "persistent": copr.persistent,
+        }
+    return flask.jsonify({"projects": settings})
+
+
 @backend_ns.route("/update/", methods=["POST", "PUT"])
 @misc.backend_authenticated
 def update():
@@ -177,9 +339,11 @@ def update():
         if typ not in request_data:
             continue
 
+        # one request could carry several updates of the same object
+        # (e.g. batched updates of different build chroots), keep their order
         to_update = {}
         for obj in request_data[typ]:
-            to_update[obj["id"]] = obj
+            to_update.setdefault(obj["id"], []).append(obj)
 
         existing = {}
         for obj in logic_cls.get_by_ids(to_update.keys()).all():
@@ -188,7 +352,8 @@ def update():
         non_existing_ids = list(set(to_update.keys()) - set(existing.keys()))
 
         for i, obj in existing.items():
-            logic_cls.update_state_from_dict(obj, to_update[i])
+            for upd_dict in to_update[i]:
+                logic_cls.update_state_from_dict(obj, upd_dict)
 
         db.session.commit()
         result.update({"updated_{0}_ids".format(typ): list(existing.keys()),
@@ -240,6 +405,7 @@ def defer_build():
             BuildsLogic.update_state_from_dict(build, {
                 "chroot": chroot,
                 "last_deferred": int(time.time()),
+                "leased_until": None,
             })
             db.session.commit()
             result["was_deferred"] = True
@@ -260,6 +426,7 @@ def reschedule_all_running():
     if to_reschedule:
         for build_chroot in to_reschedule:
             build_chroot.status = StatusEnum("pending")
+            build_chroot.leased_until = None
             db.session.add(build_chroot)
 
         db.session.commit()
@@ -0,0 +1,108 @@
+# -*- encoding: utf-8 -*-
+import time
+
+from coprs import models, rcp
+from coprs.constants import WORK_AVAILABLE_PUBSUB
+from coprs.helpers import StatusEnum, ActionTypeEnum
+from coprs.logic.backend_logic import BackendLogic
+
+from tests.coprs_test_case import CoprsTestCase
+
+
+class TestBackendLogic(CoprsTestCase):
+
+    def setup_method(self, method):
+        super(TestBackendLogic, self).setup_method(method)
+        self.pubsub = rcp.get_connection().pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(*[WORK_AVAILABLE_PUBSUB.format(kind=kind)
+                                for kind in ["build", "action", "import"]])
+
+    def teardown_method(self, method):
+        self.pubsub.close()
+        super(TestBackendLogic, self).teardown_method(method)
+
+    def get_published_kinds(self):
+        kinds = set()
+        for _ in range(10):
+            message = self.pubsub.get_message(timeout=0.05)
+            if message:
+                kinds.add(message["channel"].decode("utf-8").rsplit("::", 1)[1])
+        return kinds
+
+    def test_get_work_kinds(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.b1_bc[0].status = StatusEnum("pending")
+        self.b2_bc[0].status = StatusEnum("importing")
+        self.b3_bc[0].status = StatusEnum("running")
+        assert BackendLogic.get_work_kinds(self.db.session) == {"build", "import"}
+
+        self.db.session.commit()
+        self.b1_bc[0].leased_until = int(time.time()) + 300
+        self.b2_bc[0].last_deferred = int(time.time())
+        assert BackendLogic.get_work_kinds(self.db.session) == set()
+
+        self.db.session.add(models.Action(action_type=ActionTypeEnum("createrepo"), object_type="copr"))
+        assert BackendLogic.get_work_kinds(self.db.session) == {"action"}
+
+    def test_commit_publishes_work_available(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.get_published_kinds()
+
+        self.b1_bc[0].status = StatusEnum("pending")
+        self.db.session.commit()
+        assert self.get_published_kinds() == {"build"}
+
+        # no new work, just the pending task changes
+        self.b1_bc[0].leased_until = int(time.time()) + 300
+        self.b1_bc[0].last_deferred = int(time.time())
+        self.db.session.commit()
+        assert self.get_published_kinds() == set()
+
+        self.b1_bc[0].status = StatusEnum("running")
+        self.db.session.commit()
+        assert self.get_published_kinds() == set()
+
+        self.db.session.add(models.BuildChroot(build=self.b1, mock_chroot=self.mc2,
+                                               status=StatusEnum("pending")))
+        self.db.session.commit()
+        assert self.get_published_kinds() == {"build"}
+
+    def test_rollback_publishes_nothing(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.get_published_kinds()
+        self.b1_bc[0].status = StatusEnum("pending")
+        self.db.session.flush()
+        self.db.session.rollback()
+        self.db.session.commit()
+        assert self.get_published_kinds() == set()
+
+    def test_wait_for_work_no_wait(self):
+        start = time.time()
+        assert BackendLogic.wait_for_work(["build"], 0, lambda: None) is None
+        assert time.time() - start < 0.5
+
+    def test_wait_for_work_found_immediately(self):
+        start = time.time()
+        assert BackendLogic.wait_for_work(["build"], 10, lambda: "work") == "work"
+        assert time.time() - start < 0.5
+
+    def test_wait_for_work_timeout(self):
+        calls = []
+
+        def check():
+            calls.append(1)
+
+        start = time.time()
+        assert BackendLogic.wait_for_work(["build"], 0.3, check) is None
+        assert time.time() - start >= 0.3
+        assert len(calls) == 1
+
+    def test_wait_for_work_woken_up(self):
+        results = [None, "work"]
+
+        def check():
+            result = results.pop(0)
+            if result is None:
+                BackendLogic.publish_work_available(["build"])
+            return result
+
+        start = time.time()
+        assert BackendLogic.wait_for_work(["build"], 10, check) == "work"
+        assert time.time() - start < 5
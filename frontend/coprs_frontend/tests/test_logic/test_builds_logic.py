@@ -3,6 +3,9 @@ import json
 
 import pytest
 import time
+from mock import patch
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Query
 from sqlalchemy.orm.exc import NoResultFound
 from coprs import helpers, models
 from coprs.constants import MAX_BUILD_TIMEOUT
@@ -114,6 +117,73 @@ class TestBuildsLogic(CoprsTestCase):
         data = BuildsLogic.get_build_task_queue().all()
         assert len(data) == 5
 
+    def test_fair_share_queue_tags(self, f_users, f_coprs, f_mock_chroots, f_db):
+        # user1 queues three builds in fedora-18-x86_64, user2 one build in two chroots
+        builds = [BuildsLogic.add(self.u1, "foo{}".format(i), self.c1, skip_import=True)
+                  for i in range(3)]
+        builds.append(BuildsLogic.add(self.u2, "bar", self.c2, skip_import=True))
+        self.db.session.commit()
+
+        assert [bc.queue_tag for build in builds for bc in build.build_chroots] == [1, 2, 3, 2, 3]
+        order = [(task.build_id, task.build.copr.owner_name) for task in
+                 BuildsLogic.get_build_task_candidates().all()]
+        assert [owner for _, owner in order] == ["user1", "user1", "user2", "user1", "user2"]
+
+        # user2 has weight 2, the next build goes before user1's queue
+        models.BuildQueueOwner.query.get("user2").weight = 2
+        later = BuildsLogic.add(self.u2, "baz", self.c3, skip_import=True)
+        assert later.build_chroots[0].queue_tag == 3.5
+
+        background = BuildsLogic.add(self.u2, "qux", self.c3, skip_import=True, background=True)
+        assert background.build_chroots[0].queue_tag > later.build_chroots[0].queue_tag
+
+    def test_queue_owner_created_concurrently(self, f_users, f_coprs, f_mock_chroots, f_db):
+        owner = BuildsLogic.get_queue_owner("user2")
+        assert (owner.weight, owner.last_tag) == (1.0, 0.0)
+
+        # another submission inserted the row after this one found none
+        self.db.session.execute(models.BuildQueueOwner.__table__.insert(),
+                                {"owner_name": "user1", "weight": 2.0, "last_tag": 5.0})
+        first = Query.first
+        with patch.object(Query, "first", autospec=True,
+                          side_effect=lambda query: None if query.column_descriptions[0]["type"]
+                          is models.BuildQueueOwner else first(query)):
+            build = BuildsLogic.add(self.u1, "foo", self.c1, skip_import=True)
+        self.db.session.commit()
+        assert build.build_chroots[0].queue_tag == 5.5
+        assert models.BuildQueueOwner.query.count() == 2
+
+    def test_queue_owner_weight_positive(self, f_users, f_db):
+        self.db.session.add(models.BuildQueueOwner(owner_name="user1", weight=0))
+        with pytest.raises(IntegrityError):
+            self.db.session.commit()
+        self.db.session.rollback()
+
+    def test_untagged_tasks_go_first(self, f_users, f_coprs, f_mock_chroots, f_db):
+        tagged = BuildsLogic.add(self.u1, "foo", self.c1, skip_import=True)
+        untagged = BuildsLogic.add(self.u2, "bar", self.c3, skip_import=True)
+        untagged.build_chroots[0].queue_tag = None
+        self.db.session.commit()
+
+        order = [task.build_id for task in BuildsLogic.get_build_task_candidates().all()]
+        assert order == [untagged.id, tagged.id]
+
+    def test_fair_share_running_builds(self, f_users, f_coprs, f_mock_chroots, f_db):
+        builds = [BuildsLogic.add(self.u1, "foo{}".format(i), self.c1, skip_import=True)
+                  for i in range(4)]
+        self.db.session.commit()
+        BuildsLogic.add(self.u2, "bar", self.c3, skip_import=True)
+        for build in builds[:2]:
+            build.build_chroots[0].status = StatusEnum("running")
+            build.build_chroots[0].started_on = int(time.time())
+        self.db.session.commit()
+
+        # user1's next build has lower tag, but user1 already runs two builds
+        assert BuildsLogic.get_build_task().build.copr.owner_name == "user2"
+
+        tasks = BuildsLogic.lease_build_tasks(3, 300)
+        assert [task.build.copr.owner_name for task in tasks] == ["user2", "user1", "user1"]
+
     def test_build_queue_6(self, f_users, f_coprs, f_mock_chroots, f_db):
         self.db.session.commit()
         data = BuildsLogic.get_build_task_queue().all()
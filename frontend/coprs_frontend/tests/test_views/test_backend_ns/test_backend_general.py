@@ -1,5 +1,7 @@
 import json
+import time
 
+from coprs import models, helpers
 from tests.coprs_test_case import CoprsTestCase
 from coprs.logic.builds_logic import BuildsLogic
 
@@ -21,11 +23,44 @@ class TestWaitingBuilds(CoprsTestCase):
         r = self.tc.get("/backend/waiting/", headers=self.auth_header)
         #assert len(json.loads(r.data.decode("utf-8"))["builds"]) == 5 #TODO: make the test useful ?
 
+    def test_waiting_long_poll(self):
+        start = time.time()
+        r = self.tc.get("/backend/waiting/?wait=0.3", headers=self.auth_header)
+        data = json.loads(r.data.decode("utf-8"))
+        assert data == {"action": None, "build": None}
+        assert time.time() - start >= 0.3
+
+    def test_waiting_long_poll_for_builds_only(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.db.session.add(models.Action(
+            action_type=helpers.ActionTypeEnum("createrepo"), object_type="copr",
+            data="", created_on=int(time.time())))
+        self.db.session.commit()
+
+        start = time.time()
+        r = self.tc.get("/backend/waiting/?wait=0.3&wait_for=build", headers=self.auth_header)
+        data = json.loads(r.data.decode("utf-8"))
+        assert data["action"] is not None
+        assert data["build"] is None
+        assert time.time() - start >= 0.3
+
+        start = time.time()
+        r = self.tc.get("/backend/waiting/?wait=10", headers=self.auth_header)
+        assert json.loads(r.data.decode("utf-8"))["action"] is not None
+        assert time.time() - start < 5
+
+    def test_waiting_for_unknown_kind(self):
+        start = time.time()
+        r = self.tc.get("/backend/waiting/?wait=10&wait_for=import", headers=self.auth_header)
+        assert r.status_code == 400
+        assert time.time() - start < 5
+
     def test_waiting_bg_build(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
         self.b2.is_background = True
-        for build_chroots in [self.b2_bc, self.b3_bc, self.b4_bc]:
+        for build, build_chroots in [(self.b2, self.b2_bc), (self.b3, self.b3_bc), (self.b4, self.b4_bc)]:
             for build_chroot in build_chroots:
                 build_chroot.status = 4  # pending
+            BuildsLogic.assign_queue_tags(build)
         self.db.session.commit()
 
         r = self.tc.get("/backend/waiting/")
@@ -33,6 +68,96 @@ class TestWaitingBuilds(CoprsTestCase):
         assert data["build"]["build_id"] == 3
 
 
+class TestPendingBuildCounts(CoprsTestCase):
+
+    def test_pending_build_counts(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroots in [self.b2_bc, self.b3_bc, self.b4_bc]:
+            for build_chroot in build_chroots:
+                build_chroot.status = 4  # pending
+        self.b3.canceled = True
+        self.b4.submitted_on = int(time.time())
+        self.db.session.commit()
+
+        r = self.tc.get("/backend/pending_build_counts/?window=600", headers=self.auth_header)
+        data = json.loads(r.data.decode("utf-8"))
+        assert data["pending"] == {"x86_64": 2, "i386": 1}
+        assert data["arrived"] == {"x86_64": 1, "i386": 1}
+        assert data["window"] == 600
+
+    def test_pending_build_counts_bad_window(self):
+        r = self.tc.get("/backend/pending_build_counts/?window=foo", headers=self.auth_header)
+        assert r.status_code == 400
+
+
+class TestLeaseBuildTasks(CoprsTestCase):
+
+    def lease(self, **kwargs):
+        r = self.tc.post("/backend/lease_build_tasks/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps(kwargs))
+        return json.loads(r.data.decode("utf-8"))["builds"]
+
+    def test_lease_requires_password(self):
+        r = self.tc.post("/backend/lease_build_tasks/",
+                         content_type="application/json",
+                         data=json.dumps({"count": 5}))
+        assert b"You have to provide the correct password" in r.data
+
+    def test_leased_tasks_are_not_offered_again(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        for build_chroots in [self.b2_bc, self.b3_bc, self.b4_bc]:
+            for build_chroot in build_chroots:
+                build_chroot.status = 4  # pending
+        self.db.session.commit()
+
+        first = self.lease(count=2)
+        assert [task["task_id"] for task in first] == \
+            ["2-fedora-18-x86_64", "3-fedora-17-x86_64"]
+
+        second = self.lease(count=10)
+        assert set(task["task_id"] for task in second) == \
+            {"3-fedora-17-i386", "4-fedora-17-x86_64", "4-fedora-17-i386"}
+
+        assert self.lease(count=10) == []
+        r = self.tc.get("/backend/waiting/", headers=self.auth_header)
+        assert json.loads(r.data.decode("utf-8"))["build"] is None
+
+    def test_expired_lease(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroot in self.b3_bc:
+            build_chroot.status = 4  # pending
+            build_chroot.leased_until = 10
+        self.db.session.commit()
+
+        assert len(self.lease(count=10)) == 2
+
+    def test_lease_filtered_by_arch(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroots in [self.b3_bc, self.b4_bc]:
+            for build_chroot in build_chroots:
+                build_chroot.status = 4  # pending
+        self.db.session.commit()
+
+        leased = self.lease(count=10, archs=["i386"])
+        assert [task["chroot"] for task in leased] == ["fedora-17-i386"] * 2
+
+    def test_deferred_build_loses_lease(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroot in self.b3_bc:
+            build_chroot.status = 4  # pending
+        self.db.session.commit()
+
+        self.lease(count=10)
+        self.tc.post("/backend/defer_build/",
+                     content_type="application/json",
+                     headers=self.auth_header,
+                     data=json.dumps({"build_id": 3, "chroot": "fedora-17-i386"}))
+
+        build_chroots = self.models.Build.query.get(3).chroots_dict_by_name
+        assert build_chroots["fedora-17-i386"].leased_until is None
+        assert build_chroots["fedora-17-i386"].last_deferred is not None
+        assert build_chroots["fedora-17-x86_64"].leased_until is not None
+
+
 # status = 0 # failure
 # status = 1 # succeeded
 class TestUpdateBuilds(CoprsTestCase):
@@ -146,6 +271,51 @@ class TestUpdateBuilds(CoprsTestCase):
         assert ended.chroots_ended_on == {'fedora-18-x86_64': 139086644000}
 
 
+    def test_update_same_build_in_order(self, f_users, f_coprs, f_mock_chroots,
+                                        f_builds, f_db):
+        self.db.session.commit()
+        data = {"builds": [
+            {"id": 1, "chroot": "fedora-18-x86_64", "status": 3, "started_on": 139086644000},
+            {"id": 1, "chroot": "fedora-18-x86_64", "status": 1, "ended_on": 149086644000},
+        ]}
+        r = self.tc.post("/backend/update/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps(data))
+        assert json.loads(r.data.decode("utf-8"))["updated_builds_ids"] == [1]
+
+        updated = self.models.Build.query.get(1)
+        assert updated.status == 1
+        assert updated.chroots_started_on == {'fedora-18-x86_64': 139086644000}
+        assert updated.chroots_ended_on == {'fedora-18-x86_64': 149086644000}
+
+
+class TestProjectSettings(CoprsTestCase):
+
+    def get_settings(self, **kwargs):
+        r = self.tc.post("/backend/project_settings/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps(kwargs))
+        return json.loads(r.data.decode("utf-8"))["projects"]
+
+    def test_project_settings(self, f_users, f_db):
+        self.c1 = models.Copr(name=u"foocopr", user=self.u1)
+        self.c2 = models.Copr(name=u"foocopr", user=self.u2, auto_createrepo=False)
+        self.c3 = models.Copr(name=u"barcopr", user=self.u2, persistent=True)
+        self.db.session.add_all([self.c1, self.c2, self.c3])
+        self.db.session.commit()
+
+        assert self.get_settings() == {
+            self.c1.full_name: {"auto_createrepo": True, "persistent": False},
+            self.c2.full_name: {"auto_createrepo": False, "persistent": False},
+            self.c3.full_name: {"auto_createrepo": True, "persistent": True},
+        }
+        assert self.get_settings(projects=[self.c2.full_name, "foo/nonexisting"]) == {
+            self.c2.full_name: {"auto_createrepo": False, "persistent": False},
+        }
+
+
 class TestWaitingActions(CoprsTestCase):
 
     def test_no_waiting_actions(self):
@@ -159,6 +329,25 @@ class TestWaitingActions(CoprsTestCase):
         #assert len(json.loads(r.data.decode("utf-8"))["actions"]) == 2  #TODO: make the test useful ?
 
 
+    def test_waiting_actions_batch(self, f_users, f_coprs, f_db):
+        for i in range(3):
+            self.db.session.add(models.Action(
+                action_type=helpers.ActionTypeEnum("createrepo"), object_type="copr",
+                data="", created_on=1000 + i))
+        self.db.session.commit()
+        ids = [action.id for action in models.Action.query.order_by(models.Action.created_on)]
+
+        r = self.tc.get("/backend/waiting_actions/?count=2", headers=self.auth_header)
+        assert [a["id"] for a in json.loads(r.data.decode("utf-8"))["actions"]] == ids[:2]
+
+        r = self.tc.get("/backend/waiting_actions/?count=5&exclude={},{}".format(*ids[:2]),
+                        headers=self.auth_header)
+        assert [a["id"] for a in json.loads(r.data.decode("utf-8"))["actions"]] == ids[2:]
+
+        r = self.tc.get("/backend/waiting_actions/?count=x", headers=self.auth_header)
+        assert r.status_code == 400
+
+
 class TestUpdateActions(CoprsTestCase):
     data1 = """
 {
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Compares run time of the default (dnf + rpm) and --native prunerepo modes
+on a synthetic copr-like repository and checks both leave the same files.
+
+The repository has PACKAGES binary rpms, every package name is built in
+VERSIONS successive build directories together with its srpm. All rpm files
+are symlinks to one sample rpm so that "rpm -qp" works in the default mode,
+the repository metadata are generated directly by this script. All packages
+are older than --days, so everything but the latest build of each package
+gets removed.
+
+    python3 benchmarks/synthetic_repo.py --rpm foo.rpm --packages 50000 --versions 5
+"""
+
+import argparse
+import gzip
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from xml.sax.saxutils import quoteattr
+
+
+PRUNEREPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'prunerepo')
+
+MODES = {
+    'dnf': [],
+    'native': ['--native'],
+}
+
+PACKAGE_TEMPLATE = """<package type="rpm">
+  <name>{name}</name>
+  <arch>{arch}</arch>
+  <version epoch="0" ver="{version}" rel="1"/>
+  <checksum type="sha256" pkgid="YES">{checksum}</checksum>
+  <summary>synthetic package</summary>
+  <description></description>
+  <packager></packager>
+  <url></url>
+  <time file="{build_time}" build="{build_time}"/>
+  <size package="1" installed="1" archive="1"/>
+  <location href={location}/>
+  <format>
+    <rpm:license>GPLv2+</rpm:license>
+    <rpm:sourcerpm>{sourcerpm}</rpm:sourcerpm>
+  </format>
+</package>
+"""
+
+REPOMD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo" xmlns:rpm="http://linux.duke.edu/metadata/rpm">
+  <revision>{timestamp}</revision>
+  <data type="primary">
+    <checksum type="sha256">{checksum}</checksum>
+    <open-checksum type="sha256">{open_checksum}</open-checksum>
+    <location href="repodata/primary.xml.gz"/>
+    <timestamp>{timestamp}</timestamp>
+    <size>{size}</size>
+    <open-size>{open_size}</open-size>
+  </data>
+</repomd>
+"""
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def generate_repo(path, sample_rpm, packages, versions):
+    entries = []
+    build_id = 0
+    build_time = int(time.time()) - 30 * 24 * 3600
+    for name_id in range(packages // versions):
+        name = 'synthetic{0}'.format(name_id)
+        for version in range(1, versions + 1):
+            build_id += 1
+            build_dir = '{0:08d}-{1}'.format(build_id, name)
+            os.mkdir(os.path.join(path, build_dir))
+            srpm = '{0}-{1}-1.src.rpm'.format(name, version)
+            for arch, filename, sourcerpm in [('src', srpm, ''),
+                                              ('x86_64', '{0}-{1}-1.x86_64.rpm'.format(name, version), srpm)]:
+                location = os.path.join(build_dir, filename)
+                os.symlink(sample_rpm, os.path.join(path, location))
+                entries.append(PACKAGE_TEMPLATE.format(
+                    name=name, arch=arch, version=version, build_time=build_time,
+                    checksum=sha256(location.encode('utf-8')),
+                    location=quoteattr(location), sourcerpm=sourcerpm))
+
+    primary = ''.join(
+        ['<?xml version="1.0" encoding="UTF-8"?>\n',
+         '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+         'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{0}">\n'.format(len(entries))]
+        + entries + ['</metadata>\n']).encode('utf-8')
+    primary_gz = gzip.compress(primary)
+
+    os.mkdir(os.path.join(path, 'repodata'))
+    with open(os.path.join(path, 'repodata', 'primary.xml.gz'), 'wb') as f:
+        f.write(primary_gz)
+    with open(os.path.join(path, 'repodata', 'repomd.xml'), 'w') as f:
+        f.write(REPOMD_TEMPLATE.format(
+            timestamp=int(time.time()), checksum=sha256(primary_gz), open_checksum=sha256(primary),
+            size=len(primary_gz), open_size=len(primary)))
+
+
+def list_rpms(path):
+    return sorted(os.path.relpath(os.path.join(root, name), path)
+                  for root, _, names in os.walk(path)
+                  for name in names if name.endswith('.rpm'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rpm', required=True, help='sample rpm file')
+    parser.add_argument('--packages', type=int, default=50000, help='number of binary rpms in the repository')
+    parser.add_argument('--versions', type=int, default=5, help='number of builds of every package name')
+    parser.add_argument('--mode', choices=sorted(MODES), action='append',
+                        help='can be given more times, default is all modes')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='prunerepo-bench-')
+    try:
+        template = os.path.join(workdir, 'template')
+        os.mkdir(template)
+        sample_rpm = os.path.join(workdir, 'sample.rpm')
+        shutil.copy(args.rpm, sample_rpm)
+        generate_repo(template, sample_rpm, args.packages, args.versions)
+
+        remaining = {}
+        for mode in args.mode or sorted(MODES):
+            repo = os.path.join(workdir, mode)
+            subprocess.check_call(['cp', '-a', template, repo])
+
+            start = time.time()
+            subprocess.check_call([PRUNEREPO, '--quiet', '--nocreaterepo'] + MODES[mode] + [repo])
+            took = time.time() - start
+
+            remaining[mode] = list_rpms(repo)
+            print('{0:8} {1:8.2f}s  rpms left: {2}'.format(mode, took, len(remaining[mode])))
+            shutil.rmtree(repo)
+
+        if len(set(map(tuple, remaining.values()))) > 1:
+            print('modes left different rpms in the repository')
+            return 1
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
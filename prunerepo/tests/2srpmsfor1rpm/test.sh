@@ -27,4 +27,17 @@ run 'ls 00000009-motionpaint-1.4/*.rpm' && die
 
 echo success.
 
+echo "============================ The same with --native ============================";
+
+setup
+runcmd --native --days=1 .
+
+run 'ls 00000003-motionpaint-1.3/*.rpm' && die
+run 'ls 00000005-motionpaint-1.3/*.rpm' && die
+run 'ls 00000007-motionpaint-1.4/*.rpm' || die
+run 'ls 00000007-motionpaint-1.4/*.src.rpm' || die
+run 'ls 00000009-motionpaint-1.4/*.rpm' && die
+
+echo success.
+
 exit 0
@@ -60,6 +60,26 @@ run '[[ `ls 3-latestpkg/*.rpm | wc -l` == 3 ]]' || die
 
 echo success.
 
+echo "============================ test --native ============================";
+
+setup
+runcmd --native .
+
+run 'ls 0-oldestbuild/*.rpm' && die
+run 'ls 1-norpmsinside/*.rpm' && die
+run 'ls 2-secondlatestpkg/*.rpm' && die
+run '[[ `ls 3-latestpkg/*.rpm | wc -l` == 3 ]]' || die
+run '[[ `listpkgsbyfs` == `listpkgsbyrepo` ]]' || die
+
+setup
+runcmd --native --days $oldestbuilddayback .
+
+run 'ls 0-oldestbuild/*.rpm' && die
+run '[[ `ls 2-secondlatestpkg/*.rpm | wc -l` == 3 ]]' || die
+run '[[ `ls 3-latestpkg/*.rpm | wc -l` == 3 ]]' || die
+
+echo success.
+
 echo "============================ test --nocreaterepo ============================";
 
 setup